@@ -3,23 +3,61 @@
 
 import os
 import sys
+import logging
 
-# pcraster dynamic framework is used:
-from pcraster.framework import DynamicFramework
-
-# classes used in this script
-from dynamic_resample_framework import ResampleFramework
-
-# time object
-from currTimeStep import ModelTime
-
-# utility module:
+# utility module (pcraster is imported only when it is used):
 import virtualOS as vos
+import datasetPool
+
+# the engine with numpy and netCDF4 only (the pcraster dynamic framework and ResampleFramework 
+# are imported in main, only if they are used)
+import streaming
 
 # starting and end dates
 startDate = "1958-01-01" #YYYY-MM-DD
 endDate   = "2010-12-31" #YYYY-MM-DD
 
+# run mode:
+# - "input_time_axis": only the time steps of the input netcdf file between startDate and endDate are resampled
+#                      (the input file can have daily, monthly, yearly or irregular time steps)
+# - "incremental"    : as "input_time_axis", but only the input time steps that are not in the output file yet (e.g. the
+#                      new months of a growing input file) are resampled and appended to it (it stops at once if there 
+#                      are no new time steps)
+# - "tiled"          : as "input_time_axis", but the fields are read, resampled and written in tiles (latitude bands) 
+#                      of tile_rows output rows, for grids that do not fit in memory (e.g. 30 arc-second inputs)
+# - "daily"          : the pcraster DynamicFramework is used with daily time steps and monthly input values 
+#                      (only the last days of months are resampled) 
+run_mode = "input_time_axis"
+
+# engine:
+# - "numpy"   : the input time steps are resampled with numpy and netCDF4 only (streaming.resampleNetcdf), without 
+#               PCRaster (which does not have to be installed; clone and cell area maps are read without it), for the
+#               "input_time_axis" and "incremental" run modes of one variable (without memory_budget, read-ahead or workers)
+# - "pcraster": ResampleFramework (a pcraster DynamicModel), for all run modes and options
+# - "auto"    : "numpy" if the run mode and options allow it, otherwise "pcraster"
+engine = "auto"
+
+# for the "input_time_axis" and "tiled" run modes: the number of time steps that are read, resampled and written at once;
+# it is either given (block_size) or derived from the memory (MB) that may be used (memory_budget)
+block_size    = 1
+memory_budget = None
+#~ memory_budget = 2000.
+
+# for the "tiled" run mode: the number of output rows and columns per tile (tile_rows None: derived from memory_budget, 
+# or all rows; tile_cols None: all columns); with tile_cols, tiles without input values (e.g. ocean) are skipped more often
+tile_rows = None
+tile_cols = None
+
+# for the "input_time_axis" run mode: the number of blocks that are read ahead (by a "process" or a "thread") 
+# while the current block is resampled (0: no read-ahead)
+prefetch_depth = 0
+prefetch_mode  = "process"
+
+# for the "input_time_axis" run mode: the number of processes that read and resample blocks in parallel 
+# (the blocks are still written in the order of time in one output file); for the "tiled" run mode: the number 
+# of processes that read and resample the tiles of every block in parallel
+number_of_workers = 1
+
 # input netcdf file:
 input_netcdf = {}
 input_netcdf['folder']           = "/scratch/edwin/05min_runs_results/2015_04_27/non_natural_2015_04_27/global/netcdf/"
@@ -30,6 +68,9 @@ input_netcdf['clone_file']       = "/data/hydroworld/PCRGLOBWB20/input5min/routi
 input_netcdf['cell_resolution']  = 5./60.
 # cell area (m2) for the input netcdf file:
 input_netcdf['cell_area']        = "/data/hydroworld/PCRGLOBWB20/input5min/routing/cellsize05min.correct.map"
+# optional: the folder of (reusable) cell area maps that are warped to the clone (if their grids differ); 
+#           it can be shared by several runs (default: the tmp folder of the run)
+#~ input_netcdf['warp_cache_folder'] = "/scratch/edwin/warp_cache/"
 
 # output netcdf file:
 output_netcdf = {}
@@ -40,9 +81,56 @@ output_netcdf['file_name']       = "totalEvaporation_monthTot_output_30min_upsca
 output_netcdf['file_name']       = output_netcdf['folder']+"/"+output_netcdf['file_name']
 output_netcdf['variable_name']   = "total_evaporation"
 output_netcdf['variable_unit']   = "m.month-1"
+# optional: the folder for (reusable) remapping plans with sparse weights; such plans are also used  
+#           for non-integer resample factors and for output origins (xUL, yUL) that differ from the input
+#~ output_netcdf['remap_plan_folder'] = output_netcdf['folder']+"/remap_plans/"
+
+# optional: the method for downscaling (if the output cell_resolution is smaller than the input one):
+#           "nearest" (default; block replication), "bilinear" or "area" (area-weighted, mass-preserving)
+#~ output_netcdf['downscaling_method'] = "bilinear"
+
+# resume: an existing output file (with the same grid and variable) is continued after its last complete time step
+#         (e.g. after an interrupted run); a partially written final time step is written again; without resume, 
+#         the output file is made again (the "incremental" run mode always resumes)
+output_netcdf['resume'] = False
+
+# progress and instrumentation: progress messages (with the throughput and the remaining time) are printed at most 
+# every progress_interval seconds; at the end of a run, the time, bytes and peak memory use of every stage (read, refine, 
+# upscale/downscale, write and sync) are printed; optional: a profile (cProfile) of the run is saved in profile_file 
+output_netcdf['progress_interval'] = 10.
+#~ output_netcdf['profile_file'] = output_netcdf['folder']+"/resample.prof"
+# logging level: logging.DEBUG also reports every time step and every opened (or cached) netcdf file
+log_level = logging.INFO
+
+# the maximum number of netcdf files that are kept open (input and output files; see datasetPool)
+max_open_files = 64
+
+# multi-variable mode (optional): other variables that are resampled (in one pass over time) with the same setup 
+# (clone, cell area and upscaling) as the variable above; items: [input file name, input variable name, 
+# output variable name, output variable unit]; all input files must have the same time steps
+variable_list = []
+#~ variable_list.append([input_netcdf['folder']+"/totalRunoff_monthTot_output.nc", "total_runoff", "total_runoff", "m.month-1"])
+# - True : all variables are written in output_netcdf['file_name']
+# - False: one output file per input file (in the output folder; the input file name with output_file_suffix)
+single_output_file = True
+output_file_suffix = "_30min_upscaled_from_5min"
 #
 output_netcdf['format']    = "NETCDF4"
 output_netcdf['zlib']      = True
+# optional: buffered writing; the number of time steps that are written at once (buffer_size) and
+#           the number of written time steps after which the output file is synchronized (sync_interval)
+#~ output_netcdf['buffer_size']   = 12
+#~ output_netcdf['sync_interval'] = 120
+# optional: storage options; chunksizes can be a tuple (time, lat, lon), "map" (for reading whole time steps) 
+#           or "timeseries" (for reading long time series, with output_netcdf['chunk_time_steps'] per chunk);
+#           least_significant_digit trims the precision (e.g. 3: values are stored with a precision of 0.001)
+#           (see output_netcdf_report.py for file sizes and throughputs of some of these options)
+#~ output_netcdf['chunksizes']  = "map"
+#~ output_netcdf['complevel']   = 4
+#~ output_netcdf['shuffle']     = True
+#~ output_netcdf['least_significant_digit'] = None
+# - the "tiled" run mode writes latitude bands: chunks of whole maps would be decompressed and compressed again for every tile  
+if run_mode == "tiled" and 'chunksizes' not in output_netcdf.keys(): output_netcdf['chunksizes'] = "map"
 output_netcdf['netcdf_attribute'] = {}
 output_netcdf['netcdf_attribute']['institution'] = "Department of Physical Geography, Utrecht University" 
 output_netcdf['netcdf_attribute']['title'      ] = "PCR-GLOBWB output"
@@ -66,8 +154,38 @@ try:
 except:
     os.system('rm -r '+str(output_netcdf['folder'])+"/tmp/*")
 
+def getEngine():
+    # the engine that is used (see engine)
+    numpy_engine = run_mode in ["input_time_axis", "incremental"] and len(variable_list) == 0 and memory_budget == None and\
+                   prefetch_depth == 0 and number_of_workers == 1
+    if engine == "numpy" and not numpy_engine:
+        raise ValueError("The numpy engine only resamples one variable in the input_time_axis or incremental run mode, "+\
+                         "without memory_budget, prefetch_depth or number_of_workers.")
+    if engine == "auto": return "numpy" if numpy_engine else "pcraster"
+    return engine
+
 def main():
     
+    logging.basicConfig(level = log_level, format = "%(message)s")
+    datasetPool.pool.setMaxOpenFiles(max_open_files)
+
+    # incremental mode: the time axes of the input and output files are compared first 
+    if run_mode == "incremental":
+        output_netcdf['resume'] = True
+        time_steps = streaming.getTimeStepsToAppend(input_netcdf, output_netcdf, startDate, endDate)
+        print("Number of new input time steps for "+str(output_netcdf['file_name'])+": "+str(len(time_steps)))
+        if len(time_steps) == 0: return
+
+    # resample netcdf with numpy and netCDF4 only
+    if getEngine() == "numpy":
+        streaming.resampleNetcdf(input_netcdf, output_netcdf, startDate, endDate, block_size)
+        return
+
+    # pcraster dynamic framework is used:
+    from pcraster.framework import DynamicFramework
+    from dynamic_resample_framework import ResampleFramework
+    from currTimeStep import ModelTime
+    
     # time object
     modelTime = ModelTime() # timeStep info: year, month, day, doy, hour, etc
     modelTime.getStartEndTimeSteps(startDate,endDate)
@@ -77,9 +195,18 @@ def main():
                                       output_netcdf,\
                                       modelTime,\
                                       tmpDir)
-    dynamic_framework = DynamicFramework(resampleModel, modelTime.nrOfTimeSteps)
-    dynamic_framework.setQuiet(True)
-    dynamic_framework.run()
+    if len(variable_list) > 0:
+        resampleModel.runMultipleVariables(variable_list, startDate, endDate, single_output_file, output_file_suffix,\
+                                           block_size, memory_budget)
+    elif run_mode in ["input_time_axis", "incremental"]:
+        resampleModel.runOverInputTimeSteps(startDate, endDate, block_size, memory_budget, prefetch_depth, prefetch_mode,\
+                                            number_of_workers)
+    elif run_mode == "tiled":
+        resampleModel.runTiled(startDate, endDate, block_size, memory_budget, tile_rows, tile_cols, number_of_workers)
+    else:
+        dynamic_framework = DynamicFramework(resampleModel, modelTime.nrOfTimeSteps)
+        dynamic_framework.setQuiet(True)
+        dynamic_framework.run()
                                       
 
 if __name__ == '__main__':
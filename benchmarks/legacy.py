@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# The legacy (cell-by-cell) implementations of the resampling stages, copied from the first
+# version of virtualOS.py and dynamic_resample_framework.py in the git history. They are only
+# used by run_benchmarks.py to check that the current implementations give the same results.
+
+import gc
+
+import numpy as np
+import numpy.ma as ma
+
+MV = 1e20
+smallNumber = 1E-39
+
+def regridData2FinerGrid(rescaleFac,coarse,MV):
+    if rescaleFac ==1:
+        return coarse
+    nr,nc = np.shape(coarse)
+
+    fine= np.zeros(nr*nc*rescaleFac*rescaleFac).reshape(nr*rescaleFac,nc*rescaleFac) + MV
+
+
+    ii = -1
+    nrF,ncF = np.shape(fine)
+    for i in range(0 , nrF):
+            if i % rescaleFac == 0:
+                ii += 1
+            fine [i,:] = coarse[ii,:].repeat(rescaleFac)
+
+    nr = None; nc = None
+    del nr; del nc
+    nrF = None; ncF = None
+    del nrF; del ncF
+    n = gc.collect() ; del gc.garbage[:] ; n = None ; del n
+    return fine
+
+def regridToCoarse(fine,fac,mode,missValue):
+    nr,nc = np.shape(fine)
+    coarse = np.zeros(nr/fac * nc / fac).reshape(nr/fac,nc/fac) + MV
+    nr,nc = np.shape(coarse)
+    for r in range(0,nr):
+        for c in range(0,nc):
+            ar = fine[r * fac : fac * (r+1),c * fac: fac * (c+1)]
+            m = np.ma.masked_values(ar,missValue)
+            if ma.count(m) == 0:
+                coarse[r,c] = MV
+            else:
+                if mode == 'average':
+                    coarse [r,c] = ma.average(m)
+                elif mode == 'median':
+                    coarse [r,c] = ma.median(m)
+                elif mode == 'sum':
+                    coarse [r,c] = ma.sum(m)
+                elif mode =='min':
+                    coarse [r,c] = ma.min(m)
+                elif mode == 'max':
+                    coarse [r,c] = ma.max(m)
+    return coarse
+
+def getValDivZero(x,y,y_lim,z_def= 0.):
+  #-returns the result of a division that possibly involves a zero
+  # denominator; in which case, a default value is substituted:
+  # x/y= z in case y > y_lim,
+  # x/y= z_def in case y <= y_lim, where y_lim -> 0.
+  # z_def is set to zero if not otherwise specified
+  import pcraster as pcr
+  return pcr.ifthenelse(y > y_lim,x/pcr.max(y_lim,y),z_def)
+
+def areaWeightedUpscaling(values, cell_area, resample_factor, grid):
+    #
+    # The former PCRaster upscaling of ResampleFramework (__init__ and dynamic); values and cell_area
+    # are numpy arrays on the input grid (a dictionary with 'rows', 'cols', 'cellsize', 'xUL' and 'yUL').
+    import pcraster as pcr
+
+    # get the unique ids for the output resolution
+    pcr.setclone(int(grid['rows']) / resample_factor, int(grid['cols']) / resample_factor,
+                 grid['cellsize'] * resample_factor, grid['xUL'], grid['yUL'])
+    cell_unique_ids = pcr.pcr2numpy(pcr.scalar(pcr.uniqueid(pcr.boolean(1.))),MV)
+
+    # the remaining pcraster calculations are performed at the input resolution
+    pcr.setclone(int(grid['rows']), int(grid['cols']), grid['cellsize'], grid['xUL'], grid['yUL'])
+    unique_ids = pcr.nominal(pcr.numpy2pcr(pcr.Scalar, regridData2FinerGrid(resample_factor,cell_unique_ids, MV), MV))
+    cell_area = pcr.numpy2pcr(pcr.Scalar, cell_area, MV)
+    output_value = pcr.numpy2pcr(pcr.Scalar, values, MV)
+
+    # upscaling using cell area
+    output_value_in_pcraster = \
+                    getValDivZero(\
+                    pcr.areatotal(output_value*cell_area, unique_ids),\
+                    pcr.areatotal(cell_area, unique_ids), smallNumber)
+
+    # resample to the output clone resolution
+    return regridToCoarse(pcr.pcr2numpy(output_value_in_pcraster, MV), resample_factor, "max", MV)
@@ -0,0 +1,299 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Benchmarks of the resampling stages with synthetic data (no input files are needed): for every
+# resolution, a global netCDF input (with a monthly and a daily time axis) and a cell area map are
+# made in a work folder, and the following stages are timed separately:
+#
+# - read_numpy       : vos.netcdf2NumpyClone (every time step),
+# - read_pcraster    : vos.netcdf2PCRobjClone (every time step; only if PCRaster is available),
+# - regrid_finer     : vos.regridData2FinerGrid (from the output to the input resolution),
+# - upscaling        : upscaling.AreaWeightedUpscaling (setup and upscale),
+# - regrid_coarse_*  : vos.regridToCoarse for every mode,
+# - write            : OutputNetcdf.data2NetCDF (every time step, at the input resolution).
+#
+# The results are checked against the legacy implementations (see legacy.py; the legacy loops are
+# only run on a window of legacy_rows output rows) and the results are saved in a JSON file, which
+# can be compared with the one of another version (legacy times are scaled from the window to the whole field):
+#
+# usage: python run_benchmarks.py [results_file] [resolutions] [work_folder]
+#        python run_benchmarks.py compare old_results_file new_results_file
+#
+# resolutions: a comma separated list of "30min", "5min", "30sec" (a 30 x 60 degree window) and
+#              "30sec_global" (the whole globe: about 4 GB per field); default: "30min,5min,30sec"
+
+import os
+import sys
+import json
+import time
+import struct
+import datetime
+import platform
+import subprocess
+import shutil
+import tempfile
+
+import numpy as np
+import netCDF4 as nc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import virtualOS as vos
+import csfMap
+from upscaling import AreaWeightedUpscaling
+from outputNetcdf import OutputNetcdf
+
+import legacy
+
+try:
+    import pcraster as pcr
+    from pcraster import numpy2pcr
+    pcraster_available = True
+except ImportError:
+    pcraster_available = False
+
+# resolutions: cell size (arc-degree), extent (rows and columns), the resample factor of the upscaling
+# stages and the number of time steps of the monthly and daily axes
+resolutions = {"30min"       : {'cellsize': 30./60. , 'rows':   360, 'cols':   720, 'factor':  2, 'time_steps': {'monthly': 24, 'daily': 62}},
+               "5min"        : {'cellsize':  5./60. , 'rows':  2160, 'cols':  4320, 'factor':  6, 'time_steps': {'monthly': 12, 'daily': 31}},
+               "30sec"       : {'cellsize':  0.5/60., 'rows':  3600, 'cols':  7200, 'factor': 10, 'time_steps': {'monthly':  3, 'daily':  3}},
+               "30sec_global": {'cellsize':  0.5/60., 'rows': 21600, 'cols': 43200, 'factor': 10, 'time_steps': {'monthly':  2, 'daily':  2}}}
+
+regrid_modes = ['average', 'median', 'sum', 'min', 'max']
+
+# the number of output rows on which the legacy loops are run
+legacy_rows = 12
+
+variable_name = "total_evaporation"
+
+def writeMap(fileName, values, cellsize, xUL, yUL):
+    # writes a (float32, scalar) PCRaster map (CSF 2.0; see csfMap for the layout)
+    header = bytearray(csfMap.csfDataOffset)
+    header[0:len(csfMap.csfSignature)] = csfMap.csfSignature
+    struct.pack_into('<H', header, 32, 2)
+    struct.pack_into('<I', header, 46, 1)
+    struct.pack_into('<HH', header, 64, 0xEB, 0x5A)
+    struct.pack_into('<dd', header, 84, xUL, yUL)
+    struct.pack_into('<II', header, 100, values.shape[0], values.shape[1])
+    struct.pack_into('<ddd', header, 108, cellsize, cellsize, 0.)
+    with open(fileName, 'wb') as mapFile:
+        mapFile.write(bytes(header))
+        mapFile.write(np.where(values == vos.MV, np.nan, values).astype('<f4').tobytes())
+
+def gridOf(resolution):
+    # the grid (cell size, rows, cols and upper left corner) of a resolution; the 30sec window is in Europe/Africa
+    grid = dict(resolutions[resolution])
+    grid['xUL'] = -180.0 ; grid['yUL'] = 90.0
+    if resolution == "30sec": grid['xUL'] = -10.0 ; grid['yUL'] = 60.0
+    return grid
+
+def latitudesOf(grid, rowStart = 0, rowEnd = None):
+    if rowEnd == None: rowEnd = grid['rows']
+    return grid['yUL'] - grid['cellsize'] * (np.arange(rowStart, rowEnd) + 0.5)
+
+def longitudesOf(grid):
+    return grid['xUL'] + grid['cellsize'] * (np.arange(grid['cols']) + 0.5)
+
+def cellArea(grid, rowStart = 0, rowEnd = None):
+    # cell area (m2) of the rows rowStart, ..., rowEnd - 1 of a regular latitude/longitude grid
+    radius = 6371007.2
+    latitudes = latitudesOf(grid, rowStart, rowEnd)
+    north = np.radians(latitudes + grid['cellsize'] / 2.) ; south = np.radians(latitudes - grid['cellsize'] / 2.)
+    area = radius**2 * np.radians(grid['cellsize']) * (np.sin(north) - np.sin(south))
+    return np.repeat(area[:,None], grid['cols'], axis = 1)
+
+def syntheticField(grid, time_step, rowStart = 0, rowEnd = None):
+    # a smooth field with some noise; the "oceans" (about 60 percent of the cells) are missing
+    lat = np.radians(latitudesOf(grid, rowStart, rowEnd))[:,None]
+    lon = np.radians(longitudesOf(grid))[None,:]
+    land = np.sin(3.0 * lon) * np.cos(2.0 * lat) + 0.5 * np.sin(5.0 * lat + lon) > 0.3
+    noise = np.random.RandomState(time_step).rand(len(lat[:,0]), len(lon[0])) * 0.1
+    field = 1.0 + np.cos(lat) * np.cos(lon + 0.1 * time_step) + noise
+    return np.where(land, field, vos.MV).astype(np.float32)
+
+def timeStamps(axis, time_steps):
+    if axis == 'daily':
+        return [datetime.datetime(2000,1,1) + datetime.timedelta(days = i) for i in range(time_steps)]
+    # the last days of months
+    return [datetime.datetime(2000 + (i + 1) // 12, (i + 1) % 12 + 1, 1) - datetime.timedelta(days = 1) for i in range(time_steps)]
+
+def makeInput(fileName, grid, axis):
+    # a netCDF input file (written per time step and per band of rows, to limit the memory use)
+    rootgrp = nc.Dataset(fileName, 'w', format = "NETCDF4")
+    rootgrp.createDimension('time', None)
+    rootgrp.createDimension('lat', grid['rows'])
+    rootgrp.createDimension('lon', grid['cols'])
+    date_time = rootgrp.createVariable('time', 'f8', ('time',))
+    date_time.units = 'days since 1901-01-01' ; date_time.calendar = 'standard'
+    rootgrp.createVariable('lat', 'f8', ('lat',))[:] = latitudesOf(grid)
+    rootgrp.createVariable('lon', 'f8', ('lon',))[:] = longitudesOf(grid)
+    var = rootgrp.createVariable(variable_name, 'f4', ('time','lat','lon'), fill_value = vos.MV, zlib = True, complevel = 1,
+                                 chunksizes = (1, min(grid['rows'], 256), min(grid['cols'], 1024)))
+    time_stamps = timeStamps(axis, grid['time_steps'][axis])
+    date_time[:] = nc.date2num(time_stamps, date_time.units, date_time.calendar)
+    for i in range(len(time_stamps)):
+        for rowStart in range(0, grid['rows'], 2048):
+            rowEnd = min(rowStart + 2048, grid['rows'])
+            var[i, rowStart:rowEnd, :] = syntheticField(grid, i, rowStart, rowEnd)
+    rootgrp.close()
+    return time_stamps
+
+def timed(function, *arguments):
+    start_time = time.time()
+    result = function(*arguments)
+    return result, time.time() - start_time
+
+def compare(result, reference):
+    # whether result and reference are the same (allowing rounding differences) and the largest difference
+    result = np.asarray(result, dtype = np.float64) ; reference = np.asarray(reference, dtype = np.float64)
+    if result.shape != reference.shape: return False, None
+    equal = np.isclose(result, reference, rtol = 1e-6, atol = 1e-6) | (np.isnan(result) & np.isnan(reference))
+    difference = np.abs(np.where(np.isfinite(result) & np.isfinite(reference), result - reference, 0.0))
+    return bool(equal.all()), float(difference.max()) if difference.size > 0 else 0.0
+
+def runResolution(resolution, work_folder, results):
+
+    grid = gridOf(resolution)
+    factor = grid['factor']
+    cells = grid['rows'] * grid['cols']
+    print("Resolution "+resolution+": "+str(grid['rows'])+" x "+str(grid['cols'])+" cells")
+
+    # the window (input rows and columns) of the legacy loops
+    window = (legacy_rows * factor, min(grid['cols'], 4 * legacy_rows * factor))
+
+    def addResult(axis, stage, seconds, calls = 1, equivalent = None, max_difference = None, legacy_seconds = None):
+        if legacy_seconds != None: legacy_seconds = legacy_seconds * cells / float(window[0] * window[1])
+        result = {'resolution': resolution, 'time_axis': axis, 'stage': stage, 'seconds': seconds / calls, 'calls': calls,
+                  'cells': cells, 'mega_cells_per_second': cells / 1e6 / max(seconds / calls, 1e-9),
+                  'equivalent': equivalent, 'max_difference': max_difference, 'legacy_seconds': legacy_seconds}
+        results.append(result)
+        print("  %-8s %-22s %10.4f s %10.1f Mcells/s   equivalent: %-5s %s" % (axis, stage, result['seconds'], result['mega_cells_per_second'],
+                                                                               equivalent, "" if legacy_seconds == None else "(legacy: %.4f s)" % legacy_seconds))
+
+    # cell area map (also the clone map)
+    cell_area_file = os.path.join(work_folder, "cell_area_"+resolution+".map")
+    writeMap(cell_area_file, cellArea(grid), grid['cellsize'], grid['xUL'], grid['yUL'])
+
+    for axis in ['monthly', 'daily']:
+
+        input_file = os.path.join(work_folder, "input_"+resolution+"_"+axis+".nc")
+        time_stamps = makeInput(input_file, grid, axis)
+
+        # reading (numpy), checked against the netCDF values
+        start_time = time.time()
+        for time_stamp in time_stamps:
+            values = vos.netcdf2NumpyClone(input_file, variable_name, str(time_stamp.date()), cloneMapFileName = cell_area_file)
+        seconds = time.time() - start_time
+        rootgrp = nc.Dataset(input_file)
+        equivalent, max_difference = compare(values, np.ma.filled(rootgrp.variables[variable_name][len(time_stamps) - 1], vos.MV))
+        rootgrp.close()
+        addResult(axis, "read_numpy", seconds, len(time_stamps), equivalent, max_difference)
+
+        # reading (PCRaster)
+        if pcraster_available:
+            pcr.setclone(grid['rows'], grid['cols'], grid['cellsize'], grid['xUL'], grid['yUL'])
+            start_time = time.time()
+            for time_stamp in time_stamps:
+                pcr_values = vos.netcdf2PCRobjClone(input_file, variable_name, str(time_stamp.date()), cloneMapFileName = cell_area_file)
+            seconds = time.time() - start_time
+            equivalent, max_difference = compare(pcr.pcr2numpy(pcr_values, vos.MV), values)
+            addResult(axis, "read_pcraster", seconds, len(time_stamps), equivalent, max_difference)
+            pcr_values = None
+        else:
+            print("  %-8s %-22s skipped (PCRaster is not available)" % (axis, "read_pcraster"))
+        vos.closeNetcdfFiles()
+
+        # writing (at the input resolution)
+        output_netcdf = {'cellsize': grid['cellsize'], 'rows': grid['rows'], 'cols': grid['cols'], 'xUL': grid['xUL'], 'yUL': grid['yUL'],
+                         'format': "NETCDF4", 'zlib': True, 'netcdf_attribute': {}}
+        for attribute in ['institution', 'title', 'source', 'history', 'references', 'description', 'comment']:
+            output_netcdf['netcdf_attribute'][attribute] = "run_benchmarks.py"
+        output_file = os.path.join(work_folder, "output_"+resolution+"_"+axis+".nc")
+        output = OutputNetcdf(output_netcdf)
+        output.createNetCDF(output_file, variable_name, "-")
+        start_time = time.time()
+        for time_stamp in time_stamps: output.data2NetCDF(output_file, variable_name, values, time_stamp)
+        output.close(output_file)
+        addResult(axis, "write", time.time() - start_time, len(time_stamps))
+        os.remove(output_file) ; os.remove(input_file)
+
+    # the stages on fields (the values of the last time step)
+    axis = "field"
+
+    # refining (from the output resolution)
+    coarse = values[::factor, ::factor].copy()
+    fine, seconds = timed(vos.regridData2FinerGrid, factor, coarse, vos.MV)
+    legacy_fine, legacy_seconds = timed(legacy.regridData2FinerGrid, factor, coarse[:legacy_rows], vos.MV)
+    equivalent, max_difference = compare(fine[:legacy_rows * factor], legacy_fine)
+    addResult(axis, "regrid_finer", seconds, 1, equivalent, max_difference, legacy_seconds)
+    fine = None ; legacy_fine = None
+
+    # area-weighted upscaling
+    cell_area = csfMap.readMap(cell_area_file, vos.MV)
+    upscaling, setup_seconds = timed(AreaWeightedUpscaling, cell_area, factor)
+    addResult(axis, "upscaling_setup", setup_seconds)
+    upscaled, seconds = timed(upscaling.upscale, values)
+    equivalent = max_difference = legacy_seconds = None
+    if pcraster_available:
+        window_grid = {'rows': window[0], 'cols': window[1], 'cellsize': grid['cellsize'], 'xUL': grid['xUL'], 'yUL': grid['yUL']}
+        reference, legacy_seconds = timed(legacy.areaWeightedUpscaling, values[:window[0], :window[1]], cell_area[:window[0], :window[1]],
+                                          factor, window_grid)
+        equivalent, max_difference = compare(upscaled[:legacy_rows, :window[1] // factor], reference)
+    addResult(axis, "upscaling", seconds, 1, equivalent, max_difference, legacy_seconds)
+    upscaling = None ; cell_area = None
+
+    # regridToCoarse (every mode)
+    for mode in regrid_modes:
+        coarse, seconds = timed(vos.regridToCoarse, values, factor, mode, vos.MV)
+        reference, legacy_seconds = timed(legacy.regridToCoarse, values[:window[0], :window[1]], factor, mode, vos.MV)
+        equivalent, max_difference = compare(coarse[:legacy_rows, :window[1] // factor], reference)
+        addResult(axis, "regrid_coarse_"+mode, seconds, 1, equivalent, max_difference, legacy_seconds)
+
+    os.remove(cell_area_file)
+
+def gitVersion():
+    # the git commit of the repository (None if it is not known)
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd = os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compareResults(old_file, new_file):
+    # prints the times of both result files per stage, with the ratio (old / new: > 1 is faster)
+    old = json.load(open(old_file)) ; new = json.load(open(new_file))
+    print("old: "+str(old['version'])+" ("+str(old['date'])+"); new: "+str(new['version'])+" ("+str(new['date'])+")")
+    print("%-14s %-8s %-22s %12s %12s %8s %s" % ("resolution", "axis", "stage", "old (s)", "new (s)", "ratio", "equivalent"))
+    old_results = dict([((r['resolution'], r['time_axis'], r['stage']), r) for r in old['results']])
+    for r in new['results']:
+        key = (r['resolution'], r['time_axis'], r['stage'])
+        if key not in old_results: continue
+        ratio = old_results[key]['seconds'] / max(r['seconds'], 1e-12)
+        print("%-14s %-8s %-22s %12.4f %12.4f %8.2f %s" % (key + (old_results[key]['seconds'], r['seconds'], ratio, r['equivalent'])))
+
+def main():
+
+    if len(sys.argv) > 1 and sys.argv[1] == "compare": return compareResults(sys.argv[2], sys.argv[3])
+
+    results_file = sys.argv[1] if len(sys.argv) > 1 else "benchmark_results.json"
+    resolution_list = (sys.argv[2] if len(sys.argv) > 2 else "30min,5min,30sec").split(",")
+    work_folder = sys.argv[3] if len(sys.argv) > 3 else tempfile.mkdtemp(prefix = "netcdf_resample_benchmarks_")
+    if not os.path.exists(work_folder): os.makedirs(work_folder)
+
+    results = []
+    try:
+        for resolution in resolution_list: runResolution(resolution, work_folder, results)
+    finally:
+        if len(sys.argv) <= 3: shutil.rmtree(work_folder)
+
+    output = {'version': gitVersion(), 'date': datetime.datetime.now().isoformat(), 'python': platform.python_version(),
+              'numpy': np.__version__, 'netCDF4': nc.__version__, 'pcraster': pcraster_available, 'results': results}
+    with open(results_file, 'w') as json_file: json.dump(output, json_file, indent = 1, sort_keys = True)
+    print("Results: "+str(results_file))
+
+    not_equivalent = [r['resolution']+"/"+r['stage'] for r in results if r['equivalent'] == False]
+    if len(not_equivalent) > 0:
+        print("Not equivalent to the legacy implementation: "+", ".join(not_equivalent))
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
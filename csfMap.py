@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Reading PCRaster (CSF 2.0) maps (headers and values) in-process, without 
+# the mapattr utility (and without PCRaster). Headers are cached by file path, 
+# size and modification time, so repeated lookups (e.g. clone checks in every 
+# time step) do not read the file again.
+#
+# CSF 2.0 layout (offsets in bytes):
+# - main header  : signature (0), version (32), gis file id (34), projection (38),
+#                  attribute table (40), data type (44), byte order (46)
+# - raster header: value scale (64), cell representation (66), minimum (68), maximum (76),
+#                  xUL (84), yUL (92), rows (100), cols (104), cell size x (108),
+#                  cell size y (116), angle (124)
+# - data         : from offset 256 (row-wise, from the upper left corner)
+
+import os
+import struct
+
+import numpy as np
+
+csfSignature  = b"RUU CROSS SYSTEM MAP FORMAT"
+csfDataOffset = 256
+
+# cell representations: numpy type names
+cellRepresentations = {0x00: 'u1', 0x04: 'i1', 0x11: 'u2', 0x15: 'i2',
+                       0x22: 'u4', 0x26: 'i4', 0x5A: 'f4', 0xDB: 'f8'}
+
+# value scales
+valueScales = {0xE0: 'boolean', 0xE2: 'nominal', 0xF2: 'ordinal',
+               0xEB: 'scalar' , 0xFB: 'directional', 0xF0: 'ldd'}
+
+# the header cache: file path -> (size, modification time, header)
+headerCache = dict()
+
+def readHeader(mapFileName):
+    #
+    # Returns the header of a PCRaster map as a dictionary with 'rows', 'cols' (int),
+    # 'cellsize', 'cellsizeY', 'xUL', 'yUL', 'angle' (float), 'projection', 'value_scale',
+    # 'cell_representation' (numpy type name) and 'byte_order' ('<' or '>').
+    # An IOError is raised if the file does not exist or is not a CSF 2.0 map.
+    path = os.path.abspath(mapFileName)
+    stat = os.stat(path)
+    if path in headerCache.keys() and headerCache[path][:2] == (stat.st_size, stat.st_mtime):
+        return headerCache[path][2]
+
+    with open(path, 'rb') as mapFile: header_bytes = mapFile.read(csfDataOffset)
+    if len(header_bytes) < csfDataOffset or not header_bytes.startswith(csfSignature):
+        raise IOError("Not a PCRaster (CSF 2.0) map: "+str(mapFileName))
+
+    # the byte order field is 1 in the byte order of the file
+    byte_order = '<' if struct.unpack('<I', header_bytes[46:50])[0] == 1 else '>'
+
+    projection, = struct.unpack(byte_order + 'H', header_bytes[38:40])
+    value_scale, cell_representation = struct.unpack(byte_order + 'HH', header_bytes[64:68])
+    xUL, yUL = struct.unpack(byte_order + 'dd', header_bytes[84:100])
+    rows, cols = struct.unpack(byte_order + 'II', header_bytes[100:108])
+    cellsize, cellsizeY, angle = struct.unpack(byte_order + 'ddd', header_bytes[108:132])
+
+    header = {'rows'               : int(rows),
+              'cols'               : int(cols),
+              'cellsize'           : cellsize,
+              'cellsizeY'          : cellsizeY,
+              'xUL'                : xUL,
+              'yUL'                : yUL,
+              'angle'              : angle,
+              'projection'         : projection,
+              'value_scale'        : valueScales.get(value_scale, value_scale),
+              'cell_representation': cellRepresentations.get(cell_representation, cell_representation),
+              'byte_order'         : byte_order}
+    headerCache[path] = (stat.st_size, stat.st_mtime, header)
+    return header
+
+# missing values of integer cell representations (for real cell representations, missing values are NaN)
+missingValues = {'u1': 255, 'i1': -128, 'u2': 65535, 'i2': -32768, 'u4': 4294967295, 'i4': -2147483648}
+
+def readMap(mapFileName, missingValue = 1e20, rowStart = 0, rowEnd = None, colStart = 0, colEnd = None):
+    #
+    # Returns the values of a PCRaster map in a float64 array (rows, cols), in which missing values 
+    # are set to missingValue. The map is read with a memory map (without PCRaster); if rowStart 
+    # and/or rowEnd (colStart and/or colEnd) are given, only the rows rowStart, ..., rowEnd - 1 
+    # (the columns colStart, ..., colEnd - 1) are read.
+    header = readHeader(mapFileName)
+    if header['cell_representation'] not in cellRepresentations.values():
+        raise IOError("Unknown cell representation in: "+str(mapFileName))
+    data = np.memmap(os.path.abspath(mapFileName), dtype = header['byte_order'] + header['cell_representation'], mode = 'r',
+                     offset = csfDataOffset, shape = (header['rows'], header['cols']))
+    data = data[rowStart:rowEnd, colStart:colEnd]
+    values = np.array(data, dtype = np.float64)
+    if header['cell_representation'] in missingValues.keys():
+        values[data == missingValues[header['cell_representation']]] = missingValue
+    else:
+        values[np.isnan(values)] = missingValue
+    del data
+    return values
@@ -3,6 +3,9 @@
 
 import time
 import datetime
+import logging
+
+logger = logging.getLogger(__name__)
 
 class ModelTime(object):
 
@@ -95,7 +98,7 @@ class ModelTime(object):
         self._timeStepPCR = timeStepPCR
         self._currTime = self._startTime + datetime.timedelta(days=1 * (timeStepPCR - 1))
         self._fulldate = str(self.currTime.strftime('%Y-%m-%d'))
-        print(self._fulldate)
+        logger.debug(self._fulldate)
         if self._spinUpStatus == True : 
             print("Spin-Up "+str(self._noSpinUp)+" of "+str(self._maxSpinUps))
 
@@ -143,5 +146,4 @@ class ModelTime(object):
         return self.isLastDayOfYear()
     
     def __str__(self):
-        print self._currTime
         return str(self._currTime)
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# A bounded pool of open netCDF files (netCDF4.Dataset objects), shared by the readers of virtualOS and
+# the writers of OutputNetcdf, so that files are opened only once (instead of once per time step) and
+# the number of open files is limited (multi-file jobs do not run out of file descriptors):
+#
+#     with datasetPool.pool.dataset(ncFile) as f:               # reading ('r')
+#         ...
+#     with datasetPool.pool.dataset(ncFile, 'a') as rootgrp:    # appending ('a')
+#         ...
+#
+# - If more than max_open_files files are open, the least recently used ones are closed (except the
+#   ones that are in use); they are opened again when they are needed again.
+# - A file that is open for appending is also used for reading (it has the values that are written);
+#   a file that is open for reading is opened again for appending when that is needed.
+# - A file is used by only one thread at a time (the others wait until it is no longer used); the
+#   bookkeeping of the pool is protected by a lock, so the pool can be used by multiple threads.
+# - Before starting (forking) other processes, all files should be closed (closeAll), as HDF5 files
+#   that are open while forking cannot be opened again by the new processes; new processes that are
+#   started anyway forget (but do not close) the files of the parent process (forget).
+
+import os
+import threading
+import logging
+import collections
+
+import netCDF4 as nc
+
+logger = logging.getLogger(__name__)
+
+class PooledDataset(object):
+
+    # an open file of the pool: the dataset, its mode, the number of its users and its lock 
+    # (with the thread that holds it and the depth of its nested uses by that thread)
+
+    def __init__(self, dataset, mode):
+        self.dataset = dataset
+        self.mode = mode
+        self.users = 0
+        self.lock = threading.RLock()
+        self.owner = None
+        self.depth = 0
+
+class DatasetUse(object):
+
+    # the use of a file of the pool (a context manager; see DatasetPool.dataset)
+
+    def __init__(self, pool, fileName, mode):
+        self.pool = pool
+        self.fileName = fileName
+        self.mode = mode
+
+    def __enter__(self):
+        self.entry = self.pool.acquire(self.fileName, self.mode)
+        return self.entry.dataset
+
+    def __exit__(self, *exception):
+        self.pool.release(self.entry)
+        return False
+
+class DatasetPool(object):
+
+    def __init__(self, maxOpenFiles = 64):
+        object.__init__(self)
+
+        self.max_open_files = maxOpenFiles
+
+        # file path -> PooledDataset (in the order of use: the least recently used first)
+        self.datasets = collections.OrderedDict()
+        self.lock = threading.RLock()
+
+    def setMaxOpenFiles(self, maxOpenFiles):
+        with self.lock:
+            self.max_open_files = maxOpenFiles
+            self.evict()
+
+    def dataset(self, fileName, mode = 'r'):
+        # the (open) file fileName for reading ('r') or appending ('a'), for a with statement
+        if mode not in ['r', 'a']: raise ValueError("The dataset pool only opens files for reading ('r') or appending ('a'): "+str(mode))
+        return DatasetUse(self, fileName, mode)
+
+    def acquire(self, fileName, mode = 'r'):
+
+        # opens fileName (if needed) and marks it as in use; the file is used by one thread at a time
+        path = os.path.abspath(fileName)
+        while True:
+            with self.lock:
+                entry = self.datasets.pop(path, None)
+                if entry != None and mode == 'a' and entry.mode == 'r':
+                    if entry.owner == threading.current_thread().ident:
+                        self.datasets[path] = entry
+                        raise IOError("The netcdf file "+str(fileName)+" cannot be opened for appending while this thread reads it.")
+                    if entry.users == 0:
+                        # opened again for appending
+                        entry.dataset.close()
+                        entry = None
+                if entry == None:
+                    entry = PooledDataset(nc.Dataset(path, mode), mode)
+                    logger.debug("New: "+str(fileName))
+                else:
+                    logger.debug("Cached: "+str(fileName))
+                self.datasets[path] = entry
+                entry.users += 1
+                self.evict()
+            entry.lock.acquire()
+            entry.owner = threading.current_thread().ident ; entry.depth += 1
+            if mode == 'r' or entry.mode == 'a': return entry
+            # the file was in use (for reading) by another thread: it is opened again for appending
+            self.release(entry)
+
+    def release(self, entry):
+        entry.depth -= 1
+        if entry.depth == 0: entry.owner = None
+        entry.lock.release()
+        with self.lock:
+            entry.users -= 1
+            self.evict()
+
+    def evict(self):
+        # closes the least recently used files (that are not in use) while there are too many open files
+        with self.lock:
+            for path in list(self.datasets.keys()):
+                if len(self.datasets) <= self.max_open_files: break
+                if self.datasets[path].users == 0:
+                    self.datasets.pop(path).dataset.close()
+                    logger.debug("Closed: "+str(path))
+
+    def isOpen(self, fileName):
+        with self.lock:
+            return os.path.abspath(fileName) in self.datasets.keys()
+
+    def close(self, fileName):
+        # closes fileName (if it is open); it should not be in use
+        with self.lock:
+            entry = self.datasets.pop(os.path.abspath(fileName), None)
+            if entry != None: entry.dataset.close()
+
+    def closeAll(self):
+        with self.lock:
+            while len(self.datasets) > 0: self.datasets.popitem(last = False)[1].dataset.close()
+
+    def forget(self):
+        # forgets (without closing) all files, e.g. the files of the parent process in a new (forked) process
+        with self.lock:
+            self.datasets.clear()
+
+# the pool of this process (used by virtualOS and OutputNetcdf)
+pool = DatasetPool()
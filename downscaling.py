@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import copy
+
+import numpy as np
+
+import virtualOS as vos
+
+class Downscaling(object):
+
+    # Downscaling of fields (numpy arrays) from a source grid to a finer
+    # target grid. Grids are dictionaries with 'xUL', 'yUL', 'cellsize',
+    # 'rows' and 'cols' (as in RemapPlan). Methods:
+    #
+    # - "nearest" : every target cell gets the value of the source cell at
+    #               its center; for aligned grids (see isAligned), this is a
+    #               block replication (vos.regridData2FinerGrid).
+    # - "bilinear": bilinear interpolation between the centers of the four
+    #               nearest source cells; missing source values are left out
+    #               (the weights of the others are scaled up), and the outer
+    #               source cells are used beyond the outer cell centers.
+    # - "area"    : area-weighted (mass-preserving); for aligned grids, every
+    #               target cell lies within one source cell, and this is the
+    #               same as "nearest" (for other grids, use a RemapPlan).
+    #
+    # Missing values are equal to missValue (as given by the netcdf readers).
+
+    def __init__(self, source_grid, target_grid, method = "nearest", missValue = vos.MV):
+        object.__init__(self)
+
+        self.method = method
+        self.missValue = missValue
+        self.source_grid = source_grid
+        self.target_grid = target_grid
+        self.source_shape = (int(source_grid['rows']), int(source_grid['cols']))
+        self.target_shape = (int(target_grid['rows']), int(target_grid['cols']))
+
+        if self.method not in ["nearest", "bilinear", "area"]:
+            raise ValueError("Unknown downscaling method: "+str(self.method))
+        if self.method == "area" and not isAligned(source_grid, target_grid):
+            raise ValueError("Area-weighted downscaling between grids that are not aligned requires a remapping plan.")
+
+        # block replication
+        self.replication_factor = None
+        if self.method in ["nearest", "area"] and isAligned(source_grid, target_grid):
+            self.replication_factor = int(round(float(source_grid['cellsize']) / float(target_grid['cellsize'])))
+
+        # the (fractional) source rows and columns at the centers of target cells
+        rows = (float(source_grid['yUL']) - float(target_grid['yUL']) + float(target_grid['cellsize']) * (np.arange(self.target_shape[0]) + 0.5))\
+               / float(source_grid['cellsize'])
+        cols = (float(target_grid['xUL']) - float(source_grid['xUL']) + float(target_grid['cellsize']) * (np.arange(self.target_shape[1]) + 0.5))\
+               / float(source_grid['cellsize'])
+
+        if self.method == "nearest":
+            self.rows = np.clip(np.floor(rows).astype(np.int64), 0, self.source_shape[0] - 1)
+            self.cols = np.clip(np.floor(cols).astype(np.int64), 0, self.source_shape[1] - 1)
+            self.inside = ((rows >= 0) & (rows < self.source_shape[0]))[:,None] & ((cols >= 0) & (cols < self.source_shape[1]))[None,:]
+
+        if self.method == "bilinear":
+            # the two neighbouring source cell centers and their weights, in both directions
+            self.row_neighbours = neighbours(rows - 0.5, self.source_shape[0])
+            self.col_neighbours = neighbours(cols - 0.5, self.source_shape[1])
+
+    def getTile(self, rowStart, rowEnd, colStart = 0, colEnd = None):
+
+        # Returns the downscaling of the target rows rowStart, ..., rowEnd - 1 and columns colStart, ..., colEnd - 1 
+        # (a latitude band or a tile) with the (first and last + 1) source rows and columns that are needed for them.
+        # For block replication, rowStart and colStart must be multiples of the replication factor.
+        if colEnd == None: colEnd = self.target_shape[1]
+        tile = copy.copy(self)
+        tile.target_shape = (rowEnd - rowStart, colEnd - colStart)
+        if self.replication_factor != None:
+            sourceRowStart = rowStart // self.replication_factor
+            sourceRowEnd   = int(np.ceil(rowEnd / float(self.replication_factor)))
+            sourceColStart = colStart // self.replication_factor
+            sourceColEnd   = int(np.ceil(colEnd / float(self.replication_factor)))
+        if self.method == "nearest" and self.replication_factor == None:
+            sourceRowStart = int(self.rows[rowStart:rowEnd].min())
+            sourceRowEnd   = int(self.rows[rowStart:rowEnd].max()) + 1
+            sourceColStart = int(self.cols[colStart:colEnd].min())
+            sourceColEnd   = int(self.cols[colStart:colEnd].max()) + 1
+            tile.rows   = self.rows[rowStart:rowEnd] - sourceRowStart
+            tile.cols   = self.cols[colStart:colEnd] - sourceColStart
+            tile.inside = self.inside[rowStart:rowEnd, colStart:colEnd]
+        if self.method == "bilinear":
+            sourceRowStart = int(self.row_neighbours[0][0][rowStart:rowEnd].min())
+            sourceRowEnd   = int(self.row_neighbours[1][0][rowStart:rowEnd].max()) + 1
+            sourceColStart = int(self.col_neighbours[0][0][colStart:colEnd].min())
+            sourceColEnd   = int(self.col_neighbours[1][0][colStart:colEnd].max()) + 1
+            tile.row_neighbours = [(rows[rowStart:rowEnd] - sourceRowStart, weights[rowStart:rowEnd]) for rows, weights in self.row_neighbours]
+            tile.col_neighbours = [(cols[colStart:colEnd] - sourceColStart, weights[colStart:colEnd]) for cols, weights in self.col_neighbours]
+        tile.source_shape = (sourceRowEnd - sourceRowStart, sourceColEnd - sourceColStart)
+        return tile, sourceRowStart, sourceRowEnd, sourceColStart, sourceColEnd
+
+    def downscale(self, source):
+
+        # source: a field (rows, cols) or a stack of fields (..., rows, cols) on the source grid
+        source = np.ma.filled(source, self.missValue)
+
+        if self.replication_factor != None:
+            return vos.regridData2FinerGrid(self.replication_factor, source, self.missValue)
+
+        if self.method == "nearest":
+            target = source[..., self.rows[:,None], self.cols[None,:]]
+            target[..., ~self.inside] = self.missValue
+            return target
+
+        # bilinear: the interpolation is separable (first between columns, then between rows); 
+        # missing values get zero weights, and the weights of the others are scaled up
+        dtype = np.result_type(source.dtype, np.float32)
+        available = source != self.missValue
+        target = self.interpolate(np.where(available, source, 0.0).astype(dtype))
+        total_weight = self.interpolate(available.astype(dtype))
+        available = None
+        return np.where(total_weight > 0.0, target / np.maximum(total_weight, vos.smallNumber), self.missValue).astype(dtype)
+
+    def interpolate(self, values):
+
+        # bilinear interpolation of (..., rows, cols) values (without missing values)
+        (lower, lower_weight), (upper, upper_weight) = self.col_neighbours
+        values = values[..., lower] * lower_weight.astype(values.dtype) + values[..., upper] * upper_weight.astype(values.dtype)
+        (lower, lower_weight), (upper, upper_weight) = self.row_neighbours
+        return values[..., lower, :] * lower_weight.astype(values.dtype)[:,None] + values[..., upper, :] * upper_weight.astype(values.dtype)[:,None]
+
+def neighbours(position, number):
+    # the lower and upper neighbours (indices, clipped to 0 ... number - 1) of fractional positions, with their weights
+    lower = np.floor(position)
+    upper_weight = position - lower
+    lower = lower.astype(np.int64)
+    return [(np.clip(lower, 0, number - 1), 1.0 - upper_weight), (np.clip(lower + 1, 0, number - 1), upper_weight)]
+
+def isAligned(source_grid, target_grid):
+    # whether every target cell lies within one source cell, with an integer ratio of cell sizes
+    # and the same number of target cells in every source cell (the same origin and extent)
+    factor = float(source_grid['cellsize']) / float(target_grid['cellsize'])
+    if abs(factor - round(factor)) > 1e-6: return False
+    factor = int(round(factor))
+    return abs(float(source_grid['xUL']) - float(target_grid['xUL'])) < 1e-6 * float(target_grid['cellsize']) and\
+           abs(float(source_grid['yUL']) - float(target_grid['yUL'])) < 1e-6 * float(target_grid['cellsize']) and\
+           int(target_grid['rows']) == factor * int(source_grid['rows']) and\
+           int(target_grid['cols']) == factor * int(source_grid['cols'])
@@ -2,15 +2,34 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
 import sys
 import datetime
 import calendar
+import time
+import threading
+import multiprocessing
+import logging
+import collections
 
+import numpy as np
 import pcraster as pcr
 from pcraster.framework import DynamicModel
 
 from outputNetcdf import OutputNetcdf
+from upscaling import AreaWeightedUpscaling
+from downscaling import Downscaling, isAligned
+from remapPlan import getRemapPlan
+from prefetch import Prefetcher
+# the incremental mode (see 0_netcdf_resample.py) is shared with the engine without PCRaster (streaming.resampleNetcdf)
+from streaming import getTimeStepsToAppend
 import virtualOS as vos
+import csfMap
+import warping
+import instrumentation
+import datasetPool
+
+logger = logging.getLogger(__name__)
 
 class ResampleFramework(DynamicModel):
 
@@ -25,6 +44,9 @@ class ResampleFramework(DynamicModel):
         self.tmpDir = tmpDir
         self.modelTime = modelTime
 
+        # lock for netcdf reading and writing (needed if input is read ahead by a thread)
+        self.netcdf_lock = threading.RLock()
+
         # a dictionary contains input clone properties (based on the input netcdf file)
         self.input_clone = vos.netcdfCloneAttributes(self.input_netcdf['file_name'],\
                                                      round(self.input_netcdf['cell_resolution']*60.),\
@@ -34,30 +56,27 @@ class ResampleFramework(DynamicModel):
         self.resample_factor = self.output_netcdf["cell_resolution"]/\
                                 self.input_netcdf['cell_resolution']
         
+        # output clone properties (the origin, rows and cols may also be given in output_netcdf)
+        self.output_netcdf['cellsize'] = self.output_netcdf["cell_resolution"]
+        if 'rows' not in self.output_netcdf.keys(): 
+            self.output_netcdf['rows'] = int(round(float(self.input_clone['rows'])/float(self.resample_factor))) 
+        if 'cols' not in self.output_netcdf.keys(): 
+            self.output_netcdf['cols'] = int(round(float(self.input_clone['cols'])/float(self.resample_factor)))
+        if 'xUL' not in self.output_netcdf.keys(): self.output_netcdf['xUL'] = self.input_clone['xUL']
+        if 'yUL' not in self.output_netcdf.keys(): self.output_netcdf['yUL'] = self.input_clone['yUL']
+
         # clone map 
         if self.resample_factor > 1.0: # upscaling
 
-            # the resample factor must be a rounded value without decimal
-            self.resample_factor = round(self.resample_factor)
-            
-            # output clone properties
-            self.output_netcdf['rows'    ] = int(round(float(self.input_clone['rows'])/float(self.resample_factor))) 
-            self.output_netcdf['cols'    ] = int(round(float(self.input_clone['cols'])/float(self.resample_factor)))
-            self.output_netcdf['cellsize'] = self.output_netcdf["cell_resolution"]
-            self.output_netcdf['xUL'     ] = self.input_clone['xUL']
-            self.output_netcdf['yUL'     ] = self.input_clone['yUL']
-
-            # get the unique ids for the output resolution
-            # - use the clone for the output resolution (only for a temporary purpose)
-            pcr.setclone(self.output_netcdf['rows'    ],
-                         self.output_netcdf['cols'    ],
-                         self.output_netcdf['cellsize'],
-                         self.output_netcdf['xUL'     ],
-                         self.output_netcdf['yUL'     ])
-            # - unique_ids in a numpy object
-            cell_unique_ids = pcr.pcr2numpy(pcr.scalar(pcr.uniqueid(pcr.boolean(1.))),vos.MV)
+            # upscaling per block requires a resample factor without decimal and the same origin (upper left corner);
+            # otherwise, or if a folder for remapping plans is given, a remapping plan (with sparse weights) is used
+            self.use_remap_plan = abs(self.resample_factor - round(self.resample_factor)) > 1e-6 or\
+                                  self.output_netcdf['xUL'] != self.input_clone['xUL'] or\
+                                  self.output_netcdf['yUL'] != self.input_clone['yUL'] or\
+                                  'remap_plan_folder' in self.output_netcdf.keys()
+            if not self.use_remap_plan: self.resample_factor = round(self.resample_factor)
 
-            # the remaining pcraster calculations are performed at the input resolution
+            # all pcraster calculations are performed at the input resolution
             pcr.setclone(self.input_clone['rows'    ],
                          self.input_clone['cols'    ],
                          self.input_clone['cellsize'],
@@ -67,15 +86,21 @@ class ResampleFramework(DynamicModel):
             # clone map file 
             self.clone_map_file = self.input_netcdf['clone_file']
             
-            # cell unique ids in a pcraster object
-            self.unique_ids = pcr.nominal(pcr.numpy2pcr(pcr.Scalar,
-                              vos.regridData2FinerGrid(self.resample_factor,cell_unique_ids, vos.MV), vos.MV))
-
-            # cell area (m2)
-            self.cell_area = vos.readPCRmapClone(\
-                             self.input_netcdf["cell_area"],\
-                             self.clone_map_file,\
-                             self.tmpDir)
+            if self.use_remap_plan:
+
+                # remapping plan; it is saved and reused by the next runs (with the same grids and cell area file)
+                if 'remap_plan_folder' in self.output_netcdf.keys():
+                    plan_folder = self.output_netcdf['remap_plan_folder']
+                else:
+                    plan_folder = os.path.join(os.path.dirname(os.path.abspath(self.output_netcdf['file_name'])), "remap_plans")
+                self.upscaling = getRemapPlan(self.input_clone, self.output_netcdf, self.input_netcdf["cell_area"],\
+                                              self.readCellArea, plan_folder)
+            
+            else:
+            
+                # area-weighted upscaling (using numpy arrays; the total cell area of every output cell is calculated only once);
+                # it is prepared when it is first used (see prepareUpscaling), as the tiled mode uses the cell area per tile
+                self.upscaling = None
             
         else: # downscaling / resampling to smaller cell length
 
@@ -86,67 +111,587 @@ class ResampleFramework(DynamicModel):
                          self.output_netcdf['xUL'     ],
                          self.output_netcdf['yUL'     ])
 
-            # clone map file
-            self.clone_map_file = self.output_netcdf['clone_file']
+            # clone map file (of the input, which is read at its own resolution)
+            self.clone_map_file = self.input_netcdf['clone_file']
+
+            # downscaling method: "nearest" (default), "bilinear" or "area" (area-weighted, mass-preserving)
+            self.downscaling_method = "nearest"
+            if 'downscaling_method' in self.output_netcdf.keys(): self.downscaling_method = self.output_netcdf['downscaling_method']
+
+            # area-weighted downscaling to grids that are not aligned with the input grid uses a remapping plan (see upscaling)
+            self.use_remap_plan = self.downscaling_method == "area" and not isAligned(self.input_clone, self.output_netcdf)
+            if self.use_remap_plan:
+                if 'remap_plan_folder' in self.output_netcdf.keys():
+                    plan_folder = self.output_netcdf['remap_plan_folder']
+                else:
+                    plan_folder = os.path.join(os.path.dirname(os.path.abspath(self.output_netcdf['file_name'])), "remap_plans")
+                self.downscaling = getRemapPlan(self.input_clone, self.output_netcdf, self.input_netcdf["cell_area"],\
+                                                self.readCellArea, plan_folder)
+            else:
+                self.downscaling = Downscaling(self.input_clone, self.output_netcdf, self.downscaling_method)
         
+        # the resampling of the last tile of the tiled mode, with its rows and columns (see readAndResampleTile)
+        self.tile_resampling = (None, None)
+
         # an object for netcdf reporting
         self.output = OutputNetcdf(self.output_netcdf)       
         
-        # preparing the netcdf file at coarse resolution:
-        self.output.createNetCDF(self.output_netcdf['file_name'],
-                                 self.output_netcdf['variable_name'],
-                                 self.output_netcdf['variable_unit'])
+        # resuming (optional): an existing output file (with the same grid and variable) is continued after its 
+        # last complete time step (see resumeTimeSteps); otherwise, a new output file is made
+        self.resume = 'resume' in self.output_netcdf.keys() and self.output_netcdf['resume'] == True
+        if self.resume and os.path.isfile(self.output_netcdf['file_name']):
+            print("Resuming the output file: "+str(self.output_netcdf['file_name']))
+        else:
+            # preparing the netcdf file at coarse resolution:
+            self.output.createNetCDF(self.output_netcdf['file_name'],
+                                     self.output_netcdf['variable_name'],
+                                     self.output_netcdf['variable_unit'])
         
+    def readCellArea(self):
+
+        # cell area (m2) in a numpy array; if needed, it is warped to the clone (and cached in warp_cache_folder)
+        warp_cache_folder = None
+        if 'warp_cache_folder' in self.input_netcdf.keys(): warp_cache_folder = self.input_netcdf['warp_cache_folder']
+        cell_area = vos.readPCRmapClone(\
+                    self.input_netcdf["cell_area"],\
+                    self.clone_map_file,\
+                    self.tmpDir,\
+                    warpCacheFolder = warp_cache_folder)
+        return pcr.pcr2numpy(cell_area, vos.MV)
+
+    def readCellAreaTile(self, rowStart, rowEnd, colStart = 0, colEnd = None):
+
+        # cell area (m2) of the rows rowStart, ..., rowEnd - 1 and columns colStart, ..., colEnd - 1 of the clone 
+        # (for the tiled mode), without reading the whole map in memory; a cell area map with another grid is 
+        # warped once and read from the warp cache 
+        cell_area = str(self.input_netcdf["cell_area"])
+        if re.match(r"[0-9.-]*$", cell_area):
+            if colEnd == None: colEnd = vos.getMapAttributes(self.clone_map_file, "cols")
+            return np.full((rowEnd - rowStart, colEnd - colStart), float(cell_area))
+        if vos.isSameClone(cell_area, self.clone_map_file):
+            return csfMap.readMap(cell_area, vos.MV, rowStart, rowEnd, colStart, colEnd)
+        warp_cache_folder = os.path.join(str(self.tmpDir), "warp_cache")
+        if 'warp_cache_folder' in self.input_netcdf.keys(): warp_cache_folder = self.input_netcdf['warp_cache_folder']
+        warped = warping.getWarpedMap(cell_area, self.clone_map_file, "nearest", warp_cache_folder, vos.MV, mmapMode = 'r')
+        return np.array(warped[rowStart:rowEnd, colStart:colEnd])
+
+    def prepareUpscaling(self):
+
+        # the area-weighted upscaling of whole fields (with the cell area of the whole clone)
+        if self.resample_factor > 1.0 and not self.use_remap_plan and self.upscaling == None:
+            self.upscaling = AreaWeightedUpscaling(self.readCellArea(), self.resample_factor)
+
+    def resumeTimeSteps(self, timeSteps, outputs):
+
+        # Returns the (index, date) time steps that are not written yet and the output position of the first one. 
+        # Without resume, these are all time steps (written from position 0 of the new output files). With resume, 
+        # these are the time steps after the last complete time step of the output files (outputs: output file names 
+        # with their variable names); records after it (e.g. a partial final record) are written again.
+        if not self.resume: return timeSteps, 0
+        position = None ; last_time_stamp = None ; last_file = None
+        for output_file, variable_names in outputs:
+            number, time_stamp = self.output.getCompleteTimeSteps(output_file, variable_names)
+            if position == None or number < position: position, last_time_stamp, last_file = number, time_stamp, output_file
+        if position == 0: return timeSteps, 0
+        remaining_time_steps = self.output.getTimeStepsAfter(last_file, timeSteps, position)
+        print("Resuming after "+str(last_time_stamp)+" ("+str(position)+" complete time steps in the output): "+\
+              str(len(remaining_time_steps))+" time steps remain")
+        return remaining_time_steps, position
+
+    def startStatistics(self, numberOfTimeSteps):
+
+        # the instrumentation of a run (see instrumentation.RunStatistics): progress messages (at most every 
+        # progress_interval seconds) and, if a profile_file is given in output_netcdf, a profile of the run
+        progress_interval = 10.0
+        if 'progress_interval' in self.output_netcdf.keys(): progress_interval = float(self.output_netcdf['progress_interval'])
+        profile_file = None
+        if 'profile_file' in self.output_netcdf.keys(): profile_file = self.output_netcdf['profile_file']
+        self.statistics = instrumentation.RunStatistics(numberOfTimeSteps, progress_interval, profile_file).start()
+
     def initial(self): 
-        pass
+
+        self.startStatistics(self.modelTime.nrOfTimeSteps)
+
+        # resume: the time steps up to the last complete one of the output file are skipped
+        self.output_position = 0 ; self.last_written_time_stamp = None
+        if self.resume:
+            self.output_position, self.last_written_time_stamp = self.output.getCompleteTimeSteps(self.output_netcdf['file_name'],\
+                                                                                                  [self.output_netcdf['variable_name']])
 
     def dynamic(self):
         
         # update model time using the current pcraster timestep value
         self.modelTime.update(self.currentTimeStep())
 
+        # time stamp 
+        timeStamp = datetime.datetime(self.modelTime.year,\
+                                      self.modelTime.month,\
+                                      self.modelTime.day,0)
+
         # reading
-        if self.modelTime.isLastDayOfMonth():
-            input_value = vos.netcdf2PCRobjClone(ncFile  = self.input_netcdf['file_name'],
-                                                 varName = self.input_netcdf['variable_name'],
-                                                 dateInput = str(self.modelTime.fulldate),
-                                                 useDoy = None,
-                                                 cloneMapFileName = self.clone_map_file)
+        if self.last_written_time_stamp != None and timeStamp <= self.last_written_time_stamp:
+            logger.debug("Already written for this date: "+str(self.modelTime))
+            data_available = False 
+
+        elif self.modelTime.isLastDayOfMonth():
+            input_value = vos.netcdf2NumpyClone(ncFile  = self.input_netcdf['file_name'],
+                                                varName = self.input_netcdf['variable_name'],
+                                                dateInput = str(self.modelTime.fulldate),
+                                                useDoy = None,
+                                                cloneMapFileName = self.clone_map_file)
             data_available = True  
         
         else:
-            print "No values are available for this date: "+str(self.modelTime)
+            logger.debug("No values are available for this date: "+str(self.modelTime))
             data_available = False 
         
-        if data_available: output_value = input_value
+        if data_available:
+
+            # resampling
+            output_value = self.resample(input_value)
+
+            # reporting
+            self.report(output_value, timeStamp, self.output_position)
+            self.output_position += 1
+
+        # progress (every day is a time step)
+        self.statistics.progress(1, timeStamp)
+
+        # closing the file at the end of
+        if self.modelTime.isLastTimeStep(): 
+            self.output.close(self.output_netcdf['file_name'])
+            self.statistics.finish()
+
+    def resample(self, input_value):
+
+        output_value = input_value
+
+        # upscaling (area-weighted, using cell area)
+        if self.resample_factor > 1.0:
+            with instrumentation.stage("upscale"):
+                if self.use_remap_plan:
+                    output_value = self.upscaling.remap(input_value)
+                else:
+                    self.prepareUpscaling()
+                    output_value = self.upscaling.upscale(input_value)
+
+        # downscaling (nearest, bilinear or area-weighted)
+        if self.resample_factor < 1.0:
+            with instrumentation.stage("downscale"):
+                if self.use_remap_plan:
+                    output_value = self.downscaling.remap(input_value)
+                else:
+                    output_value = self.downscaling.downscale(input_value)
+
+        return output_value
+
+    def report(self, output_value, timeStamp, posCnt = None):
+
+        # write to netcdf 
+        self.output.data2NetCDF(self.output_netcdf['file_name'],\
+                                self.output_netcdf['variable_name'],\
+                                output_value,\
+                                timeStamp,\
+                                posCnt)
+
+    def reportBlock(self, output_values, timeStamps, posCnt = None):
+
+        # write a block of time steps to netcdf (in one hyperslab)
+        self.output.dataBlock2NetCDF(self.output_netcdf['file_name'],\
+                                     self.output_netcdf['variable_name'],\
+                                     output_values,\
+                                     timeStamps,\
+                                     posCnt)
+
+    def getBlockSize(self, memoryBudget):
+
+        # the number of time steps that can be processed at once within memoryBudget (MB);
+        # about 32 bytes are needed per input cell (reading, masking and resampling) and
+        # about 24 bytes per output cell (resampling and writing)
+        bytes_per_time_step = 32. * self.input_clone['rows'] * self.input_clone['cols'] +\
+                              24. * self.output_netcdf['rows'] * self.output_netcdf['cols']
+        return max(1, int(memoryBudget * 1024. * 1024. / bytes_per_time_step))
+
+    def getReadArguments(self, blocks):
+
+        # arguments of vos.netcdf2NumpyCloneBlock for every block (one hyperslab read per block)
+        return [(self.input_netcdf['file_name'], self.input_netcdf['variable_name'],\
+                 block[0][0], block[-1][0] + 1, self.clone_map_file) for block in blocks]
+
+    def readBlocks(self, blocks, prefetchDepth = 0, prefetchMode = "process"):
 
-        # upscaling
-        if data_available and self.resample_factor > 1.0:
+        # input values of every block; with prefetchDepth > 0, the next (at most prefetchDepth) 
+        # blocks are read ahead (by a thread or a process) 
+        argument_list = self.getReadArguments(blocks)
+        if prefetchDepth > 0:
+            # - a reader process opens its own netcdf files (instead of using the ones of this process);
+            # - a reader thread shares the netcdf files of this process (it must not forget the open files)
+            if prefetchMode == "thread":
+                return Prefetcher(vos.netcdf2NumpyCloneBlock, argument_list, prefetchDepth, prefetchMode, lock = self.netcdf_lock)
+            vos.closeNetcdfFiles()
+            return Prefetcher(vos.netcdf2NumpyCloneBlock, argument_list, prefetchDepth, prefetchMode,\
+                              initializer = datasetPool.pool.forget)
+        return (vos.netcdf2NumpyCloneBlock(*arguments) for arguments in argument_list)
+
+    def runOverInputTimeSteps(self, startDate, endDate, blockSize = 1, memoryBudget = None, prefetchDepth = 0, prefetchMode = "process",\
+                                    numberOfWorkers = 1):
+
+        # Run without DynamicFramework: only the time steps of the input netcdf file 
+        # that are between startDate and endDate (YYYY-MM-DD) are read and resampled.
+        # - blockSize      : the number of time steps that are read, resampled and written at once,
+        # - memoryBudget   : if given, the block size is derived from this memory budget (MB),
+        # - prefetchDepth  : the number of blocks that are read ahead while resampling (0: no read-ahead),
+        # - prefetchMode   : "process" or "thread" (the reader of the read-ahead),
+        # - numberOfWorkers: the number of processes that read and resample blocks in parallel; the 
+        #                    blocks are still written (by this process) in the order of time, so the 
+        #                    output is the same as with one worker (there is no read-ahead with workers); at most 
+        #                    2 x numberOfWorkers blocks are resampled (or waiting to be written) at a time.
+        time_steps = vos.getNetcdfTimeSteps(self.input_netcdf['file_name'], startDate, endDate)
+        print("Number of input time steps between "+str(startDate)+" and "+str(endDate)+": "+str(len(time_steps)))
+        time_steps, position = self.resumeTimeSteps(time_steps, [(self.output_netcdf['file_name'], [self.output_netcdf['variable_name']])])
+
+        if memoryBudget != None: blockSize = self.getBlockSize(memoryBudget)
+        print("Number of time steps per block: "+str(blockSize)+"; read-ahead depth: "+str(prefetchDepth)+"; workers: "+str(numberOfWorkers))
+        blocks = vos.getTimeStepBlocks(time_steps, blockSize)
+
+        self.startStatistics(len(time_steps))
+        pool = None ; input_blocks = None
+        self.prepareUpscaling()
+        if numberOfWorkers > 1:
+            # the worker processes read and resample blocks (with their own netcdf files)
+            vos.closeNetcdfFiles()
+            pool = multiprocessing.Pool(numberOfWorkers, initializeWorker, (self.resample,))
+            output_iterator = boundedImap(pool, readAndResampleBlock, self.getReadArguments(blocks), 2 * numberOfWorkers)
+        else:
+            input_blocks = self.readBlocks(blocks, prefetchDepth, prefetchMode)
+            output_iterator = (self.resample(input_values) for input_values in input_blocks)
+        try:
+            for block in blocks:
+
+                # reading and resampling (all time steps at once), or waiting for the workers/read-ahead
+                with instrumentation.stage("wait"): output_values = next(output_iterator)
+
+                # reporting
+                with self.netcdf_lock: self.reportBlock(output_values, [timeStamp for idx, timeStamp in block], position)
+                position += len(block)
+                self.statistics.progress(len(block), block[-1][1])
+            
+            if pool != None: pool.close()
+        finally:
+            if isinstance(input_blocks, Prefetcher): input_blocks.close()
+            if pool != None:
+                pool.terminate()
+                pool.join()
+
+        # closing the file at the end
+        self.output.close(self.output_netcdf['file_name'])
+
+        # throughput and stages
+        self.statistics.finish()
+
+    def getTileRows(self, memoryBudget, blockSize = 1, tileCols = None):
+
+        # the number of output rows per tile that can be processed within memoryBudget (MB) for blocks 
+        # of blockSize time steps (with the bytes per cell of getBlockSize) and tileCols output columns
+        if tileCols == None: tileCols = self.output_netcdf['cols']
+        bytes_per_output_row = blockSize * (32. * self.input_clone['rows'] * self.input_clone['cols'] +\
+                                            24. * self.output_netcdf['rows'] * self.output_netcdf['cols']) / self.output_netcdf['rows'] *\
+                                            min(1., float(tileCols) / self.output_netcdf['cols'])
+        return max(1, int(memoryBudget * 1024. * 1024. / bytes_per_output_row))
+
+    def getTiles(self, tileRows, tileCols = None):
+
+        # the tiles of the output (latitude bands if tileCols is not given): dictionaries with the (first and last + 1) 
+        # output rows and columns ('rows', 'cols') and the input rows and columns (of the clone map) that are needed for 
+        # them ('input_rows', 'input_cols'); the resampling of a tile is prepared when it is used (see getTileResampling); 
+        # tiles are aligned with the resample factor (upscaling) or with the replication factor (block replication of 
+        # downscaling)
+        if self.use_remap_plan:
+            raise ValueError("The tiled mode does not support remapping plans (non-integer resample factors or other output origins).")
+        output_rows = int(self.output_netcdf['rows'])
+        output_cols = int(self.output_netcdf['cols'])
+        if tileCols == None: tileCols = output_cols
+        if self.resample_factor < 1.0 and self.downscaling.replication_factor != None:
+            factor = self.downscaling.replication_factor
+            tileRows = int(np.ceil(tileRows / float(factor))) * factor
+            tileCols = int(np.ceil(tileCols / float(factor))) * factor
+        tiles = []
+        for rowStart in range(0, output_rows, tileRows):
+            for colStart in range(0, output_cols, tileCols):
+                tile = {'rows': (rowStart, min(rowStart + tileRows, output_rows)),
+                        'cols': (colStart, min(colStart + tileCols, output_cols))}
+                if self.resample_factor > 1.0:
+                    # upscaling: every output cell covers resample_factor x resample_factor input cells
+                    factor = int(self.resample_factor)
+                    tile['input_rows'] = (tile['rows'][0] * factor, tile['rows'][1] * factor)
+                    tile['input_cols'] = (tile['cols'][0] * factor, tile['cols'][1] * factor)
+                else:
+                    downscaling = self.downscaling.getTile(tile['rows'][0], tile['rows'][1], tile['cols'][0], tile['cols'][1])
+                    tile['input_rows'] = downscaling[1:3]
+                    tile['input_cols'] = downscaling[3:5]
+                tiles.append(tile)
+        return tiles
+
+    def getTileResampling(self, tile):
+
+        # the upscaling (with the cell area of the tile) or the downscaling of a tile
+        if self.resample_factor > 1.0:
+            return AreaWeightedUpscaling(self.readCellAreaTile(tile['input_rows'][0], tile['input_rows'][1],\
+                                                               tile['input_cols'][0], tile['input_cols'][1]), int(self.resample_factor))
+        return self.downscaling.getTile(tile['rows'][0], tile['rows'][1], tile['cols'][0], tile['cols'][1])[0]
+
+    def getTilesWithCellArea(self, tiles):
+
+        # The indices of the tiles that are read and resampled: for upscaling, only the tiles with cell areas (read tile 
+        # by tile). The cell area does not change in time, so the other tiles (e.g. ocean tiles of a land cell area map) 
+        # are not scheduled for any block; tiles without input values in a block are skipped after reading (see 
+        # readAndResampleTile).
+        if self.resample_factor <= 1.0: return list(range(len(tiles)))
+        tiles_with_cell_area = []
+        for i in range(len(tiles)):
+            cell_area = self.readCellAreaTile(tiles[i]['input_rows'][0], tiles[i]['input_rows'][1],\
+                                              tiles[i]['input_cols'][0], tiles[i]['input_cols'][1])
+            if not np.isclose(np.ma.filled(cell_area, vos.MV), vos.MV).all(): tiles_with_cell_area.append(i)
+        return tiles_with_cell_area
+
+    def readAndResampleTile(self, readArguments, tile):
+
+        # reading (only the input rows and columns of a tile) and resampling; None if all input values are 
+        # missing (e.g. ocean tiles): then the output values of the tile are missing as well. The resampling
+        # of the last tile is kept (as tile_resampling), so it is prepared only once for all blocks of a tile.
+        input_values = vos.netcdf2NumpyCloneBlock(*readArguments,\
+                                                  rowStart = tile['input_rows'][0], rowEnd = tile['input_rows'][1],\
+                                                  colStart = tile['input_cols'][0], colEnd = tile['input_cols'][1])
+        if not np.any(input_values != vos.MV): return None
+        key = (tile['rows'], tile['cols'])
+        if self.tile_resampling[0] != key:
+            self.tile_resampling = (None, None)
+            self.tile_resampling = (key, self.getTileResampling(tile))
+        resampling = self.tile_resampling[1]
+        if self.resample_factor > 1.0:
+            with instrumentation.stage("upscale"):
+                return resampling.upscale(input_values)
+        with instrumentation.stage("downscale"):
+            return resampling.downscale(input_values)
+
+    def runTiled(self, startDate, endDate, blockSize = 1, memoryBudget = None, tileRows = None, tileCols = None, numberOfWorkers = 1):
+
+        # Tiled (out-of-core) mode for large grids (e.g. 30 arc-second inputs): as runOverInputTimeSteps, but every 
+        # block of time steps is read, resampled and written per tile (tileRows x tileCols output cells; latitude bands 
+        # if tileCols is not given), so the memory use depends on the tile size instead of the grid size. Tiles are 
+        # processed one after the other (all blocks of a tile), so the resampling of a tile is prepared only once; the 
+        # time steps are complete (see resumeTimeSteps) after the last tile.
+        # - blockSize      : the number of time steps that are read, resampled and written at once,
+        # - memoryBudget   : if given (and tileRows is not), the tile size is derived from this memory budget (MB; 
+        #                    shared by the workers),
+        # - tileRows       : the number of output rows per tile (default: all rows, or derived from memoryBudget),
+        # - tileCols       : the number of output columns per tile (default: all columns),
+        # - numberOfWorkers: the number of processes that read and resample the blocks of the tiles in parallel (this
+        #                    process writes every tile in its part of the output variable). 
+        # Tiles without input values (e.g. ocean tiles) are not resampled and not written (their values are missing); 
+        # tiles without cell areas are not read either (see getTilesWithCellArea).
+        time_steps = vos.getNetcdfTimeSteps(self.input_netcdf['file_name'], startDate, endDate)
+        print("Number of input time steps between "+str(startDate)+" and "+str(endDate)+": "+str(len(time_steps)))
+        time_steps, position = self.resumeTimeSteps(time_steps, [(self.output_netcdf['file_name'], [self.output_netcdf['variable_name']])])
+
+        if tileRows == None:
+            tileRows = self.output_netcdf['rows']
+            if memoryBudget != None: tileRows = self.getTileRows(memoryBudget / float(numberOfWorkers), blockSize, tileCols)
+        tiles = self.getTiles(int(tileRows), tileCols)
+        print("Number of time steps per block: "+str(blockSize)+"; number of tiles: "+str(len(tiles))+" (at most "+\
+              str(max([tile['rows'][1] - tile['rows'][0] for tile in tiles]))+" x "+\
+              str(max([tile['cols'][1] - tile['cols'][0] for tile in tiles]))+" output cells per tile)")
+
+        # the tiles that are read and resampled (for every block)
+        active_tiles = self.getTilesWithCellArea(tiles)
+        print("Tiles with cell areas: "+str(len(active_tiles))+" of "+str(len(tiles)))
+
+        # the time steps of all blocks are written first; the values of every block are written per tile
+        blocks = vos.getTimeStepBlocks(time_steps, blockSize)
+        read_arguments = self.getReadArguments(blocks)
+        self.output.markComplete(self.output_netcdf['file_name'], position)
+        positions = []
+        for block in blocks:
+            positions.append(position)
+            self.output.dataTile2NetCDF(self.output_netcdf['file_name'], self.output_netcdf['variable_name'],\
+                                        None, [timeStamp for idx, timeStamp in block], 0, 0, position)
+            position += len(block)
+        tasks = [(i, b) for i in active_tiles for b in range(len(blocks))]
+
+        self.startStatistics(len(time_steps))
+        skipped_tiles = (len(tiles) - len(active_tiles)) * len(blocks)
+        pool = None
+        if numberOfWorkers > 1:
+            # the worker processes read and resample tiles (with their own netcdf files)
+            vos.closeNetcdfFiles()
+            pool = multiprocessing.Pool(numberOfWorkers, initializeTileWorker, (self.readAndResampleTile, tiles))
+        try:
+            # reading and resampling (by the workers: at most 2 blocks per worker at a time, see boundedImap)
+            if pool != None:
+                output_iterator = boundedImap(pool, readAndResampleTile, [(read_arguments[b], i) for i, b in tasks], 2 * numberOfWorkers)
+            else:
+                output_iterator = (self.readAndResampleTile(read_arguments[b], tiles[i]) for i, b in tasks)
+
+            # reporting (in the rows and columns of every tile); the progress is the share of the tiles that are done
+            done = 0
+            for n in range(len(tasks)):
+                i, b = tasks[n]
+                with instrumentation.stage("wait"): output_values = next(output_iterator)
+                if output_values is None:
+                    skipped_tiles += 1
+                else:
+                    self.output.dataTile2NetCDF(self.output_netcdf['file_name'], self.output_netcdf['variable_name'],\
+                                                output_values, [timeStamp for idx, timeStamp in blocks[b]],\
+                                                tiles[i]['rows'][0], tiles[i]['cols'][0], positions[b])
+                if b == len(blocks) - 1:
+                    progress = len(time_steps) * (n + 1) // len(tasks)
+                    self.statistics.progress(progress - done)
+                    done = progress
+            if done < len(time_steps): self.statistics.progress(len(time_steps) - done)
+            self.output.markComplete(self.output_netcdf['file_name'], position)
+
+            if pool != None: pool.close()
+        finally:
+            if pool != None:
+                pool.terminate()
+                pool.join()
+
+        # closing the file at the end
+        self.output.close(self.output_netcdf['file_name'])
+
+        print("Skipped tiles without values: "+str(skipped_tiles)+"; workers: "+str(numberOfWorkers))
+        self.statistics.finish()
+
+    def prepareVariables(self, variableList, singleOutputFile = True, outputFileSuffix = "_resampled"):
+
+        # the variables of the multi-variable mode: the one of input_netcdf/output_netcdf and the ones of variableList 
+        # (items: [input file name, input variable name, output variable name, output variable unit])
+        variables = [{'input_file'     : self.input_netcdf['file_name'],
+                      'input_variable' : self.input_netcdf['variable_name'],
+                      'output_file'    : self.output_netcdf['file_name'],
+                      'output_variable': self.output_netcdf['variable_name']}]
         
-            # upscaling using cell area
-            output_value_in_pcraster = \
-                            vos.getValDivZero(\
-                            pcr.areatotal(output_value*self.cell_area, self.unique_ids),\
-                            pcr.areatotal(self.cell_area, self.unique_ids), vos.smallNumber)
+        for input_file, input_variable, output_variable, variable_unit in variableList:
+            
+            variable = {'input_file': input_file, 'input_variable': input_variable, 'output_variable': output_variable}
             
-            # resample to the output clone resolution 
-            output_value = vos.regridToCoarse(pcr.pcr2numpy(output_value_in_pcraster, vos.MV),
-                                              self.resample_factor, "max", vos.MV)
+            # with resume, existing output files and variables are continued
+            if singleOutputFile:
+                # all variables in the output file of output_netcdf
+                variable['output_file'] = self.output_netcdf['file_name']
+                if not (self.resume and self.output.hasVariable(variable['output_file'], output_variable)):
+                    self.output.addNewVariable(variable['output_file'], output_variable, variable_unit)
+            else:
+                # one output file per input file (in the output folder)
+                output_file_name = os.path.splitext(os.path.basename(input_file))[0] + outputFileSuffix + ".nc"
+                variable['output_file'] = os.path.join(os.path.dirname(os.path.abspath(self.output_netcdf['file_name'])), output_file_name)
+                if not (self.resume and os.path.isfile(variable['output_file'])):
+                    self.output.createNetCDF(variable['output_file'], output_variable, variable_unit)
+            
+            variables.append(variable)
+        
+        return variables
 
-        # reporting
-        if data_available:
+    def runMultipleVariables(self, variableList, startDate, endDate, singleOutputFile = True, outputFileSuffix = "_resampled",\
+                                   blockSize = 1, memoryBudget = None):
 
-            # time stamp 
-            timestepPCR = self.modelTime.timeStepPCR
-            timeStamp = datetime.datetime(self.modelTime.year,\
-                                          self.modelTime.month,\
-                                          self.modelTime.day,0)
-            # write to netcdf 
-            self.output.data2NetCDF(self.output_netcdf['file_name'],\
-                                    self.output_netcdf['variable_name'],\
-                                    output_value,\
-                                    timeStamp)
+        # Multi-variable mode: the variable of input_netcdf and the ones of variableList (see prepareVariables) 
+        # are resampled in one pass over time with the same setup (clone, cell area and upscaling). 
+        # All input files must have the same time steps (between startDate and endDate). The variables are
+        # written in one output file (singleOutputFile = True) or in one output file per input file.
+        variables = self.prepareVariables(variableList, singleOutputFile, outputFileSuffix)
+        print("Number of variables: "+str(len(variables)))
 
-        # closing the file at the end of
-        if self.modelTime.isLastTimeStep(): self.output.close(self.output_netcdf['file_name'])
+        # time steps of every input file
+        for variable in variables:
+            variable['time_steps'] = vos.getNetcdfTimeSteps(variable['input_file'], startDate, endDate)
+            if [date for idx, date in variable['time_steps']] != [date for idx, date in variables[0]['time_steps']]:
+                msg = "The time steps of "+str(variable['input_file'])+" differ from the ones of "+str(variables[0]['input_file'])
+                raise ValueError(msg)
+        time_steps = variables[0]['time_steps']
+        print("Number of input time steps between "+str(startDate)+" and "+str(endDate)+": "+str(len(time_steps)))
+
+        # with resume: the time steps after the last complete one of all output files (the same for all variables)
+        outputs = {}
+        for variable in variables: outputs.setdefault(variable['output_file'], []).append(variable['output_variable'])
+        remaining_time_steps, output_position = self.resumeTimeSteps(time_steps, sorted(outputs.items()))
+        for variable in variables: variable['time_steps'] = variable['time_steps'][len(time_steps) - len(remaining_time_steps):]
+        time_steps = remaining_time_steps
+
+        # the memory budget is shared by all variables
+        if memoryBudget != None: blockSize = max(1, self.getBlockSize(memoryBudget) // len(variables))
+        print("Number of time steps per block: "+str(blockSize))
+
+        self.prepareUpscaling()
+        self.startStatistics(len(time_steps))
+        position = 0
+        for block in vos.getTimeStepBlocks(time_steps, blockSize):
+
+            time_stamps = [timeStamp for idx, timeStamp in block]
+            
+            # reading and resampling all variables (the input files can have different time indices)
+            output_values = []
+            for variable in variables:
+                indices = [idx for idx, timeStamp in variable['time_steps'][position:position+len(block)]]
+                input_values = vos.netcdf2NumpyCloneBlock(variable['input_file'], variable['input_variable'],\
+                                                          indices[0], indices[-1] + 1, self.clone_map_file)
+                output_values.append(self.resample(input_values))
+            position += len(block)
+            
+            # reporting
+            if singleOutputFile:
+                short_var_names = [variable['output_variable'] for variable in variables]
+                for i in range(len(block)):
+                    self.output.dataList2NetCDF(self.output_netcdf['file_name'], short_var_names,\
+                                                dict([(name, values[i]) for name, values in zip(short_var_names, output_values)]),\
+                                                time_stamps[i], output_position + i)
+            else:
+                for variable, values in zip(variables, output_values):
+                    self.output.dataBlock2NetCDF(variable['output_file'], variable['output_variable'], values, time_stamps, output_position)
+            output_position += len(block)
+            self.statistics.progress(len(block), time_stamps[-1])
+
+        # closing the files at the end
+        for output_file in sorted(set([variable['output_file'] for variable in variables])): self.output.close(output_file)
+
+        # throughput (of every variable) and stages
+        self.statistics.finish()
+
+def boundedImap(pool, function, argumentList, window):
+    #
+    # As pool.imap (the results in the order of argumentList), but at most window tasks are submitted to the
+    # pool at a time (running, or finished and not used yet), so that results do not pile up in memory if the 
+    # workers are faster than the consumer (e.g. the writing of the output file).
+    pending = collections.deque()
+    for arguments in argumentList:
+        if len(pending) >= window: yield pending.popleft().get()
+        pending.append(pool.apply_async(function, (arguments,)))
+    while len(pending) > 0: yield pending.popleft().get()
+
+# the resampling function of worker processes (see ResampleFramework.runOverInputTimeSteps)
+worker_resample = None
+
+def initializeWorker(resample):
+    global worker_resample
+    worker_resample = resample
+    # workers open their own netcdf files (and do not record stages)
+    datasetPool.pool.forget()
+    instrumentation.active = None
+
+def readAndResampleBlock(arguments):
+    return worker_resample(vos.netcdf2NumpyCloneBlock(*arguments))
+
+# the tiles and their reading/resampling function in worker processes (see ResampleFramework.runTiled)
+worker_tiles = None
+
+def initializeTileWorker(readAndResample, tiles):
+    global worker_resample, worker_tiles
+    worker_resample = readAndResample
+    worker_tiles = tiles
+    # workers open their own netcdf files (and do not record stages)
+    datasetPool.pool.forget()
+    instrumentation.active = None
 
+def readAndResampleTile(arguments):
+    read_arguments, i = arguments
+    return worker_resample(read_arguments, worker_tiles[i])
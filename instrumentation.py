@@ -0,0 +1,205 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Instrumentation of resampling runs (see ResampleFramework): the wall time, the bytes (of the values that
+# are read or written) and the memory use (RSS) of every stage, rate-limited progress messages with
+# the throughput and the remaining time (ETA), and optionally a profile (cProfile) of the whole run.
+#
+# Stages are timed where the work is done (virtualOS, outputNetcdf, ResampleFramework) with
+#
+#     with instrumentation.stage("read") as read_stage:
+#         ...
+#         read_stage.bytes = values.nbytes
+#
+# which costs (nearly) nothing if no run is instrumented (e.g. in other scripts that use virtualOS).
+# Nested stages are exclusive: e.g. the time of the stage "sync" within the stage "write" is not counted
+# as writing. Stages of worker processes are not recorded; the time that this process waits for them
+# (or for the read-ahead) is recorded as the stage "wait". Stages of other threads (e.g. a read-ahead
+# thread) overlap the stages of the thread that started the run; they are recorded separately (with a *).
+# The memory use of a stage is its largest increase of the current memory use (RSS) of the process, from
+# the start to the end of a call (including nested stages, and, for threads, the memory that other threads
+# allocate in the meantime; only on Linux, where it is read from /proc/self/statm), next to the peak memory 
+# use (RSS) of the whole process at the end of the stage.
+
+import os
+import sys
+import time
+import datetime
+import threading
+import cProfile
+import pstats
+
+try:
+    import resource
+except ImportError:
+    # e.g. on Windows: the peak memory use is not known
+    resource = None
+
+# the stages (in the order of the summary; other stages are added at the end)
+stageNames = ["read", "refine", "upscale", "downscale", "wait", "write", "sync"]
+
+# the instrumented run (a RunStatistics object; None: stages are not recorded)
+active = None
+
+def peakMemory(who = "self"):
+    # the peak memory use (RSS, MB) of this process ("self") or of its finished child processes ("children")
+    if resource == None: return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == "darwin": return maxrss / 1024. / 1024.      # bytes
+    return maxrss / 1024.                                            # kilobytes
+
+# the current memory use is read from /proc/self/statm (in pages)
+statmFile = "/proc/self/statm"
+pageSize = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") and os.path.isfile(statmFile) else None
+
+def currentMemory():
+    # the current memory use (RSS, MB) of this process (None if it is not known)
+    if pageSize == None: return None
+    with open(statmFile) as f: return int(f.read().split()[1]) * pageSize / 1024. / 1024.
+
+def formatDuration(seconds):
+    return str(datetime.timedelta(seconds = int(round(seconds))))
+
+class Stage(object):
+
+    # a timed stage of a run (see stage)
+
+    def __init__(self, statistics, name):
+        self.statistics = statistics
+        self.name = name
+        self.bytes = 0
+
+    def __enter__(self):
+        self.children = 0.0
+        self.statistics.getStack().append(self)
+        self.start_memory = currentMemory()
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, *exception):
+        seconds = time.time() - self.start_time
+        memory_increase = None
+        if self.start_memory != None: memory_increase = currentMemory() - self.start_memory
+        stack = self.statistics.getStack()
+        stack.pop()
+        if len(stack) > 0: stack[-1].children += seconds
+        self.statistics.add(self.name, seconds - self.children, self.bytes, memory_increase)
+        return False
+
+class NoStage(object):
+
+    # a stage that is not recorded (if no run is instrumented)
+
+    bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+noStage = NoStage()
+
+def stage(name):
+    # a context manager that records the wall time (and the bytes, if they are set) of a stage of the active run
+    if active == None: return noStage
+    return Stage(active, name)
+
+class RunStatistics(object):
+
+    # The statistics of a run of numberOfTimeSteps time steps: the stages (see stage) and the progress.
+    # - progressInterval: the minimum number of seconds between progress messages,
+    # - profileFile     : if given, the run is profiled (cProfile) and the profile is saved in this file
+    #                     (it can be read with pstats; the most expensive functions are also printed).
+
+    def __init__(self, numberOfTimeSteps, progressInterval = 10.0, profileFile = None):
+        object.__init__(self)
+
+        self.number_of_time_steps = numberOfTimeSteps
+        self.progress_interval = progressInterval
+        self.profile_file = profileFile
+
+        self.seconds = {} ; self.bytes = {} ; self.calls = {} ; self.peak_memory = {} ; self.memory_increase = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profiler = None
+
+    def getStack(self):
+        # the stages (of this thread) that are being timed
+        if not hasattr(self.local, 'stack'): self.local.stack = []
+        return self.local.stack
+
+    def start(self):
+        global active
+        active = self
+        self.start_time = time.time()
+        self.thread = threading.current_thread().ident
+        self.last_progress_time = self.start_time
+        self.done = 0
+        if self.profile_file != None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def add(self, name, seconds, nbytes = 0, memoryIncrease = None):
+        # stages of other threads than the one that started the run are recorded with a *
+        if threading.current_thread().ident != self.thread: name = name + "*"
+        memory = peakMemory()
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            self.bytes[name]   = self.bytes.get(name, 0) + nbytes
+            self.calls[name]   = self.calls.get(name, 0) + 1
+            if memory != None: self.peak_memory[name] = max(self.peak_memory.get(name, 0.0), memory)
+            if memoryIncrease != None: self.memory_increase[name] = max(self.memory_increase.get(name, 0.0), memoryIncrease)
+
+    def progress(self, numberOfTimeSteps, timeStamp = None):
+
+        # numberOfTimeSteps more time steps are done (up to timeStamp); the progress is printed
+        # at most every progress_interval seconds (and after the last time step)
+        self.done += numberOfTimeSteps
+        now = time.time()
+        if now - self.last_progress_time < self.progress_interval and self.done < self.number_of_time_steps: return
+        self.last_progress_time = now
+        rate = self.done / max(now - self.start_time, 1e-9)
+        msg = "Progress: "+str(self.done)+" of "+str(self.number_of_time_steps)+" time steps"
+        if timeStamp != None: msg += " (up to "+str(timeStamp)+")"
+        msg += "; "+str(round(rate, 2))+" time steps per second"
+        if self.done < self.number_of_time_steps and rate > 0.0:
+            msg += "; ETA: "+formatDuration((self.number_of_time_steps - self.done) / rate)
+        print(msg)
+
+    def finish(self):
+
+        # stops recording and prints the summary (and the profile)
+        global active
+        if active is self: active = None
+        run_time = max(time.time() - self.start_time, 1e-9)
+        if self.profiler != None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_file)
+            print("Profile: "+str(self.profile_file))
+            pstats.Stats(self.profiler, stream = sys.stdout).sort_stats('cumulative').print_stats(20)
+            self.profiler = None
+
+        print("Resampled "+str(self.done)+" time steps in "+str(round(run_time, 2))+" s ("+\
+              str(round(self.done / run_time, 2))+" time steps per second)")
+        print("%-10s %12s %7s %7s %12s %10s %9s %17s %17s" % ("stage", "time (s)", "share", "calls", "MB", "MB/s", "s/step",\
+                                                             "RSS increase (MB)", "process peak (MB)"))
+        names = [name for name in stageNames if name in self.seconds.keys()] +\
+                sorted([name for name in self.seconds.keys() if name not in stageNames and not name.endswith("*")])
+        thread_names = sorted([name for name in self.seconds.keys() if name.endswith("*")])
+        for name in names + ["other"] + thread_names:
+            if name == "other":
+                # the time of this thread that is not in any stage
+                other = run_time - sum([self.seconds[name] for name in names])
+                print("%-10s %12.3f %6.1f%%" % ("other", other, 100. * other / run_time))
+                continue
+            seconds = self.seconds[name] ; megabytes = self.bytes[name] / 1024. / 1024.
+            print("%-10s %12.3f %6.1f%% %7i %12.1f %10s %9.4f %17s %17s" % (name, seconds, 100. * seconds / run_time, self.calls[name], megabytes,
+                  "%.1f" % (megabytes / seconds) if megabytes > 0.0 and seconds > 0.0 else "-", seconds / max(self.done, 1),
+                  "%.1f" % self.memory_increase[name] if name in self.memory_increase.keys() else "-",
+                  "%.1f" % self.peak_memory[name] if name in self.peak_memory.keys() else "-"))
+        if len(thread_names) > 0:
+            print("(*: stages of other threads, e.g. the read-ahead, in parallel with the stages above)")
+        if peakMemory() != None:
+            print("Peak memory use: "+str(round(peakMemory(), 1))+" MB (worker processes: "+str(round(peakMemory("children"), 1))+" MB)")
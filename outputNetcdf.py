@@ -10,9 +10,10 @@ import subprocess
 import netCDF4 as nc
 import numpy as np
 import virtualOS as vos
+import instrumentation
+import datasetPool
 
-# the following dictionary is needed to avoid open and closing files
-filecache = dict()
+# output files are kept open (for appending) in the dataset pool (datasetPool.pool), which is shared with virtualOS
 
 class OutputNetcdf():
     
@@ -33,6 +34,34 @@ class OutputNetcdf():
         self.format = output_netcdf['format']
         self.zlib   = output_netcdf['zlib'] 
         
+        # buffered writing: the number of time steps that are collected before writing (buffer_size), and
+        # the number of written time steps after which the file is synchronized (sync_interval); the buffer 
+        # is always written (and the file synchronized) when the file is closed
+        self.buffer_size   = 1
+        self.sync_interval = 1
+        if 'buffer_size'   in output_netcdf.keys() and output_netcdf['buffer_size']   != None: self.buffer_size   = max(1, int(output_netcdf['buffer_size']))
+        if 'sync_interval' in output_netcdf.keys() and output_netcdf['sync_interval'] != None: self.sync_interval = max(1, int(output_netcdf['sync_interval']))
+        self.buffers = {}
+        self.unsynced_time_steps = {}
+
+        # the number of complete time steps (records) of every file; it is saved in the file (the global attribute 
+        # complete_time_steps) whenever the file is synchronized or closed, so that interrupted runs can be resumed
+        # (see getCompleteTimeSteps)
+        self.complete_time_steps = {}
+
+        # storage options of the variables (see netCDF4.Dataset.createVariable); options that are not given 
+        # keep the netCDF4 defaults; chunksizes can be a tuple (time, lat, lon) or an access pattern: 
+        # "map" (reading whole time steps) or "timeseries" (reading long time series of small areas)
+        self.variable_options = {'zlib': self.zlib}
+        for option in ['complevel', 'shuffle', 'least_significant_digit', 'chunksizes']:
+            if option in output_netcdf.keys() and output_netcdf[option] != None: self.variable_options[option] = output_netcdf[option]
+        if 'chunksizes' in self.variable_options.keys() and self.variable_options['chunksizes'] in ["map", "timeseries"]:
+            chunk_time_steps = None
+            if 'chunk_time_steps' in output_netcdf.keys(): chunk_time_steps = output_netcdf['chunk_time_steps']
+            self.variable_options['chunksizes'] = chooseChunkSizes(self.variable_options['chunksizes'], len(self.latitudes), len(self.longitudes),\
+                                                                   chunk_time_steps)
+            print("Output chunk sizes (time, lat, lon): "+str(self.variable_options['chunksizes']))
+        
         # netcdf attributes
         self.attributeDictionary = {}
         self.attributeDictionary['institution'] = output_netcdf['netcdf_attribute']['institution']
@@ -45,6 +74,7 @@ class OutputNetcdf():
         
     def createNetCDF(self, ncFileName, varName, varUnits, longName=None):
 
+        datasetPool.pool.close(ncFileName)
         rootgrp = nc.Dataset(ncFileName,'w',format= self.format)
 
         #-create dimensions - time is unlimited, others are fixed
@@ -76,103 +106,257 @@ class OutputNetcdf():
         longVarName  = varName
         if longName != None: longVarName = longName
 
-        var = rootgrp.createVariable(shortVarName,'f4',('time','lat','lon',),fill_value=vos.MV,zlib=self.zlib)
+        var = rootgrp.createVariable(shortVarName,'f4',('time','lat','lon',),fill_value=vos.MV,**self.variable_options)
         var.standard_name = varName
         var.long_name = longVarName
         var.units = varUnits
 
         attributeDictionary = self.attributeDictionary
         for k, v in attributeDictionary.items(): setattr(rootgrp,k,v)
+        rootgrp.complete_time_steps = np.int32(0)
 
         rootgrp.sync()
         rootgrp.close()
 
+    def getCompleteTimeSteps(self, ncFileName, shortVarNameList):
+
+        # Returns the number of complete time steps of an existing output file and the time stamp of the last one 
+        # (None if there are none), after checking that the file has the grid of this object and the variables of 
+        # shortVarNameList (otherwise, a ValueError is raised). The time steps after the complete ones (e.g. the 
+        # partial final record of an interrupted run) are not counted; they are written again by a resumed run.
+        # For files without the attribute complete_time_steps, the final record is considered partial if all
+        # values of a variable are missing.
+
+        if datasetPool.pool.isOpen(ncFileName): self.close(ncFileName)
+        with datasetPool.pool.dataset(ncFileName) as rootgrp:
+            msg = None
+            if 'lat' not in rootgrp.variables.keys() or 'lon' not in rootgrp.variables.keys() or\
+               len(rootgrp.variables['lat']) != len(self.latitudes) or len(rootgrp.variables['lon']) != len(self.longitudes) or\
+               not np.allclose(rootgrp.variables['lat'][:], self.latitudes, rtol = 0.0, atol = 1e-4) or\
+               not np.allclose(rootgrp.variables['lon'][:], self.longitudes, rtol = 0.0, atol = 1e-4):
+                msg = "The grid of the existing output file "+str(ncFileName)+" differs from the output grid."
+            for shortVarName in shortVarNameList:
+                if msg == None and (shortVarName not in rootgrp.variables.keys() or\
+                                    rootgrp.variables[shortVarName].dimensions != ('time','lat','lon')):
+                    msg = "The existing output file "+str(ncFileName)+" does not have the (time, lat, lon) variable "+str(shortVarName)+"."
+            if msg != None: raise ValueError(msg)
+
+            times = getCompleteTimes(rootgrp, shortVarNameList)
+            last_time_stamp = None
+            if len(times) > 0: last_time_stamp = nc.num2date(times[-1], rootgrp.variables['time'].units, rootgrp.variables['time'].calendar)
+        return len(times), last_time_stamp
+
+    def getTimeStepsAfter(self, ncFileName, timeSteps, numberOfTimeSteps):
+
+        # Returns the (index, date) time steps of timeSteps that come after the first numberOfTimeSteps (complete) 
+        # time steps of an existing output file. The dates are compared as they would be stored (see getStoredTimes), 
+        # so that the last complete time step (e.g. of an hourly time axis in 'f4') is not written again.
+        if numberOfTimeSteps == 0 or len(timeSteps) == 0: return timeSteps
+        with datasetPool.pool.dataset(ncFileName) as rootgrp:
+            last_time = float(rootgrp.variables['time'][numberOfTimeSteps - 1])
+            times = getStoredTimes(rootgrp, [timeStamp for idx, timeStamp in timeSteps])
+        return [time_step for time_step, time in zip(timeSteps, times) if time > last_time]
+
+    def hasVariable(self, ncFileName, shortVarName):
+
+        # whether the (existing) file has the variable shortVarName
+        with datasetPool.pool.dataset(ncFileName) as rootgrp: return shortVarName in rootgrp.variables.keys()
+
+    def markComplete(self, ncFileName, numberOfTimeSteps):
+
+        # the number of complete time steps of a file that is written per tile (see dataTile2NetCDF); 
+        # it is saved in the file when the file is synchronized or closed
+        self.complete_time_steps[ncFileName] = numberOfTimeSteps
+
     def changeAtrribute(self, ncFileName, attributeDictionary, closeFile = False):
 
-        if ncFileName in filecache.keys():
-            #~ print "Cached: ", ncFileName
-            rootgrp = filecache[ncFileName]
-        else:
-            #~ print "New: ", ncFileName
-            rootgrp = nc.Dataset(ncFileName,'a')
-            filecache[ncFileName] = rootgrp
+        with datasetPool.pool.dataset(ncFileName, 'a') as rootgrp:
+            for k, v in attributeDictionary.items(): setattr(rootgrp,k,v)
+            rootgrp.sync()
+        if closeFile == True: datasetPool.pool.close(ncFileName)
 
-        for k, v in attributeDictionary.items(): setattr(rootgrp,k,v)
+    def addNewVariable(self, ncFileName, varName, varUnits, longName=None, closeFile = False):
 
-        rootgrp.sync()
-        if closeFile == True: rootgrp.close()
+        shortVarName = varName
 
-    def addNewVariable(self, ncFileName, varName, varUnits, longName=None, closeFile = False):
+        with datasetPool.pool.dataset(ncFileName, 'a') as rootgrp:
+            var = rootgrp.createVariable(shortVarName,'f4',('time','lat','lon',) ,fill_value=vos.MV,**self.variable_options)
+            var.standard_name = varName
+            var.long_name = varName
+            var.units = varUnits
+            rootgrp.sync()
+        if closeFile == True: datasetPool.pool.close(ncFileName)
 
-        if ncFileName in filecache.keys():
-            #~ print "Cached: ", ncFileName
-            rootgrp = filecache[ncFileName]
-        else:
-            #~ print "New: ", ncFileName
-            rootgrp = nc.Dataset(ncFileName,'a')
-            filecache[ncFileName] = rootgrp
+    def data2NetCDF(self, ncFileName, shortVarName, varField, timeStamp, posCnt = None, closeFile = False):
 
-        shortVarName = varName
+        self.writeData(ncFileName, {shortVarName: [varField]}, [timeStamp], posCnt, closeFile)
 
-        var = rootgrp.createVariable(shortVarName,'f4',('time','lat','lon',) ,fill_value=vos.MV,zlib=self.zlib)
-        var.standard_name = varName
-        var.long_name = varName
-        var.units = varUnits
+    def dataBlock2NetCDF(self, ncFileName, shortVarName, varFields, timeStamps, posCnt = None, closeFile = False):
 
-        rootgrp.sync()
-        if closeFile == True: rootgrp.close()
+        # writing a block of time steps (varFields: time, lat, lon) in one hyperslab
+        self.writeData(ncFileName, {shortVarName: varFields}, timeStamps, posCnt, closeFile)
 
-    def data2NetCDF(self, ncFileName, shortVarName, varField, timeStamp, posCnt = None, closeFile = False):
+    def dataTile2NetCDF(self, ncFileName, shortVarName, varFields, timeStamps, rowStart, colStart = 0, posCnt = None, closeFile = False):
 
-        if ncFileName in filecache.keys():
-            #~ print "Cached: ", ncFileName
-            rootgrp = filecache[ncFileName]
-        else:
-            #~ print "New: ", ncFileName
-            rootgrp = nc.Dataset(ncFileName,'a')
-            filecache[ncFileName] = rootgrp
+        # writing the rows rowStart, ... and columns colStart, ... of a block of time steps (varFields: time, rows, cols) 
+        # in one hyperslab (a latitude band or a tile); buffered time steps of the file are written first; without
+        # varFields (None), only the time steps are written (the values of the block remain missing)
 
-        date_time = rootgrp.variables['time']
-        if posCnt == None: posCnt = len(date_time)
-        date_time[posCnt] = nc.date2num(timeStamp,date_time.units,date_time.calendar)
+        self.flush(ncFileName)
 
-        rootgrp.variables[shortVarName][posCnt,:,:] = varField
+        with datasetPool.pool.dataset(ncFileName, 'a') as rootgrp:
+            date_time = rootgrp.variables['time']
+            if posCnt == None: posCnt = len(date_time)
+            date_time[posCnt:posCnt+len(timeStamps)] = nc.date2num(list(timeStamps),date_time.units,date_time.calendar)
 
-        rootgrp.sync()
-        if closeFile == True: rootgrp.close()
+            if varFields is not None:
+                with instrumentation.stage("write") as write_stage:
+                    rootgrp.variables[shortVarName][posCnt:posCnt+len(timeStamps),rowStart:rowStart+np.shape(varFields)[-2],\
+                                                                                 colStart:colStart+np.shape(varFields)[-1]] = varFields
+                    write_stage.bytes = np.asarray(varFields).nbytes
+
+        # (partially) written time steps count for the synchronization interval; the block is complete 
+        # after all its tiles are written (see markComplete)
+        self.synchronize(ncFileName, len(timeStamps))
+        if closeFile == True: self.close(ncFileName)
 
     def dataList2NetCDF(self, ncFileName, shortVarNameList, varFieldList, timeStamp, posCnt = None, closeFile = False):
 
-        if ncFileName in filecache.keys():
-            #~ print "Cached: ", ncFileName
-            rootgrp = filecache[ncFileName]
-        else:
-            #~ print "New: ", ncFileName
-            rootgrp = nc.Dataset(ncFileName,'a')
-            filecache[ncFileName] = rootgrp
+        varFieldDictionary = {}
+        for shortVarName in shortVarNameList: varFieldDictionary[shortVarName] = [varFieldList[shortVarName]]
+        self.writeData(ncFileName, varFieldDictionary, [timeStamp], posCnt, closeFile)
 
-        date_time = rootgrp.variables['time']
-        if posCnt == None: posCnt = len(date_time)
+    def writeData(self, ncFileName, varFieldDictionary, timeStamps, posCnt = None, closeFile = False):
 
-        for shortVarName in shortVarNameList:
-            date_time[posCnt] = nc.date2num(timeStamp,date_time.units,date_time.calendar)
-            rootgrp.variables[shortVarName][posCnt,:,:] = varFieldList[shortVarName]
+        # varFieldDictionary: variable name -> fields (one for every time stamp)
+        # The time steps are collected in a buffer that is written (flushed) once it 
+        # has at least buffer_size time steps (and also when the file is closed).
+        # Without buffering (buffer_size 1), the fields are written at once (without copies).
 
-        rootgrp.sync()
-        if closeFile == True: rootgrp.close()
+        buffer = self.buffers.get(ncFileName, [])
 
-    def close(self, ncFileName):
+        # by default, the time steps are appended (after the ones that are still in the buffer)
+        if posCnt == None: 
+            with datasetPool.pool.dataset(ncFileName, 'a') as rootgrp: posCnt = len(rootgrp.variables['time'])
+            if len(buffer) > 0: posCnt = max(posCnt, max([entry[0] for entry in buffer]) + 1)
+
+        if self.buffer_size <= 1 and len(buffer) == 0:
+            # the fields are written as they are (a single field as a (1, lat, lon) view)
+            fields = {}
+            for shortVarName in varFieldDictionary.keys():
+                fields[shortVarName] = varFieldDictionary[shortVarName]
+                if len(timeStamps) == 1: fields[shortVarName] = np.asanyarray(fields[shortVarName][0])[np.newaxis]
+            with datasetPool.pool.dataset(ncFileName, 'a') as rootgrp, instrumentation.stage("write") as write_stage:
+                self.writeRun(rootgrp, ncFileName, posCnt, timeStamps, fields, write_stage)
+            self.synchronize(ncFileName, len(timeStamps))
 
-        if ncFileName in filecache.keys():
-            #~ print "Cached: ", ncFileName
-            rootgrp = filecache[ncFileName]
         else:
-            #~ print "New: ", ncFileName
-            rootgrp = nc.Dataset(ncFileName,'a')
-            filecache[ncFileName] = rootgrp
+            # every buffer entry: position, time stamp and (a copy of) the field of every variable
+            self.buffers[ncFileName] = buffer
+            for i in range(len(timeStamps)):
+                fields = {}
+                for shortVarName in varFieldDictionary.keys(): 
+                    fields[shortVarName] = np.array(np.ma.filled(varFieldDictionary[shortVarName][i], vos.MV))
+                buffer.append((posCnt + i, timeStamps[i], fields))
+            if len(buffer) >= self.buffer_size: self.flush(ncFileName)
+
+        if closeFile == True: self.close(ncFileName)
+
+    def flush(self, ncFileName):
+
+        # writing the buffer: every run of consecutive time steps (with the same variables) is written in one 
+        # hyperslab per variable (including the time values); the file is synchronized every sync_interval time steps
+        buffer = self.buffers.pop(ncFileName, [])
+        if len(buffer) == 0: return
+        
+        buffer.sort(key = lambda entry: entry[0])
+        start = 0
+        with datasetPool.pool.dataset(ncFileName, 'a') as rootgrp, instrumentation.stage("write") as write_stage:
+            for end in range(1, len(buffer) + 1):
+                if end < len(buffer) and buffer[end][0] == buffer[end - 1][0] + 1 and \
+                                         sorted(buffer[end][2].keys()) == sorted(buffer[start][2].keys()): continue
+                run = buffer[start:end]
+                fields = {}
+                for shortVarName in run[0][2].keys(): fields[shortVarName] = np.array([entry[2][shortVarName] for entry in run])
+                self.writeRun(rootgrp, ncFileName, run[0][0], [entry[1] for entry in run], fields, write_stage)
+                start = end
+
+        self.synchronize(ncFileName, len(buffer))
+
+    def writeRun(self, rootgrp, ncFileName, posStart, timeStamps, fields, writeStage):
+
+        # writing consecutive time steps from posStart (fields: variable name -> time, lat, lon values) 
+        # in one hyperslab per variable (including the time values) of the (opened) file rootgrp
+        posEnd = posStart + len(timeStamps)
+        date_time = rootgrp.variables['time']
+        date_time[posStart:posEnd] = nc.date2num(list(timeStamps),date_time.units,date_time.calendar)
+        for shortVarName in fields.keys():
+            values = np.ma.filled(fields[shortVarName], vos.MV)
+            rootgrp.variables[shortVarName][posStart:posEnd,:,:] = values
+            writeStage.bytes += values.nbytes
+        self.complete_time_steps[ncFileName] = max(self.complete_time_steps.get(ncFileName, 0), posEnd)
+
+    def synchronize(self, ncFileName, numberOfTimeSteps):
+
+        # the file is synchronized (with the number of complete time steps) every sync_interval written time steps
+        self.unsynced_time_steps[ncFileName] = self.unsynced_time_steps.get(ncFileName, 0) + numberOfTimeSteps
+        if self.unsynced_time_steps[ncFileName] >= self.sync_interval:
+            with datasetPool.pool.dataset(ncFileName, 'a') as rootgrp, instrumentation.stage("sync"):
+                if ncFileName in self.complete_time_steps.keys(): rootgrp.complete_time_steps = np.int32(self.complete_time_steps[ncFileName])
+                rootgrp.sync()
+            self.unsynced_time_steps[ncFileName] = 0
 
-        # closing the file 
-        rootgrp.close()
+    def close(self, ncFileName):
 
-        # remove ncFilename from filecache
-        if ncFileName in filecache.keys(): filecache.pop(ncFileName, None)
+        # writing the buffer and closing the file (and removing it from the dataset pool)
+        self.flush(ncFileName)
+        with instrumentation.stage("sync"):
+            with datasetPool.pool.dataset(ncFileName, 'a') as rootgrp:
+                if ncFileName in self.complete_time_steps.keys(): rootgrp.complete_time_steps = np.int32(self.complete_time_steps.pop(ncFileName))
+            datasetPool.pool.close(ncFileName)
+        self.unsynced_time_steps.pop(ncFileName, None)
+
+def getCompleteTimes(rootgrp, shortVarNameList):
+    #
+    # Returns the time values of the complete time steps of an (opened) output file: the leading time steps 
+    # with time values, up to the global attribute complete_time_steps (see OutputNetcdf.getCompleteTimeSteps).
+    times = rootgrp.variables['time'][:]
+    number = len(times)
+    if np.ma.getmaskarray(times).any(): number = int(np.argmax(np.ma.getmaskarray(times)))
+    if 'complete_time_steps' in rootgrp.ncattrs():
+        number = min(number, int(rootgrp.complete_time_steps))
+    elif number > 0:
+        for shortVarName in shortVarNameList:
+            if np.ma.getmaskarray(rootgrp.variables[shortVarName][number - 1]).all(): 
+                number = number - 1
+                break
+    return np.ma.filled(times[:number], np.nan).astype(np.float64)
+
+def getStoredTimes(rootgrp, timeStamps):
+    #
+    # Returns the time values of timeStamps as they are stored in the time variable of an (opened) file, i.e. 
+    # rounded to its data type (e.g. 'f4', with a precision of about 0.004 days at 36000 days), so that they can 
+    # be compared exactly with the time values of the file (see getCompleteTimes).
+    date_time = rootgrp.variables['time']
+    times = nc.date2num(list(timeStamps), date_time.units, date_time.calendar)
+    return np.asarray(times).astype(date_time.dtype).astype(np.float64)
+
+def chooseChunkSizes(accessPattern, rows, cols, chunkTimeSteps = None, chunkBytes = 2**20, itemSize = 4):
+    #
+    # Returns the chunk sizes (time, lat, lon) of a (time, lat, lon) variable for an access pattern:
+    # - "map"       : one time step per chunk, with (blocks of) whole rows up to chunkBytes, so that reading 
+    #                 or writing a time step touches as few chunks as possible;
+    # - "timeseries": chunkTimeSteps (default: 120) time steps per chunk with a small square area, so that 
+    #                 reading a time series of a cell touches as few chunks as possible.
+    # Writing is most efficient when output_netcdf['buffer_size'] is a multiple of the time chunk size.
+    cells = max(1, chunkBytes // itemSize)
+    if accessPattern == "map":
+        chunk_cols = min(cols, cells)
+        chunk_rows = max(1, min(rows, cells // chunk_cols))
+        return (1, chunk_rows, chunk_cols)
+    if accessPattern == "timeseries":
+        if chunkTimeSteps == None: chunkTimeSteps = 120
+        chunkTimeSteps = max(1, int(chunkTimeSteps))
+        side = max(1, int((cells // chunkTimeSteps) ** 0.5))
+        return (chunkTimeSteps, min(rows, side), min(cols, side))
+    raise ValueError("Unknown access pattern for chunk sizes: "+str(accessPattern))
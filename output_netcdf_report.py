@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# A small report of the output storage options of OutputNetcdf (chunk sizes, compression and
+# quantization): for every preset, a synthetic field series is written and read again (whole
+# maps and time series of cells), and the file size and throughputs are printed.
+#
+# usage: python output_netcdf_report.py [rows] [cols] [time_steps] [output_folder]
+
+import os
+import sys
+import time
+import datetime
+import shutil
+import tempfile
+
+import numpy as np
+import netCDF4 as nc
+
+from outputNetcdf import OutputNetcdf
+
+presets = [["no compression"             , {'zlib': False}],
+           ["zlib (defaults)"            , {'zlib': True}],
+           ["zlib 1, shuffle"            , {'zlib': True, 'complevel': 1, 'shuffle': True}],
+           ["zlib 4, no shuffle"         , {'zlib': True, 'complevel': 4, 'shuffle': False}],
+           ["zlib, map chunks"           , {'zlib': True, 'chunksizes': "map"}],
+           ["zlib, timeseries chunks"    , {'zlib': True, 'chunksizes': "timeseries"}],
+           ["zlib, map chunks, 3 digits" , {'zlib': True, 'chunksizes': "map", 'least_significant_digit': 3}]]
+
+def syntheticFields(rows, cols, time_steps):
+    # smooth fields with some noise and a missing (ocean) area
+    lat = np.linspace(-1.0, 1.0, rows)[:,None]
+    lon = np.linspace(-1.0, 1.0, cols)[None,:]
+    noise = np.random.RandomState(0).rand(time_steps, rows, cols) * 0.1
+    season = np.sin(2.0 * np.pi * np.arange(time_steps) / 12.0)[:,None,None]
+    fields = (np.cos(3.0 * lat) * np.cos(2.0 * lon) + 0.5 * season + noise).astype(np.float32)
+    return np.ma.masked_array(fields, np.broadcast_to((lat**2 + lon**2) > 0.8, fields.shape))
+
+def main():
+
+    rows       = int(sys.argv[1]) if len(sys.argv) > 1 else 360
+    cols       = int(sys.argv[2]) if len(sys.argv) > 2 else 720
+    time_steps = int(sys.argv[3]) if len(sys.argv) > 3 else 120
+    output_folder = sys.argv[4] if len(sys.argv) > 4 else tempfile.mkdtemp(prefix = "output_netcdf_report_")
+    if not os.path.exists(output_folder): os.makedirs(output_folder)
+
+    fields = syntheticFields(rows, cols, time_steps)
+    time_stamps = [datetime.datetime(2000,1,1) + datetime.timedelta(days = i) for i in range(time_steps)]
+    mega_bytes = fields.size * 4 / 1e6
+
+    output_netcdf = {}
+    output_netcdf['cellsize'] = 180.0 / rows
+    output_netcdf['rows']     = rows
+    output_netcdf['cols']     = cols
+    output_netcdf['xUL']      = -180.0
+    output_netcdf['yUL']      =   90.0
+    output_netcdf['format']   = "NETCDF4"
+    output_netcdf['buffer_size']   = 12
+    output_netcdf['sync_interval'] = time_steps
+    output_netcdf['netcdf_attribute'] = {}
+    for attribute in ['institution', 'title', 'source', 'history', 'references', 'description', 'comment']:
+        output_netcdf['netcdf_attribute'][attribute] = "output_netcdf_report.py"
+
+    print("Fields: "+str(time_steps)+" x "+str(rows)+" x "+str(cols)+" ("+str(round(mega_bytes, 1))+" MB uncompressed)")
+    print("%-28s %-16s %10s %12s %12s %14s %10s" % ("preset", "chunks", "size (MB)", "write MB/s", "maps MB/s", "series (ms)", "max error"))
+
+    for name, options in presets:
+
+        preset = dict(output_netcdf)
+        preset.update(options)
+        file_name = os.path.join(output_folder, name.replace(" ", "_").replace(",", "") + ".nc")
+
+        # writing
+        output = OutputNetcdf(preset)
+        start_time = time.time()
+        output.createNetCDF(file_name, "value", "-")
+        output.dataBlock2NetCDF(file_name, "value", fields, time_stamps)
+        output.close(file_name)
+        write_time = time.time() - start_time
+
+        # reading whole maps
+        dataset = nc.Dataset(file_name)
+        start_time = time.time()
+        for i in range(time_steps): values = dataset.variables['value'][i]
+        map_time = time.time() - start_time
+
+        # reading the time series of 10 cells
+        rs = np.random.RandomState(1)
+        start_time = time.time()
+        for row, col in zip(rs.randint(0, rows, 10), rs.randint(0, cols, 10)): series = dataset.variables['value'][:, row, col]
+        series_time = (time.time() - start_time) / 10.0
+
+        chunks = dataset.variables['value'].chunking()
+        max_error = np.abs(dataset.variables['value'][:] - fields).max()
+        dataset.close()
+
+        print("%-28s %-16s %10.2f %12.1f %12.1f %14.2f %10.2g" % (name, "contiguous" if chunks == "contiguous" else "x".join(map(str, chunks)),
+                                                               os.path.getsize(file_name) / 1e6, mega_bytes / max(write_time, 1e-9),
+                                                               mega_bytes / max(map_time, 1e-9), series_time * 1000.0, max_error))
+
+    if len(sys.argv) <= 4: shutil.rmtree(output_folder)
+
+if __name__ == '__main__':
+    sys.exit(main())
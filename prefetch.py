@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import sys
+import traceback
+import threading
+import multiprocessing
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+class Prefetcher(object):
+
+    # Read-ahead of input data: a reader (a thread or a process) calls
+    # readFunction(*arguments) for every item of argumentList and puts the
+    # results in a bounded queue (with at most 'depth' results), while the
+    # results are used (in the same order) by iterating over the Prefetcher.
+    #
+    # - mode = "thread" : the reader is a thread; as netCDF/HDF5 libraries are
+    #                     usually not thread-safe, a lock can be given that is
+    #                     acquired during every read (the same lock should then
+    #                     be used while writing netcdf files).
+    # - mode = "process": the reader is a process; the results are sent (pickled)
+    #                     through a multiprocessing queue.
+    #
+    # An initializer (e.g. to forget the open files of the parent process) is
+    # called by the reader before reading; a reader thread shares the state of
+    # this process, so such an initializer should only be given for processes.
+    #
+    # An error in the reader is raised again in the consumer. The reader stops
+    # (and is joined) when all results are used, or after close().
+
+    def __init__(self, readFunction, argumentList, depth = 2, mode = "process", lock = None, initializer = None):
+        object.__init__(self)
+
+        self.number_of_items = len(argumentList)
+        self.mode = mode
+
+        if self.mode == "thread":
+            self.queue      = queue.Queue(maxsize = max(1, int(depth)))
+            self.stop_event = threading.Event()
+            self.reader     = threading.Thread(target = readAhead,
+                                               args = (readFunction, argumentList, self.queue, self.stop_event, lock, initializer))
+        else:
+            self.queue      = multiprocessing.Queue(maxsize = max(1, int(depth)))
+            self.stop_event = multiprocessing.Event()
+            self.reader     = multiprocessing.Process(target = readAhead,
+                                                      args = (readFunction, argumentList, self.queue, self.stop_event, None, initializer))
+        self.reader.daemon = True
+        self.reader.start()
+        self.closed = False
+
+    def __iter__(self):
+
+        try:
+            for i in range(self.number_of_items):
+                status, result = self.queue.get()
+                if status == "error":
+                    raise RuntimeError("Error while reading ahead (prefetching):\n" + result)
+                yield result
+        finally:
+            self.close()
+
+    def close(self):
+
+        if self.closed: return
+        self.closed = True
+
+        # stop the reader and empty the queue, so that the reader is never blocked
+        self.stop_event.set()
+        while self.reader.is_alive():
+            try:
+                while True: self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.reader.join(0.1)
+        if self.mode != "thread": self.queue.close()
+
+def readAhead(readFunction, argumentList, outputQueue, stopEvent, lock = None, initializer = None):
+
+    # the reader (thread or process) of the Prefetcher
+    try:
+        if initializer != None: initializer()
+        for arguments in argumentList:
+            if stopEvent.is_set(): return
+            if lock != None:
+                with lock: result = readFunction(*arguments)
+            else:
+                result = readFunction(*arguments)
+            putItem(outputQueue, stopEvent, ("data", result))
+    except Exception:
+        putItem(outputQueue, stopEvent, ("error", "".join(traceback.format_exception(*sys.exc_info()))))
+
+def putItem(outputQueue, stopEvent, item):
+
+    # a blocking put that still stops when stopEvent is set
+    while not stopEvent.is_set():
+        try:
+            outputQueue.put(item, timeout = 0.1)
+            return
+        except queue.Full:
+            pass
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import hashlib
+import json
+
+import numpy as np
+
+import virtualOS as vos
+
+# scipy (sparse matrices) is only imported when a plan is made or used, so that resampling 
+# without remapping plans does not need it
+sparse = vos.LazyModule("scipy.sparse")
+
+# version of the plan file format (part of the plan key)
+planVersion = 1
+
+class RemapPlan(object):
+
+    # Area-weighted remapping between two regular lat/lon grids. A grid is a
+    # dictionary with 'xUL', 'yUL', 'cellsize', 'rows' and 'cols' (as used
+    # in ResampleFramework and OutputNetcdf). The grids may have any (also
+    # non-integer) ratio of cell sizes and any origins.
+    #
+    # The weights are stored in a sparse matrix W (target cells x source cells):
+    #
+    #   W[j,i] = fraction[i,j] * cell_area[i] / sum_k(fraction[k,j] * cell_area[k])
+    #
+    # with fraction[i,j] the fraction of the source cell i that lies in the
+    # target cell j. As in AreaWeightedUpscaling (and the former PCRaster
+    # areatotal calculation), source cells with missing values are counted
+    # in the denominator, targets with a denominator not above smallNumber
+    # get zero, and targets without any source value get MV.
+
+    def __init__(self, source_grid, target_grid, cell_area = None, weights = None):
+        object.__init__(self)
+
+        self.source_grid = gridTuple(source_grid)
+        self.target_grid = gridTuple(target_grid)
+        self.source_shape = (int(source_grid['rows']), int(source_grid['cols']))
+        self.target_shape = (int(target_grid['rows']), int(target_grid['cols']))
+
+        if weights is None: weights = self.calculateWeights(source_grid, target_grid, cell_area)
+        self.weights = weights.tocsr()
+
+        # the coverage matrix has the same (sparsity) structure with ones: it counts the source values in every target cell
+        self.coverage = sparse.csr_matrix((np.ones(len(self.weights.data)), self.weights.indices, self.weights.indptr),
+                                          shape = self.weights.shape)
+
+    def calculateWeights(self, source_grid, target_grid, cell_area):
+
+        # overlap fractions of source cells in target cells; rows (from north) and columns are calculated separately
+        row_fraction = overlapFractions(-float(source_grid['yUL']), float(source_grid['cellsize']), int(source_grid['rows']),
+                                        -float(target_grid['yUL']), float(target_grid['cellsize']), int(target_grid['rows']))
+        col_fraction = overlapFractions( float(source_grid['xUL']), float(source_grid['cellsize']), int(source_grid['cols']),
+                                         float(target_grid['xUL']), float(target_grid['cellsize']), int(target_grid['cols']))
+        fraction = sparse.kron(row_fraction, col_fraction, format = 'coo')
+
+        # source cell areas (m2); without cell areas, all cells are weighted equally
+        if cell_area is None: cell_area = np.ones(self.source_shape)
+        cell_area = np.ma.filled(cell_area, vos.MV).astype(np.float64).ravel()
+        cell_area_available = ~np.isclose(cell_area, vos.MV)
+
+        # cells without cell area values are not used at all
+        used = cell_area_available[fraction.row]
+        source = fraction.row[used]
+        target = fraction.col[used]
+        weight = fraction.data[used] * cell_area[source]
+
+        # denominator: the (overlapping) cell area total of every target cell
+        total_area = np.bincount(target, weights = weight, minlength = fraction.shape[1])
+        weight = np.where(total_area[target] > vos.smallNumber,
+                          weight / np.maximum(vos.smallNumber, total_area[target]), 0.0)
+
+        # zero weights are kept (explicitly), as their cells still count in self.coverage
+        weights = sparse.coo_matrix((weight, (target, source)), shape = (fraction.shape[1], fraction.shape[0]))
+        return weights.tocsr()
+
+    def remap(self, source):
+
+        # source: a field (rows, cols) or a stack of fields (..., rows, cols) on the source grid,
+        #         with missing values equal to MV
+        lead = np.shape(source)[:-2]
+        values = np.ma.filled(source, vos.MV).reshape((-1, self.weights.shape[1])).T
+        available = ~np.isclose(values, vos.MV)
+
+        # one sparse matrix product for all fields
+        target = self.weights.dot(np.where(available, values, 0.0).astype(np.float64))
+        target[self.coverage.dot(available.astype(np.float64)) == 0] = vos.MV
+        return target.T.reshape(lead + self.target_shape)
+
+    def save(self, fileName):
+
+        # the plan is written to a temporary file first, so that (concurrent) runs never read incomplete plans
+        tmpFileName = fileName + ".tmp" + str(os.getpid()) + ".npz"
+        np.savez(tmpFileName,
+                 data    = self.weights.data,
+                 indices = self.weights.indices,
+                 indptr  = self.weights.indptr,
+                 shape   = np.array(self.weights.shape),
+                 grids   = np.array(json.dumps({'source': self.source_grid, 'target': self.target_grid})))
+        os.rename(tmpFileName, fileName)
+
+    @classmethod
+    def load(cls, fileName):
+
+        plan_file = np.load(fileName)
+        grids = json.loads(str(plan_file['grids']))
+        weights = sparse.csr_matrix((plan_file['data'], plan_file['indices'], plan_file['indptr']),
+                                    shape = tuple(plan_file['shape']))
+        plan = cls(gridDictionary(grids['source']), gridDictionary(grids['target']), weights = weights)
+        plan_file.close()
+        return plan
+
+def gridTuple(grid):
+    # grid attributes in a fixed order (rounded to avoid floating point noise in plan keys)
+    return [round(float(grid['xUL']), 10), round(float(grid['yUL']), 10), round(float(grid['cellsize']), 12),
+            int(grid['rows']), int(grid['cols'])]
+
+def gridDictionary(grid_tuple):
+    return {'xUL': grid_tuple[0], 'yUL': grid_tuple[1], 'cellsize': grid_tuple[2],
+            'rows': grid_tuple[3], 'cols': grid_tuple[4]}
+
+def overlapFractions(source_start, source_size, source_number, target_start, target_size, target_number):
+    # fractions of (1D) source intervals within target intervals, in a sparse matrix (source x target)
+    source_lower = source_start + source_size * np.arange(source_number)
+    source_upper = source_lower + source_size
+    # the first target interval of every source interval, and the maximum number of target intervals per source interval
+    first  = np.floor((source_lower - target_start) / target_size).astype(np.int64)
+    number = int(np.ceil(source_size / target_size)) + 1
+    source = np.repeat(np.arange(source_number), number)
+    target = (first[:,None] + np.arange(number)[None,:]).ravel()
+    target_lower = target_start + target_size * target
+    overlap = np.minimum(source_upper[source], target_lower + target_size) - \
+              np.maximum(source_lower[source], target_lower)
+    fraction = overlap / source_size
+    # ignore (numerical) slivers and targets outside the target grid
+    used = (fraction > 1e-9) & (target >= 0) & (target < target_number)
+    return sparse.coo_matrix((fraction[used], (source[used], target[used])), shape = (source_number, target_number))
+
+def cellAreaDefinition(cell_area_file):
+    # the cell area definition that is used in plan keys (a file is identified by its path, size and modification time)
+    if os.path.isfile(str(cell_area_file)):
+        stat = os.stat(cell_area_file)
+        return [os.path.abspath(cell_area_file), stat.st_size, int(stat.st_mtime)]
+    return [str(cell_area_file)]
+
+def remapPlanFileName(planFolder, source_grid, target_grid, cell_area_file):
+    key = json.dumps([planVersion, gridTuple(source_grid), gridTuple(target_grid), cellAreaDefinition(cell_area_file)])
+    return os.path.join(planFolder, "remap_plan_" + hashlib.sha1(key.encode('utf-8')).hexdigest() + ".npz")
+
+def getRemapPlan(source_grid, target_grid, cell_area_file, readCellArea, planFolder):
+    #
+    # Returns the plan from planFolder if it was made before (for the same source grid,
+    # target grid and cell area file). Otherwise, a new plan is made and saved.
+    # - readCellArea: a function that returns the cell areas (numpy array) at the source
+    #                 grid; it is only called if a new plan has to be made.
+    fileName = remapPlanFileName(planFolder, source_grid, target_grid, cell_area_file)
+    if os.path.isfile(fileName):
+        print("Using the remapping plan: "+str(fileName))
+        return RemapPlan.load(fileName)
+
+    print("Making the remapping plan: "+str(fileName))
+    plan = RemapPlan(source_grid, target_grid, readCellArea())
+    vos.makeDir(planFolder)
+    plan.save(fileName)
+    return plan
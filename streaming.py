@@ -0,0 +1,301 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Streaming resampling: a library API (without PCRaster's DynamicFramework and without temporary files)
+# that resamples the fields of a netcdf variable to a target grid, one block of time steps at a time:
+#
+#     target_grid = {'cellsize': 0.5, 'rows': 360, 'cols': 720, 'xUL': -180., 'yUL': 90.}
+#     fields = streaming.resampleFields("input.nc", "total_evaporation", target_grid, cellArea = "cellarea.map")
+#     for timeStamp, values in fields:
+#         ...                                     # e.g. post-processing of every resampled field
+#
+#     # or, writing them (through OutputNetcdf):
+#     streaming.writeFields(fields, "output.nc", "total_evaporation", "m.month-1", target_grid)
+#
+# Grids are dictionaries with 'xUL', 'yUL', 'cellsize', 'rows' and 'cols' (as in RemapPlan and Downscaling).
+# Fields are read lazily (when the consumer asks for the next one) and are only kept until the consumer has
+# used them, so the memory use does not depend on the number of time steps. Missing values are vos.MV.
+#
+# This module only needs numpy and netCDF4 (PCRaster maps are read with csfMap; scipy is only imported for
+# remapping plans and warped maps): resampleNetcdf is the engine of 0_netcdf_resample.py that does not need
+# (nor import) PCRaster, e.g. for a fast startup of small jobs.
+
+import os
+import re
+
+import numpy as np
+import netCDF4 as nc
+
+import virtualOS as vos
+import csfMap
+import warping
+import datasetPool
+import instrumentation
+from upscaling import AreaWeightedUpscaling
+from downscaling import Downscaling, isAligned
+from remapPlan import RemapPlan, getRemapPlan
+from outputNetcdf import OutputNetcdf, getCompleteTimes, getStoredTimes
+
+# the mean earth radius (m) of the cell areas of lat/lon grids (see getCellArea)
+earthRadius = 6371007.2
+
+# grids are the same (or aligned) if their cell sizes and origins differ less than this fraction of the cell size
+gridTolerance = 1e-3
+
+def roundDegrees(value):
+    # cell sizes (arc-degrees) are rounded to milli-arc-seconds (lat/lon values are often float32)
+    return round(float(value) * 3600. * 1000.) / (3600. * 1000.)
+
+def snapCoordinate(value, cellsize):
+    # coordinates (arc-degrees) are rounded to gridTolerance x cellsize (e.g. float32 origins of 5 arc-minute 
+    # grids, such as 49.99999861, become 50.0)
+    unit = float(cellsize) * gridTolerance
+    return round(round(float(value) / unit) * unit, 9)
+
+def getMapGrid(mapFileName):
+    # the grid of a PCRaster map (e.g. a clone map), read without PCRaster (see csfMap)
+    header = csfMap.readHeader(mapFileName)
+    return dict([(key, header[key]) for key in ['cellsize', 'rows', 'cols', 'xUL', 'yUL']])
+
+def getGrid(ncFile):
+    #
+    # Returns the grid of a netcdf file (with 'lat' or 'latitude', and 'lon' or 'longitude' coordinates of cell centers,
+    # from north to south), as a dictionary with 'xUL', 'yUL', 'cellsize', 'rows' and 'cols'.
+    with datasetPool.pool.dataset(ncFile) as f:
+        latitudes  = np.asarray(f.variables['lat' if 'lat' in f.variables.keys() else 'latitude'][:], dtype = np.float64)
+        longitudes = np.asarray(f.variables['lon' if 'lon' in f.variables.keys() else 'longitude'][:], dtype = np.float64)
+    if len(latitudes) > 1:
+        cellsize = (latitudes[0] - latitudes[-1]) / (len(latitudes) - 1)
+    else:
+        cellsize = (longitudes[-1] - longitudes[0]) / max(1, len(longitudes) - 1)
+    cellsize = roundDegrees(cellsize)
+    return {'cellsize': cellsize,
+            'rows'    : len(latitudes),
+            'cols'    : len(longitudes),
+            'xUL'     : snapCoordinate(longitudes[0] - 0.5 * cellsize, cellsize),
+            'yUL'     : snapCoordinate(latitudes[0]  + 0.5 * cellsize, cellsize)}
+
+def sameGrid(grid, other):
+    # whether two grids are the same (up to gridTolerance)
+    return int(grid['rows']) == int(other['rows']) and int(grid['cols']) == int(other['cols']) and\
+           all([abs(float(grid[key]) - float(other[key])) < gridTolerance * float(grid['cellsize']) for key in ['cellsize', 'xUL', 'yUL']])
+
+def getCellArea(cellArea, grid):
+    #
+    # Returns the cell areas (m2) at grid in a numpy array; cellArea is:
+    # - None                  : the cell areas of the lat/lon grid on a sphere (with earthRadius),
+    # - a number (or string)  : the same area for all cells,
+    # - a numpy array         : the cell areas at grid,
+    # - a PCRaster map (file) : read without PCRaster (see csfMap), and warped to grid if it has another grid.
+    shape = (int(grid['rows']), int(grid['cols']))
+    if cellArea is None:
+        latitudes = float(grid['yUL']) - float(grid['cellsize']) * (np.arange(shape[0]) + 0.5)
+        north = np.radians(latitudes + 0.5 * float(grid['cellsize']))
+        south = np.radians(latitudes - 0.5 * float(grid['cellsize']))
+        area = earthRadius**2 * np.radians(float(grid['cellsize'])) * (np.sin(north) - np.sin(south))
+        return np.repeat(area[:,None], shape[1], axis = 1)
+    if isinstance(cellArea, np.ndarray):
+        if cellArea.shape != shape: raise ValueError("The cell area array does not have the shape of the grid: "+str(cellArea.shape))
+        return cellArea
+    if not isinstance(cellArea, str) or re.match(r"[0-9.eE+-]*$", cellArea):
+        return np.full(shape, float(cellArea))
+    map_grid = getMapGrid(cellArea)
+    if sameGrid(map_grid, grid): return csfMap.readMap(cellArea, vos.MV)
+    return warping.warpMap(csfMap.readMap(cellArea, vos.MV), map_grid, grid, "nearest", vos.MV)
+
+class Resampler(object):
+
+    # The resampling of fields from a source grid to a target grid (see getResampler):
+    # - "copy"      : the same grids,
+    # - "upscaling" : area-weighted upscaling (AreaWeightedUpscaling) of the source rows and columns
+    #                 (read_window) that are covered by a target grid with an integer factor and the same origin,
+    # - "downscaling": nearest, bilinear or (for aligned grids) area-weighted downscaling (Downscaling),
+    # - "remapping" : area-weighted remapping (RemapPlan) for all other grids.
+
+    def __init__(self, kind, function, read_window = (None, None, None, None)):
+        object.__init__(self)
+        self.kind = kind
+        self.function = function
+        self.read_window = read_window
+
+    def resample(self, values):
+        if self.function == None: return values
+        return self.function(values)
+
+def getResampler(sourceGrid, targetGrid, cellArea = None, method = "nearest", planFolder = None):
+    #
+    # Returns the Resampler from sourceGrid to targetGrid (cellArea: see getCellArea; method: the downscaling
+    # method; planFolder: if given, remapping plans are saved in (and reused from) this folder).
+    if sameGrid(sourceGrid, targetGrid):
+        return Resampler("copy", None)
+
+    factor = float(targetGrid['cellsize']) / float(sourceGrid['cellsize'])
+    if factor > 1.0:
+        integer_factor = int(round(factor))
+        if abs(factor - integer_factor) < gridTolerance and\
+           abs(float(sourceGrid['xUL']) - float(targetGrid['xUL'])) < gridTolerance * float(sourceGrid['cellsize']) and\
+           abs(float(sourceGrid['yUL']) - float(targetGrid['yUL'])) < gridTolerance * float(sourceGrid['cellsize']) and\
+           int(targetGrid['rows']) * integer_factor <= int(sourceGrid['rows']) and\
+           int(targetGrid['cols']) * integer_factor <= int(sourceGrid['cols']):
+            # only the source rows and columns that are covered by the target grid are read
+            rows = int(targetGrid['rows']) * integer_factor ; cols = int(targetGrid['cols']) * integer_factor
+            cell_area = getCellArea(cellArea, sourceGrid)[:rows, :cols]
+            return Resampler("upscaling", AreaWeightedUpscaling(cell_area, integer_factor).upscale, (0, rows, 0, cols))
+    elif method != "area" or isAligned(sourceGrid, targetGrid):
+        return Resampler("downscaling", Downscaling(sourceGrid, targetGrid, method).downscale)
+
+    if planFolder != None:
+        plan = getRemapPlan(sourceGrid, targetGrid, cellArea if isinstance(cellArea, str) else None,\
+                            lambda: getCellArea(cellArea, sourceGrid), planFolder)
+    else:
+        plan = RemapPlan(sourceGrid, targetGrid, getCellArea(cellArea, sourceGrid))
+    return Resampler("remapping", plan.remap)
+
+def resampleFields(inputFile, variableName, targetGrid, cellArea = None, method = "nearest", startDate = None, endDate = None,\
+                   blockSize = 1, planFolder = None, cloneMapFileName = None, timeSteps = None):
+    #
+    # A generator of (time stamp, resampled field) for the time steps of the variable variableName of inputFile
+    # between startDate and endDate (YYYY-MM-DD; default: all time steps), or for the (index, date) timeSteps
+    # (e.g. of vos.getNetcdfTimeSteps) if they are given. The fields are read (blockSize time steps at once) when 
+    # they are needed; see getResampler for cellArea, method and planFolder. If a (PCRaster) cloneMapFileName is 
+    # given, the input is cropped and refined to the clone map first (see vos.readNetcdfClone), as in ResampleFramework.
+    if cloneMapFileName != None:
+        source_grid = getMapGrid(cloneMapFileName)
+    else:
+        source_grid = getGrid(inputFile)
+    resampler = getResampler(source_grid, targetGrid, cellArea, method, planFolder)
+    rowStart, rowEnd, colStart, colEnd = resampler.read_window
+    stage_name = "upscale" if float(targetGrid['cellsize']) > float(source_grid['cellsize']) else "downscale"
+
+    if timeSteps == None: timeSteps = vos.getNetcdfTimeSteps(inputFile, startDate, endDate)
+    for block in vos.getTimeStepBlocks(timeSteps, blockSize):
+        input_values = vos.netcdf2NumpyCloneBlock(inputFile, variableName, block[0][0], block[-1][0] + 1, cloneMapFileName,\
+                                                  rowStart = rowStart, rowEnd = rowEnd,\
+                                                  colStart = colStart, colEnd = colEnd)
+        with instrumentation.stage(stage_name): output_values = resampler.resample(input_values)
+        input_values = None
+        for i in range(len(block)):
+            yield block[i][1], output_values[i]
+        # the fields of the block are not kept while the next block is read
+        output_values = None
+
+def getOutputNetcdf(targetGrid, outputOptions = None):
+    # an OutputNetcdf object for targetGrid, with the options of output_netcdf in outputOptions (see writeFields)
+    output_netcdf = {'format': "NETCDF4", 'zlib': True, 'netcdf_attribute': {}}
+    if outputOptions != None: output_netcdf.update(outputOptions)
+    for key in ['cellsize', 'rows', 'cols', 'xUL', 'yUL']: output_netcdf[key] = targetGrid[key]
+    netcdf_attribute = {}
+    for attribute in ['institution', 'title', 'source', 'history', 'references', 'description', 'comment']: netcdf_attribute[attribute] = "None"
+    netcdf_attribute.update(output_netcdf['netcdf_attribute'])
+    output_netcdf['netcdf_attribute'] = netcdf_attribute
+    return OutputNetcdf(output_netcdf)
+
+def writeFields(fields, outputFile, variableName, variableUnit, targetGrid, outputOptions = None, progress = None, position = None):
+    #
+    # Writes the (time stamp, field) items of fields (e.g. of resampleFields) in the variable variableName of a
+    # new netcdf file outputFile (with the grid targetGrid) through OutputNetcdf, and returns the number of written
+    # time steps. outputOptions can have the options of output_netcdf (e.g. 'format', 'zlib', 'chunksizes',
+    # 'buffer_size' and 'netcdf_attribute'). progress: if given, a function that is called with the time stamp 
+    # after every time step. position: if given, the fields are written in the existing file outputFile from this 
+    # time step (position) on, e.g. after its complete time steps (see resampleNetcdf). The file is closed also if 
+    # fields fails.
+    output = getOutputNetcdf(targetGrid, outputOptions)
+    shape = (len(output.latitudes), len(output.longitudes))
+    if position == None:
+        output.createNetCDF(outputFile, variableName, variableUnit)
+        position = 0
+    number_of_time_steps = 0
+    try:
+        for timeStamp, values in fields:
+            if np.shape(values) != shape:
+                raise ValueError("The field of "+str(timeStamp)+" does not have the shape of the target grid "+str(shape)+": "+str(np.shape(values)))
+            output.data2NetCDF(outputFile, variableName, values, timeStamp, position + number_of_time_steps)
+            number_of_time_steps += 1
+            values = None
+            if progress != None: progress(timeStamp)
+    finally:
+        output.close(outputFile)
+    return number_of_time_steps
+
+def getTimeStepsToAppend(input_netcdf, output_netcdf, startDate = None, endDate = None):
+    #
+    # Incremental mode: returns the (index, date) time steps of the input file (between startDate and endDate) that 
+    # are not in the (complete time steps of the) output file yet and come after its last time step, i.e. the ones 
+    # that a resumed run appends. This only compares the time axes, so it can be checked before the setup of 
+    # ResampleFramework (e.g. to stop at once if there are no new time steps). Without an output file, these are 
+    # all input time steps. Missing time steps before the last output time step are reported, but not returned.
+    time_steps = vos.getNetcdfTimeSteps(input_netcdf['file_name'], startDate, endDate)
+    if not os.path.isfile(output_netcdf['file_name']): return time_steps
+
+    with datasetPool.pool.dataset(output_netcdf['file_name']) as rootgrp:
+        output_times = getCompleteTimes(rootgrp, [output_netcdf['variable_name']])
+        input_times = getStoredTimes(rootgrp, [timeStamp for idx, timeStamp in time_steps])
+    if len(output_times) == 0: return time_steps
+
+    missing = ~np.isin(input_times, output_times)
+    appended = missing & (input_times > output_times[-1])
+    if (missing & ~appended).any():
+        print("Warning: "+str(int((missing & ~appended).sum()))+" input time steps before the last time step of "+\
+              str(output_netcdf['file_name'])+" are not in this file; they are not appended (a new run is needed for them).")
+    return [time_step for time_step, append in zip(time_steps, appended) if append]
+
+def resampleNetcdf(input_netcdf, output_netcdf, startDate = None, endDate = None, blockSize = 1):
+    #
+    # Resamples the input time steps between startDate and endDate (as ResampleFramework.runOverInputTimeSteps), 
+    # with numpy and netCDF4 only: input_netcdf and output_netcdf are the dictionaries of 0_netcdf_resample.py,
+    # with the same (optional) keys: the clone_file and cell_area maps are read without PCRaster (and warped to 
+    # the clone if needed), and the output is resumed (if output_netcdf['resume'] is True) and instrumented.
+
+    # the input grid (the clone map, to which the input is cropped and refined, or the grid of the input file)
+    clone_map_file = None
+    if 'clone_file' in input_netcdf.keys() and input_netcdf['clone_file'] != None: clone_map_file = input_netcdf['clone_file']
+    if clone_map_file != None:
+        source_grid = getMapGrid(clone_map_file)
+    else:
+        source_grid = getGrid(input_netcdf['file_name'])
+
+    # the output grid (the origin, rows and cols may also be given in output_netcdf)
+    output_netcdf['cellsize'] = output_netcdf['cell_resolution']
+    resample_factor = float(output_netcdf['cellsize']) / float(source_grid['cellsize'])
+    if 'rows' not in output_netcdf.keys(): output_netcdf['rows'] = int(round(float(source_grid['rows']) / resample_factor))
+    if 'cols' not in output_netcdf.keys(): output_netcdf['cols'] = int(round(float(source_grid['cols']) / resample_factor))
+    if 'xUL' not in output_netcdf.keys(): output_netcdf['xUL'] = source_grid['xUL']
+    if 'yUL' not in output_netcdf.keys(): output_netcdf['yUL'] = source_grid['yUL']
+
+    cell_area = None
+    if 'cell_area' in input_netcdf.keys(): cell_area = input_netcdf['cell_area']
+    method = "nearest"
+    if 'downscaling_method' in output_netcdf.keys(): method = output_netcdf['downscaling_method']
+    if 'remap_plan_folder' in output_netcdf.keys():
+        plan_folder = output_netcdf['remap_plan_folder']
+    else:
+        plan_folder = os.path.join(os.path.dirname(os.path.abspath(output_netcdf['file_name'])), "remap_plans")
+
+    time_steps = vos.getNetcdfTimeSteps(input_netcdf['file_name'], startDate, endDate)
+    print("Number of input time steps between "+str(startDate)+" and "+str(endDate)+": "+str(len(time_steps)))
+
+    # resume: the time steps after the last complete time step of an existing output file are written
+    position = None
+    if 'resume' in output_netcdf.keys() and output_netcdf['resume'] == True and os.path.isfile(output_netcdf['file_name']):
+        print("Resuming the output file: "+str(output_netcdf['file_name']))
+        output = getOutputNetcdf(output_netcdf, output_netcdf)
+        position, last_time_stamp = output.getCompleteTimeSteps(output_netcdf['file_name'], [output_netcdf['variable_name']])
+        if position > 0:
+            time_steps = output.getTimeStepsAfter(output_netcdf['file_name'], time_steps, position)
+            print("Resuming after "+str(last_time_stamp)+" ("+str(position)+" complete time steps in the output): "+\
+                  str(len(time_steps))+" time steps remain")
+    print("Number of time steps per block: "+str(blockSize))
+
+    progress_interval = 10.0
+    if 'progress_interval' in output_netcdf.keys(): progress_interval = float(output_netcdf['progress_interval'])
+    profile_file = None
+    if 'profile_file' in output_netcdf.keys(): profile_file = output_netcdf['profile_file']
+    statistics = instrumentation.RunStatistics(len(time_steps), progress_interval, profile_file).start()
+
+    fields = resampleFields(input_netcdf['file_name'], input_netcdf['variable_name'], output_netcdf, cell_area, method,\
+                            blockSize = blockSize, planFolder = plan_folder, cloneMapFileName = clone_map_file, timeSteps = time_steps)
+    writeFields(fields, output_netcdf['file_name'], output_netcdf['variable_name'], output_netcdf['variable_unit'],\
+                output_netcdf, output_netcdf, lambda timeStamp: statistics.progress(1, timeStamp), position)
+
+    # throughput and stages
+    statistics.finish()
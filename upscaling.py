@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+import virtualOS as vos
+
+class AreaWeightedUpscaling(object):
+
+    # Area-weighted upscaling of fields (numpy arrays) by an integer resample
+    # factor. For every (factor x factor) block, it calculates:
+    #
+    #   sum(value * cell_area) / sum(cell_area)
+    #
+    # This gives the same results as the former PCRaster calculation
+    # (used in ResampleFramework.dynamic):
+    #
+    #   getValDivZero(areatotal(value*cell_area, unique_ids),
+    #                 areatotal(cell_area, unique_ids), smallNumber)
+    #
+    # followed by regridToCoarse(..., "max"), i.e.:
+    # - the denominator includes all cells with cell_area values (also the ones with missing values),
+    # - the result is zero if the denominator is not above smallNumber, and
+    # - the result is missing (MV) if a block does not have any cell with both value and cell_area.
+
+    def __init__(self, cell_area, resample_factor, missValue = vos.MV):
+        object.__init__(self)
+
+        self.resample_factor = int(round(resample_factor))
+        self.missValue = missValue
+
+        # cell area (m2) in blocks; missing cell areas are set to zero
+        cell_area = np.ma.filled(cell_area, missValue).astype(np.float64)
+        cell_area_available = ~np.isclose(cell_area, missValue)
+        cell_area = np.where(cell_area_available, cell_area, 0.0)
+        self.cell_area_blocks = vos.getBlocks(cell_area, self.resample_factor)
+        self.cell_area_available_blocks = vos.getBlocks(cell_area_available, self.resample_factor)
+
+        # the denominator (the total cell area of every block) does not change; it is calculated only once
+        total_cell_area = self.cell_area_blocks.sum(axis = -1)
+        self.positive_total_area = total_cell_area > vos.smallNumber
+        self.total_cell_area = np.maximum(vos.smallNumber, total_cell_area)
+
+    def upscale(self, fine):
+
+        # fine: a field (rows, cols) or a stack of fields (..., rows, cols) at the input resolution,
+        #       with missing values equal to missValue
+
+        value_blocks = vos.getBlocks(np.ma.filled(fine, self.missValue), self.resample_factor)
+        available = self.cell_area_available_blocks & ~np.isclose(value_blocks, self.missValue)
+
+        # sum(value * cell_area) for every block
+        value_blocks = np.where(available, value_blocks * self.cell_area_blocks, 0.0)
+        value_total  = value_blocks.sum(axis = -1)
+        value_blocks = None
+
+        coarse = np.where(self.positive_total_area, value_total / self.total_cell_area, 0.0)
+        coarse[~available.any(axis = -1)] = vos.MV
+        return coarse
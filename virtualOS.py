@@ -13,50 +13,72 @@ import re
 import math
 import sys
 import calendar
+import logging
+import importlib
 
 import netCDF4 as nc
 import numpy as np
 import numpy.ma as ma
-import pcraster as pcr
+
+import csfMap
+import instrumentation
+import datasetPool
 
 # Global variables:
 MV = 1e20
 smallNumber = 1E-39
 
-# the following dictionary is needed to avoid open and closing files
-filecache = dict()
+# netcdf files are opened (only once) with the dataset pool (datasetPool.pool), which is shared with OutputNetcdf
+
+# decoded time axes of opened netcdf files (see getNetcdfTimeTable)
+timeTableCache = dict()
+
+# crop windows of netcdf files at clone maps (see getCloneWindow)
+cloneWindowCache = dict()
+
+logger = logging.getLogger(__name__)
+
+class LazyModule(object):
+
+    # a module that is imported when it is first used (e.g. pcraster, which takes seconds to import, 
+    # or scipy; they are not needed, nor installed everywhere, for resampling with numpy and netCDF4 
+    # only; see streaming)
+
+    def __init__(self, name):
+        self.__dict__['name'] = name
+        self.__dict__['module'] = None
+
+    def __getattr__(self, attribute):
+        if self.module == None: self.__dict__['module'] = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
+pcr = LazyModule("pcraster")
 
 def netcdfCloneAttributes(ncFile, 
                           cellSizeInArcMinutes = None,
                           roundUpperLeftCornerCoordinates = True):
 
-    if ncFile in filecache.keys():
-        f = filecache[ncFile]
-        print "Cached: ", ncFile
-    else:
-        f = nc.Dataset(ncFile)
-        filecache[ncFile] = f
-        print "New: ", ncFile
+    with datasetPool.pool.dataset(ncFile) as f:
 
-    try:
-        f.variables['lat'] = f.variables['latitude']
-        f.variables['lon'] = f.variables['longitude']
-    except:
-        pass
+        try:
+            f.variables['lat'] = f.variables['latitude']
+            f.variables['lon'] = f.variables['longitude']
+        except:
+            pass
 
-    # get the attributes of input (netCDF):
-    # - numbers of rows and columns:
-    nrRows   = len(f.variables['lat'])
-    nrCols   = len(f.variables['lon'])
-    # - cell resolution
-    cellSize = f.variables['lat'][0]- f.variables['lat'][1]                  # TODO: Include inverting latitude coordinates if f.variables['lat'][0] < f.variables['lat'][1].
-    if cellSizeInArcMinutes != None: cellSize = cellSizeInArcMinutes/60.
-    # - upper left coordinates (cell centres)
-    xULInput = f.variables['lon'][0] - 0.5*cellSize
-    yULInput = f.variables['lat'][0] + 0.5*cellSize
-    if roundUpperLeftCornerCoordinates:
-        xULInput = round(xULInput)
-        yULInput = round(yULInput)
+        # get the attributes of input (netCDF):
+        # - numbers of rows and columns:
+        nrRows   = len(f.variables['lat'])
+        nrCols   = len(f.variables['lon'])
+        # - cell resolution
+        cellSize = f.variables['lat'][0]- f.variables['lat'][1]                  # TODO: Include inverting latitude coordinates if f.variables['lat'][0] < f.variables['lat'][1].
+        if cellSizeInArcMinutes != None: cellSize = cellSizeInArcMinutes/60.
+        # - upper left coordinates (cell centres)
+        xULInput = f.variables['lon'][0] - 0.5*cellSize
+        yULInput = f.variables['lat'][0] + 0.5*cellSize
+        if roundUpperLeftCornerCoordinates:
+            xULInput = round(xULInput)
+            yULInput = round(yULInput)
     
     # a dictionary containing the attributes
     netcdfAttr = {'cellsize': cellSize,\
@@ -68,6 +90,86 @@ def netcdfCloneAttributes(ncFile,
     return netcdfAttr 
 
 
+def getNetcdfTimeSteps(ncFile, startDate = None, endDate = None):
+    #
+    # Returns the time steps of a netcdf file, as a list of (index, date), 
+    # between startDate and endDate (strings YYYY-MM-DD; both are included). 
+    # The time variable is read only once; it can have any (daily, monthly, 
+    # yearly or irregular) time steps.
+    with datasetPool.pool.dataset(ncFile) as f: time_table = getNetcdfTimeTable(ncFile, f)
+    times = time_table['times']
+
+    # time steps within the period [startDate, endDate + 1 day)
+    selected = np.ones(len(times), dtype = bool)
+    if startDate != None:
+        start = datetime.datetime.strptime(str(startDate),'%Y-%m-%d')
+        selected &= times >= nc.date2num(start, time_table['units'], time_table['calendar'])
+    if endDate != None:
+        end = datetime.datetime.strptime(str(endDate),'%Y-%m-%d') + datetime.timedelta(days=1)
+        selected &= times < nc.date2num(end, time_table['units'], time_table['calendar'])
+    indices = np.nonzero(selected)[0]
+
+    return [(int(i), time_table['dates'][i]) for i in indices]
+
+def getNetcdfTimeTable(ncFile, f):
+    #
+    # Returns the time axis of an opened netcdf file (f), decoded only once (per opened file):
+    # a dictionary with the time values ('times'), their dates ('dates'; datetime objects if they 
+    # exist in the standard calendar, otherwise calendar specific dates), the sorted time values 
+    # with their indices ('sorted_times', 'order'), and the first and last year of the time axis.
+    if ncFile in timeTableCache.keys() and timeTableCache[ncFile]['dataset'] is f: 
+        return timeTableCache[ncFile]
+
+    nctime = f.variables['time']
+    calendar = getattr(nctime, 'calendar', 'standard')
+    times = np.asarray(nctime[:], dtype = np.float64)
+
+    dates = []
+    if len(times) > 0:
+        for date in np.atleast_1d(nc.num2date(times, nctime.units, calendar)):
+            try:
+                date = datetime.datetime(date.year, date.month, date.day, date.hour, date.minute, date.second)
+            except ValueError:
+                pass
+            dates.append(date)
+    years = [date.year for date in dates]
+
+    order = np.argsort(times, kind = 'mergesort')
+    time_table = {'dataset'     : f,
+                  'units'       : nctime.units,
+                  'calendar'    : calendar,
+                  'times'       : times,
+                  'dates'       : dates,
+                  'sorted_times': times[order],
+                  'order'       : order,
+                  'first_year'  : min(years) if len(years) > 0 else None,
+                  'last_year'   : max(years) if len(years) > 0 else None}
+    timeTableCache[ncFile] = time_table
+    return time_table
+
+def getTimeIndex(time_table, date, select = 'exact'):
+    #
+    # Returns the index of date in a time table (see getNetcdfTimeTable), with a binary search, or None:
+    # - select = 'exact' : the time step at date;
+    # - select = 'before': the time step at date or, if not available, the last time step before date;
+    # - select = 'after' : the time step at date or, if not available, the first time step after date.
+    num = nc.date2num(date, time_table['units'], time_table['calendar'])
+    sorted_times = time_table['sorted_times']
+    tolerance = 1e-6 * max(1.0, abs(num))
+    first = int(np.searchsorted(sorted_times, num - tolerance, side = 'left'))
+    last  = int(np.searchsorted(sorted_times, num + tolerance, side = 'right'))
+    if last > first: return int(time_table['order'][first])
+    if select == 'before' and first > 0: return int(time_table['order'][first - 1])
+    if select == 'after' and last < len(sorted_times): return int(time_table['order'][last])
+    return None
+
+def closeNetcdfFiles():
+    # closing (and forgetting) all netcdf files of the dataset pool; this is needed before 
+    # starting (forking) other processes, as HDF5 files that are open while forking
+    # cannot be opened again by the new processes
+    datasetPool.pool.closeAll()
+    timeTableCache.clear()
+
 def netcdf2PCRobjCloneWithoutTime(ncFile,varName,
                                   cloneMapFileName  = None,\
                                   LatitudeLongitude = True,\
@@ -78,80 +180,47 @@ def netcdf2PCRobjCloneWithoutTime(ncFile,varName,
     #     Only works if cells are 'square'.
     #     Only works if cellsizeClone <= cellsizeInput
     # Get netCDF file and variable name:
-    if ncFile in filecache.keys():
-        f = filecache[ncFile]
-        print "Cached: ", ncFile
-    else:
-        f = nc.Dataset(ncFile)
-        filecache[ncFile] = f
-        print "New: ", ncFile
+    with datasetPool.pool.dataset(ncFile) as f:
     
-    #print ncFile
-    #f = nc.Dataset(ncFile)  
-    varName = str(varName)
+        #print ncFile
+        #f = nc.Dataset(ncFile)  
+        varName = str(varName)
     
-    if LatitudeLongitude == True:
-        try:
-            f.variables['lat'] = f.variables['latitude']
-            f.variables['lon'] = f.variables['longitude']
-        except:
+        if LatitudeLongitude == True:
             try:
-                f.variables['lat'] = f.variables['Latitude']
-                f.variables['lon'] = f.variables['Longitude']
+                f.variables['lat'] = f.variables['latitude']
+                f.variables['lon'] = f.variables['longitude']
             except:
-                pass
+                try:
+                    f.variables['lat'] = f.variables['Latitude']
+                    f.variables['lon'] = f.variables['Longitude']
+                except:
+                    pass
     
-    sameClone = True
-    # check whether clone and input maps have the same attributes:
-    if cloneMapFileName != None:
-        # get the attributes of cloneMap
-        attributeClone = getMapAttributesALL(cloneMapFileName)
-        cellsizeClone = attributeClone['cellsize']
-        rowsClone = attributeClone['rows']
-        colsClone = attributeClone['cols']
-        xULClone = attributeClone['xUL']
-        yULClone = attributeClone['yUL']
-        # get the attributes of input (netCDF) 
-        cellsizeInput = f.variables['lat'][0]- f.variables['lat'][1]
-        cellsizeInput = float(cellsizeInput)
-        rowsInput = len(f.variables['lat'])
-        colsInput = len(f.variables['lon'])
-        xULInput = f.variables['lon'][0]-0.5*cellsizeInput
-        yULInput = f.variables['lat'][0]+0.5*cellsizeInput
-        # check whether both maps have the same attributes 
-        if cellsizeClone != cellsizeInput: sameClone = False
-        if rowsClone != rowsInput: sameClone = False
-        if colsClone != colsInput: sameClone = False
-        if xULClone != xULInput: sameClone = False
-        if yULClone != yULInput: sameClone = False
-
-    cropData = f.variables[varName][:,:]       # still original data
-    factor = 1                                 # needed in regridData2FinerGrid
-    if sameClone == False:
-        # crop to cloneMap:
-        minX    = min(abs(f.variables['lon'][:] - (xULClone + 0.5*cellsizeInput))) # ; print(minX)
-        xIdxSta = int(np.where(abs(f.variables['lon'][:] - (xULClone + 0.5*cellsizeInput)) == minX)[0])
-        xIdxEnd = int(math.ceil(xIdxSta + colsClone /(cellsizeInput/cellsizeClone)))
-        minY    = min(abs(f.variables['lat'][:] - (yULClone - 0.5*cellsizeInput))) # ; print(minY)
-        yIdxSta = int(np.where(abs(f.variables['lat'][:] - (yULClone - 0.5*cellsizeInput)) == minY)[0])
-        yIdxEnd = int(math.ceil(yIdxSta + rowsClone /(cellsizeInput/cellsizeClone)))
-        cropData = f.variables[varName][yIdxSta:yIdxEnd,xIdxSta:xIdxEnd]
-        factor = int(float(cellsizeInput)/float(cellsizeClone))
-    
-    # convert to PCR object and close f
-    if specificFillValue != None:
-        outPCR = pcr.numpy2pcr(pcr.Scalar, \
-                  regridData2FinerGrid(factor,cropData,MV), \
-                  float(specificFillValue))
-    else:
-        outPCR = pcr.numpy2pcr(pcr.Scalar, \
-                  regridData2FinerGrid(factor,cropData,MV), \
-                  float(f.variables[varName]._FillValue))
+        # the window (of the input) that covers cloneMap (None: the same grid)
+        window = getCloneWindow(f, cloneMapFileName)
+        factor = 1                                 # needed in regridData2FinerGrid
+        if window == None:
+            cropData = f.variables[varName][:,:]
+        else:
+            # crop to cloneMap:
+            yIdxSta, yIdxEnd, xIdxSta, xIdxEnd, factor = window
+            cropData = f.variables[varName][yIdxSta:yIdxEnd,xIdxSta:xIdxEnd]
+    
+        # convert to PCR object
+        if specificFillValue != None:
+            outPCR = pcr.numpy2pcr(pcr.Scalar, \
+                      regridData2FinerGrid(factor,cropData,MV), \
+                      float(specificFillValue))
+        else:
+            outPCR = pcr.numpy2pcr(pcr.Scalar, \
+                      regridData2FinerGrid(factor,cropData,MV), \
+                      float(f.variables[varName]._FillValue))
                   
-    #~ # debug:
-    #~ pcr.report(outPCR,"tmp.map")
-    #~ print(varName)
-    #~ os.system('aguila tmp.map')
+        #~ # debug:
+        #~ pcr.report(outPCR,"tmp.map")
+        #~ print(varName)
+        #~ os.system('aguila tmp.map')
     
     #f.close();
     f = None ; cropData = None 
@@ -168,146 +237,243 @@ def netcdf2PCRobjClone(ncFile,varName,dateInput,\
     # --- with clone checking
     #     Only works if cells are 'square'.
     #     Only works if cellsizeClone <= cellsizeInput
-    # Get netCDF file and variable name:
-    
-    print ncFile
+    fineData, fillValue = getNetcdfFieldClone(ncFile, varName, dateInput, useDoy, \
+                                              cloneMapFileName, LatitudeLongitude, specificFillValue)
     
-    if ncFile in filecache.keys():
-        f = filecache[ncFile]
-        print "Cached: ", ncFile
-    else:
-        f = nc.Dataset(ncFile)
-        filecache[ncFile] = f
-        print "New: ", ncFile
+    # convert to PCR object
+    outPCR = pcr.numpy2pcr(pcr.Scalar, fineData, fillValue)
+    fineData = None
+    # PCRaster object
+    return (outPCR)
+
+def netcdf2NumpyClone(ncFile,varName,dateInput,\
+                      useDoy = None,
+                      cloneMapFileName  = None,\
+                      LatitudeLongitude = True,\
+                      specificFillValue = None):
+    # 
+    # As netcdf2PCRobjClone, but returning a numpy array (without any PCRaster 
+    # conversion) in which missing values are set to MV.  
+    fineData, fillValue = getNetcdfFieldClone(ncFile, varName, dateInput, useDoy, \
+                                              cloneMapFileName, LatitudeLongitude, specificFillValue, missingValue = MV)
+    return fineData
+
+def getNetcdfFieldClone(ncFile,varName,dateInput,\
+                        useDoy = None,
+                        cloneMapFileName  = None,\
+                        LatitudeLongitude = True,\
+                        specificFillValue = None,\
+                        missingValue      = None):
+    # 
+    # Reading a netCDF field (at the cell size of cloneMapFileName) and its fill value
+    # (or missingValue, if given, that replaces the fill value in the field).
+    # Get netCDF file and variable name:
+    with datasetPool.pool.dataset(ncFile) as f:
     
-    varName = str(varName)
+        varName = str(varName)
     
-    if LatitudeLongitude == True:
-        try:
-            f.variables['lat'] = f.variables['latitude']
-            f.variables['lon'] = f.variables['longitude']
-        except:
-            pass
+        if LatitudeLongitude == True:
+            try:
+                f.variables['lat'] = f.variables['latitude']
+                f.variables['lon'] = f.variables['longitude']
+            except:
+                pass
     
-    if varName == "evapotranspiration":        
-        try:
-            f.variables['evapotranspiration'] = f.variables['referencePotET']
-        except:
-            pass
+        if varName == "evapotranspiration":        
+            try:
+                f.variables['evapotranspiration'] = f.variables['referencePotET']
+            except:
+                pass
 
-    # date
-    date = dateInput
-    if useDoy == "Yes": 
-        idx = dateInput - 1
-    else:
-        if isinstance(date, str) == True: date = \
-                        datetime.datetime.strptime(str(date),'%Y-%m-%d') 
-        date = datetime.datetime(date.year,date.month,date.day)
-        # time index (in the netCDF file)
-        if useDoy == "month":
-            idx = int(date.month) - 1
+        # date
+        date = dateInput
+        if useDoy == "Yes": 
+            idx = dateInput - 1
         else:
-            nctime = f.variables['time']  # A netCDF time variable object.
-            if useDoy == "yearly":
-                date  = datetime.datetime(date.year,int(1),int(1))
-            if useDoy == "monthly":
-                date = datetime.datetime(date.year,date.month,int(1))
-            if useDoy == "yearly" or useDoy == "monthly":
-                # if the desired year is not available, use the first year or the last year that is available
-                first_year_in_nc_file = findFirstYearInNCTime(nctime)
-                last_year_in_nc_file  =  findLastYearInNCTime(nctime)
-                #
-                if date.year < first_year_in_nc_file:  
-                    date = datetime.datetime(first_year_in_nc_file,date.month,date.day)
-                    msg  = "\n"
-                    msg += "WARNING related to the netcdf file: "+str(ncFile)+" ; variable: "+str(varName)+" !!!!!!"+"\n"
-                    msg += "The date "+str(dateInput)+" is NOT available. "
-                    msg += "The date "+str(date.year)+"-"+str(date.month)+"-"+str(date.day)+" is used."
-                    msg += "\n"
-                    logger.warning(msg)
-                if date.year > last_year_in_nc_file:  
-                    date = datetime.datetime(last_year_in_nc_file,date.month,date.day)
-                    msg  = "\n"
-                    msg += "WARNING related to the netcdf file: "+str(ncFile)+" ; variable: "+str(varName)+" !!!!!!"+"\n"
-                    msg += "The date "+str(dateInput)+" is NOT available. "
-                    msg += "The date "+str(date.year)+"-"+str(date.month)+"-"+str(date.day)+" is used."
-                    msg += "\n"
-                    logger.warning(msg)
-            try:
-                idx = nc.date2index(date, nctime, calendar = nctime.calendar, \
-                                                  select='exact')
-            except:                                  
-                try:
-                    idx = nc.date2index(date, nctime, calendar = nctime.calendar, \
-                                                      select='before')
+            if isinstance(date, str) == True: date = \
+                            datetime.datetime.strptime(str(date),'%Y-%m-%d') 
+            date = datetime.datetime(date.year,date.month,date.day)
+            # time index (in the netCDF file)
+            if useDoy == "month":
+                idx = int(date.month) - 1
+            else:
+                time_table = getNetcdfTimeTable(ncFile, f)
+                if useDoy == "yearly":
+                    date  = datetime.datetime(date.year,int(1),int(1))
+                if useDoy == "monthly":
+                    date = datetime.datetime(date.year,date.month,int(1))
+                if useDoy == "yearly" or useDoy == "monthly":
+                    # if the desired year is not available, use the first year or the last year that is available
+                    first_year_in_nc_file = time_table['first_year']
+                    last_year_in_nc_file  = time_table['last_year']
+                    #
+                    if date.year < first_year_in_nc_file:  
+                        date = datetime.datetime(first_year_in_nc_file,date.month,date.day)
+                        msg  = "\n"
+                        msg += "WARNING related to the netcdf file: "+str(ncFile)+" ; variable: "+str(varName)+" !!!!!!"+"\n"
+                        msg += "The date "+str(dateInput)+" is NOT available. "
+                        msg += "The date "+str(date.year)+"-"+str(date.month)+"-"+str(date.day)+" is used."
+                        msg += "\n"
+                        logger.warning(msg)
+                    if date.year > last_year_in_nc_file:  
+                        date = datetime.datetime(last_year_in_nc_file,date.month,date.day)
+                        msg  = "\n"
+                        msg += "WARNING related to the netcdf file: "+str(ncFile)+" ; variable: "+str(varName)+" !!!!!!"+"\n"
+                        msg += "The date "+str(dateInput)+" is NOT available. "
+                        msg += "The date "+str(date.year)+"-"+str(date.month)+"-"+str(date.day)+" is used."
+                        msg += "\n"
+                        logger.warning(msg)
+                idx = getTimeIndex(time_table, date, select = 'exact')
+                if idx == None:                                  
+                    idx = getTimeIndex(time_table, date, select = 'before')
                     msg  = "\n"
                     msg += "WARNING related to the netcdf file: "+str(ncFile)+" ; variable: "+str(varName)+" !!!!!!"+"\n"
                     msg += "The date "+str(dateInput)+" is NOT available. The 'before' option is used while selecting netcdf time."
                     msg += "\n"
-                except:
-                    idx = nc.date2index(date, nctime, calendar = nctime.calendar, \
-                                                      select='after')
-                    msg  = "\n"
-                    msg += "WARNING related to the netcdf file: "+str(ncFile)+" ; variable: "+str(varName)+" !!!!!!"+"\n"
-                    msg += "The date "+str(dateInput)+" is NOT available. The 'after' option is used while selecting netcdf time."
-                    msg += "\n"
-                logger.warning(msg)
+                    if idx == None:
+                        idx = getTimeIndex(time_table, date, select = 'after')
+                        msg  = "\n"
+                        msg += "WARNING related to the netcdf file: "+str(ncFile)+" ; variable: "+str(varName)+" !!!!!!"+"\n"
+                        msg += "The date "+str(dateInput)+" is NOT available. The 'after' option is used while selecting netcdf time."
+                        msg += "\n"
+                    if idx == None:
+                        msg = "The netcdf file "+str(ncFile)+" does not have any time steps."
+                        raise ValueError(msg)
+                    logger.warning(msg)
                                                   
-    idx = int(idx)                                                  
+        idx = int(idx)                                                  
+
+        fineData, fillValue = readNetcdfClone(f, varName, idx, cloneMapFileName, specificFillValue, missingValue)
+    f = None
+    return fineData, fillValue
+
+def netcdf2NumpyCloneBlock(ncFile,varName,idxStart,idxEnd,\
+                           cloneMapFileName  = None,\
+                           LatitudeLongitude = True,\
+                           specificFillValue = None,\
+                           rowStart = None, rowEnd = None,\
+                           colStart = None, colEnd = None):
+    # 
+    # As netcdf2NumpyClone, but reading the time steps idxStart, ..., idxEnd - 1 
+    # (time indices) at once, in one (time, rows, cols) array. If rowStart and 
+    # rowEnd (colStart and colEnd) are given, only these rows (columns) of the 
+    # clone are read (a latitude band or a tile).
+    with datasetPool.pool.dataset(ncFile) as f:
+    
+        if LatitudeLongitude == True:
+            try:
+                f.variables['lat'] = f.variables['latitude']
+                f.variables['lon'] = f.variables['longitude']
+            except:
+                pass
 
+        fineData, fillValue = readNetcdfClone(f, str(varName), slice(int(idxStart), int(idxEnd)), cloneMapFileName, specificFillValue, MV,\
+                                              rowStart, rowEnd, colStart, colEnd)
+    f = None
+    return fineData
+
+def getCloneWindow(f, cloneMapFileName):
+    #
+    # Returns the window (yIdxSta, yIdxEnd, xIdxSta, xIdxEnd) of the (opened) netcdf file f that 
+    # covers cloneMap, with the refinement factor (input cell size / clone cell size), or None if 
+    # no cloneMap is given or if f has the same grid as cloneMap. The window is calculated only  
+    # once for every file and clone (attributes).
+    if cloneMapFileName == None: return None
+    
+    # get the attributes of cloneMap
+    attributeClone = getMapAttributesALL(cloneMapFileName)
+    key = (f.filepath(), str(cloneMapFileName), tuple(sorted(attributeClone.items())))
+    if key in cloneWindowCache.keys(): return cloneWindowCache[key]
+
+    cellsizeClone = attributeClone['cellsize']
+    rowsClone = attributeClone['rows']
+    colsClone = attributeClone['cols']
+    xULClone = attributeClone['xUL']
+    yULClone = attributeClone['yUL']
+    # get the attributes of input (netCDF) 
+    latitudes  = f.variables['lat'][:]
+    longitudes = f.variables['lon'][:]
+    cellsizeInput = latitudes[0]- latitudes[1]
+    cellsizeInput = float(cellsizeInput)
+    rowsInput = len(latitudes)
+    colsInput = len(longitudes)
+    xULInput = longitudes[0]-0.5*cellsizeInput
+    yULInput = latitudes[0]+0.5*cellsizeInput
+    # check whether both maps have the same attributes 
     sameClone = True
-    # check whether clone and input maps have the same attributes:
-    if cloneMapFileName != None:
-        # get the attributes of cloneMap
-        attributeClone = getMapAttributesALL(cloneMapFileName)
-        cellsizeClone = attributeClone['cellsize']
-        rowsClone = attributeClone['rows']
-        colsClone = attributeClone['cols']
-        xULClone = attributeClone['xUL']
-        yULClone = attributeClone['yUL']
-        # get the attributes of input (netCDF) 
-        cellsizeInput = f.variables['lat'][0]- f.variables['lat'][1]
-        cellsizeInput = float(cellsizeInput)
-        rowsInput = len(f.variables['lat'])
-        colsInput = len(f.variables['lon'])
-        xULInput = f.variables['lon'][0]-0.5*cellsizeInput
-        yULInput = f.variables['lat'][0]+0.5*cellsizeInput
-        # check whether both maps have the same attributes 
-        if cellsizeClone != cellsizeInput: sameClone = False
-        if rowsClone != rowsInput: sameClone = False
-        if colsClone != colsInput: sameClone = False
-        if xULClone != xULInput: sameClone = False
-        if yULClone != yULInput: sameClone = False
-
-    cropData = f.variables[varName][int(idx),:,:]       # still original data
-    factor = 1                          # needed in regridData2FinerGrid
+    if cellsizeClone != cellsizeInput: sameClone = False
+    if rowsClone != rowsInput: sameClone = False
+    if colsClone != colsInput: sameClone = False
+    if xULClone != xULInput: sameClone = False
+    if yULClone != yULInput: sameClone = False
+
+    window = None
     if sameClone == False:
+        # the input cells that are nearest to the upper left corner of cloneMap 
+        xIdxSta = int(np.argmin(abs(longitudes - (xULClone + 0.5*cellsizeInput))))
+        xIdxEnd = int(math.ceil(round(xIdxSta + colsClone /(cellsizeInput/cellsizeClone), 6)))
+        yIdxSta = int(np.argmin(abs(latitudes - (yULClone - 0.5*cellsizeInput))))
+        yIdxEnd = int(math.ceil(round(yIdxSta + rowsClone /(cellsizeInput/cellsizeClone), 6)))
+        factor = int(round(float(cellsizeInput)/float(cellsizeClone)))
+        window = (yIdxSta, yIdxEnd, xIdxSta, xIdxEnd, factor)
+
+    cloneWindowCache[key] = window
+    return window
+
+def readNetcdfClone(f,varName,timeIndex,cloneMapFileName = None,specificFillValue = None,missingValue = None,\
+                    rowStart = None,rowEnd = None,colStart = None,colEnd = None):
+    #
+    # Reading the netCDF variable of the (opened) file f at the time index timeIndex 
+    # (an index or a slice for multiple time steps), cropped and resampled to the 
+    # cloneMap, and its fill value. If missingValue is given, it replaces the fill 
+    # value (before refining, i.e. at the input resolution) and it is returned instead.
+    # If rowStart and rowEnd are given, only the rows rowStart, ..., rowEnd - 1 (of  
+    # the cloneMap) are returned, and only the input rows that cover them are read
+    # (and likewise for the columns colStart, ..., colEnd - 1).
+    idx = timeIndex
+
+    # the window (of the input) that covers cloneMap (None: the same grid); only this window is read 
+    window = getCloneWindow(f, cloneMapFileName)
+    factor = 1                          # needed in regridData2FinerGrid
+    if window == None:
+        yIdxSta, yIdxEnd, xIdxSta, xIdxEnd = 0, len(f.variables['lat']), 0, len(f.variables['lon'])
+    else:
         # crop to cloneMap:
-        #~ xIdxSta = int(np.where(f.variables['lon'][:] == xULClone + 0.5*cellsizeInput)[0])
-        minX    = min(abs(f.variables['lon'][:] - (xULClone + 0.5*cellsizeInput))) # ; print(minX)
-        xIdxSta = int(np.where(abs(f.variables['lon'][:] - (xULClone + 0.5*cellsizeInput)) == minX)[0])
-        xIdxEnd = int(math.ceil(xIdxSta + colsClone /(cellsizeInput/cellsizeClone)))
-        #~ yIdxSta = int(np.where(f.variables['lat'][:] == yULClone - 0.5*cellsizeInput)[0])
-        minY    = min(abs(f.variables['lat'][:] - (yULClone - 0.5*cellsizeInput))) # ; print(minY)
-        yIdxSta = int(np.where(abs(f.variables['lat'][:] - (yULClone - 0.5*cellsizeInput)) == minY)[0])
-        yIdxEnd = int(math.ceil(yIdxSta + rowsClone /(cellsizeInput/cellsizeClone)))
+        yIdxSta, yIdxEnd, xIdxSta, xIdxEnd, factor = window
+    rowOffset = 0 ; colOffset = 0
+    if rowStart != None:
+        # only the input rows that cover the rows rowStart, ..., rowEnd - 1 (after refining)
+        rowEnd    = min(rowEnd, (yIdxEnd - yIdxSta) * factor)
+        rowOffset = rowStart % factor
+        yIdxEnd   = yIdxSta + int(math.ceil(rowEnd / float(factor)))
+        yIdxSta   = yIdxSta + rowStart // factor
+    if colStart != None:
+        colEnd    = min(colEnd, (xIdxEnd - xIdxSta) * factor)
+        colOffset = colStart % factor
+        xIdxEnd   = xIdxSta + int(math.ceil(colEnd / float(factor)))
+        xIdxSta   = xIdxSta + colStart // factor
+    with instrumentation.stage("read") as read_stage:
         cropData = f.variables[varName][idx,yIdxSta:yIdxEnd,xIdxSta:xIdxEnd]
-        factor = int(float(cellsizeInput)/float(cellsizeClone))
     
-    # convert to PCR object and close f
-    if specificFillValue != None:
-        outPCR = pcr.numpy2pcr(pcr.Scalar, \
-                  regridData2FinerGrid(factor,cropData,MV), \
-                  float(specificFillValue))
-    else:
-        outPCR = pcr.numpy2pcr(pcr.Scalar, \
-                  regridData2FinerGrid(factor,cropData,MV), \
-                  float(f.variables[varName]._FillValue))
+        # fill value
+        if specificFillValue != None:
+            fillValue = float(specificFillValue)
+        else:
+            fillValue = float(f.variables[varName]._FillValue)
+    
+        cropData = ma.filled(cropData,fillValue)
+        if missingValue != None:
+            cropData = np.where(cropData == fillValue, missingValue, cropData)
+            fillValue = missingValue
+        read_stage.bytes = cropData.nbytes
+    with instrumentation.stage("refine"):
+        fineData = regridData2FinerGrid(factor,cropData,MV)
+    if rowStart != None: fineData = fineData[..., rowOffset:rowOffset + (rowEnd - rowStart), :]
+    if colStart != None: fineData = fineData[..., colOffset:colOffset + (colEnd - colStart)]
                   
     #f.close();
     f = None ; cropData = None 
-    # PCRaster object
-    return (outPCR)
+    return fineData, fillValue
 
 def netcdf2PCRobjCloneWindDist(ncFile,varName,dateInput,useDoy = None,
                        cloneMapFileName=None):
@@ -318,63 +484,62 @@ def netcdf2PCRobjCloneWindDist(ncFile,varName,dateInput,useDoy = None,
     #     Only works if cellsizeClone <= cellsizeInput
     
     # Get netCDF file and variable name:
-    f = nc.Dataset(ncFile)
-    varName = str(varName)
+    with datasetPool.pool.dataset(ncFile) as f:
+        varName = str(varName)
 
-    # date
-    date = dateInput
-    if useDoy == "Yes": 
-        idx = dateInput - 1
-    else:
-        if isinstance(date, str) == True: date = \
-                        datetime.datetime.strptime(str(date),'%Y-%m-%d') 
-        date = datetime.datetime(date.year,date.month,date.day)
-        # time index (in the netCDF file)
-        nctime = f.variables['time']  # A netCDF time variable object.
-        idx = nc.date2index(date, nctime, calendar=nctime.calendar, \
-                                                     select='exact')
-    idx = int(idx)                                                  
-
-    sameClone = True
-    # check whether clone and input maps have the same attributes:
-    if cloneMapFileName != None:
-        # get the attributes of cloneMap
-        attributeClone = getMapAttributesALL(cloneMapFileName)
-        cellsizeClone = attributeClone['cellsize']
-        rowsClone = attributeClone['rows']
-        colsClone = attributeClone['cols']
-        xULClone = attributeClone['xUL']
-        yULClone = attributeClone['yUL']
-        # get the attributes of input (netCDF) 
-        cellsizeInput = f.variables['lat'][0]- f.variables['lat'][1]
-        cellsizeInput = float(cellsizeInput)
-        rowsInput = len(f.variables['lat'])
-        colsInput = len(f.variables['lon'])
-        xULInput = f.variables['lon'][0]-0.5*cellsizeInput
-        yULInput = f.variables['lat'][0]+0.5*cellsizeInput
-        # check whether both maps have the same attributes 
-        if cellsizeClone != cellsizeInput: sameClone = False
-        if rowsClone != rowsInput: sameClone = False
-        if colsClone != colsInput: sameClone = False
-        if xULClone != xULInput: sameClone = False
-        if yULClone != yULInput: sameClone = False
-
-    cropData = f.variables[varName][int(idx),:,:]       # still original data
-    factor = 1                          # needed in regridData2FinerGrid
-    if sameClone == False:
-        # crop to cloneMap:
-        xIdxSta = int(np.where(f.variables['lon'][:] == xULClone + 0.5*cellsizeInput)[0])
-        xIdxEnd = int(math.ceil(xIdxSta + colsClone /(cellsizeInput/cellsizeClone)))
-        yIdxSta = int(np.where(f.variables['lat'][:] == yULClone - 0.5*cellsizeInput)[0])
-        yIdxEnd = int(math.ceil(yIdxSta + rowsClone /(cellsizeInput/cellsizeClone)))
-        cropData = f.variables[varName][idx,yIdxSta:yIdxEnd,xIdxSta:xIdxEnd]
-        factor = int(float(cellsizeInput)/float(cellsizeClone))
+        # date
+        date = dateInput
+        if useDoy == "Yes": 
+            idx = dateInput - 1
+        else:
+            if isinstance(date, str) == True: date = \
+                            datetime.datetime.strptime(str(date),'%Y-%m-%d') 
+            date = datetime.datetime(date.year,date.month,date.day)
+            # time index (in the netCDF file)
+            nctime = f.variables['time']  # A netCDF time variable object.
+            idx = nc.date2index(date, nctime, calendar=nctime.calendar, \
+                                                         select='exact')
+        idx = int(idx)                                                  
+
+        sameClone = True
+        # check whether clone and input maps have the same attributes:
+        if cloneMapFileName != None:
+            # get the attributes of cloneMap
+            attributeClone = getMapAttributesALL(cloneMapFileName)
+            cellsizeClone = attributeClone['cellsize']
+            rowsClone = attributeClone['rows']
+            colsClone = attributeClone['cols']
+            xULClone = attributeClone['xUL']
+            yULClone = attributeClone['yUL']
+            # get the attributes of input (netCDF) 
+            cellsizeInput = f.variables['lat'][0]- f.variables['lat'][1]
+            cellsizeInput = float(cellsizeInput)
+            rowsInput = len(f.variables['lat'])
+            colsInput = len(f.variables['lon'])
+            xULInput = f.variables['lon'][0]-0.5*cellsizeInput
+            yULInput = f.variables['lat'][0]+0.5*cellsizeInput
+            # check whether both maps have the same attributes 
+            if cellsizeClone != cellsizeInput: sameClone = False
+            if rowsClone != rowsInput: sameClone = False
+            if colsClone != colsInput: sameClone = False
+            if xULClone != xULInput: sameClone = False
+            if yULClone != yULInput: sameClone = False
+
+        cropData = f.variables[varName][int(idx),:,:]       # still original data
+        factor = 1                          # needed in regridData2FinerGrid
+        if sameClone == False:
+            # crop to cloneMap:
+            xIdxSta = int(np.where(f.variables['lon'][:] == xULClone + 0.5*cellsizeInput)[0])
+            xIdxEnd = int(math.ceil(round(xIdxSta + colsClone /(cellsizeInput/cellsizeClone), 6)))
+            yIdxSta = int(np.where(f.variables['lat'][:] == yULClone - 0.5*cellsizeInput)[0])
+            yIdxEnd = int(math.ceil(round(yIdxSta + rowsClone /(cellsizeInput/cellsizeClone), 6)))
+            cropData = f.variables[varName][idx,yIdxSta:yIdxEnd,xIdxSta:xIdxEnd]
+            factor = int(round(float(cellsizeInput)/float(cellsizeClone)))
     
-    # convert to PCR object and close f
-    outPCR = pcr.numpy2pcr(pcr.Scalar, \
-               regridData2FinerGrid(factor,cropData,MV), \
-                  float(0.0))
-    f.close();
+        # convert to PCR object
+        outPCR = pcr.numpy2pcr(pcr.Scalar, \
+                   regridData2FinerGrid(factor,cropData,MV), \
+                      float(0.0))
     f = None ; cropData = None 
     # PCRaster object
     return (outPCR)    
@@ -388,62 +553,61 @@ def netcdf2PCRobjCloneWind(ncFile,varName,dateInput,useDoy = None,
     #     Only works if cellsizeClone <= cellsizeInput
     
     # Get netCDF file and variable name:
-    f = nc.Dataset(ncFile)
-    varName = str(varName)
-
-    # date
-    date = dateInput
-    if useDoy == "Yes": 
-        idx = dateInput - 1
-    else:
-        if isinstance(date, str) == True: date = \
-                        datetime.datetime.strptime(str(date),'%Y-%m-%d') 
-        date = datetime.datetime(date.year,date.month,date.day, 0, 0)
-        # time index (in the netCDF file)
-        nctime = f.variables['time']  # A netCDF time variable object.
-        idx = nc.date2index(date, nctime, select="exact")
-    idx = int(idx)                                                  
+    with datasetPool.pool.dataset(ncFile) as f:
+        varName = str(varName)
 
-    sameClone = True
-    # check whether clone and input maps have the same attributes:
-    if cloneMapFileName != None:
-        # get the attributes of cloneMap
-        attributeClone = getMapAttributesALL(cloneMapFileName)
-        cellsizeClone = attributeClone['cellsize']
-        rowsClone = attributeClone['rows']
-        colsClone = attributeClone['cols']
-        xULClone = attributeClone['xUL']
-        yULClone = attributeClone['yUL']
-        # get the attributes of input (netCDF) 
-        cellsizeInput = f.variables['lat'][0]- f.variables['lat'][1]
-        cellsizeInput = float(cellsizeInput)
-        rowsInput = len(f.variables['lat'])
-        colsInput = len(f.variables['lon'])
-        xULInput = f.variables['lon'][0]-0.5*cellsizeInput
-        yULInput = f.variables['lat'][0]+0.5*cellsizeInput
-        # check whether both maps have the same attributes 
-        if cellsizeClone != cellsizeInput: sameClone = False
-        if rowsClone != rowsInput: sameClone = False
-        if colsClone != colsInput: sameClone = False
-        if xULClone != xULInput: sameClone = False
-        if yULClone != yULInput: sameClone = False
-
-    cropData = f.variables[varName][int(idx),:,:]       # still original data
-    factor = 1                          # needed in regridData2FinerGrid
-    if sameClone == False:
-        # crop to cloneMap:
-        xIdxSta = int(np.where(f.variables['lon'][:] == xULClone + 0.5*cellsizeInput)[0])
-        xIdxEnd = int(math.ceil(xIdxSta + colsClone /(cellsizeInput/cellsizeClone)))
-        yIdxSta = int(np.where(f.variables['lat'][:] == yULClone - 0.5*cellsizeInput)[0])
-        yIdxEnd = int(math.ceil(yIdxSta + rowsClone /(cellsizeInput/cellsizeClone)))
-        cropData = f.variables[varName][idx,yIdxSta:yIdxEnd,xIdxSta:xIdxEnd]
-        factor = int(float(cellsizeInput)/float(cellsizeClone))
+        # date
+        date = dateInput
+        if useDoy == "Yes": 
+            idx = dateInput - 1
+        else:
+            if isinstance(date, str) == True: date = \
+                            datetime.datetime.strptime(str(date),'%Y-%m-%d') 
+            date = datetime.datetime(date.year,date.month,date.day, 0, 0)
+            # time index (in the netCDF file)
+            nctime = f.variables['time']  # A netCDF time variable object.
+            idx = nc.date2index(date, nctime, select="exact")
+        idx = int(idx)                                                  
+
+        sameClone = True
+        # check whether clone and input maps have the same attributes:
+        if cloneMapFileName != None:
+            # get the attributes of cloneMap
+            attributeClone = getMapAttributesALL(cloneMapFileName)
+            cellsizeClone = attributeClone['cellsize']
+            rowsClone = attributeClone['rows']
+            colsClone = attributeClone['cols']
+            xULClone = attributeClone['xUL']
+            yULClone = attributeClone['yUL']
+            # get the attributes of input (netCDF) 
+            cellsizeInput = f.variables['lat'][0]- f.variables['lat'][1]
+            cellsizeInput = float(cellsizeInput)
+            rowsInput = len(f.variables['lat'])
+            colsInput = len(f.variables['lon'])
+            xULInput = f.variables['lon'][0]-0.5*cellsizeInput
+            yULInput = f.variables['lat'][0]+0.5*cellsizeInput
+            # check whether both maps have the same attributes 
+            if cellsizeClone != cellsizeInput: sameClone = False
+            if rowsClone != rowsInput: sameClone = False
+            if colsClone != colsInput: sameClone = False
+            if xULClone != xULInput: sameClone = False
+            if yULClone != yULInput: sameClone = False
+
+        cropData = f.variables[varName][int(idx),:,:]       # still original data
+        factor = 1                          # needed in regridData2FinerGrid
+        if sameClone == False:
+            # crop to cloneMap:
+            xIdxSta = int(np.where(f.variables['lon'][:] == xULClone + 0.5*cellsizeInput)[0])
+            xIdxEnd = int(math.ceil(round(xIdxSta + colsClone /(cellsizeInput/cellsizeClone), 6)))
+            yIdxSta = int(np.where(f.variables['lat'][:] == yULClone - 0.5*cellsizeInput)[0])
+            yIdxEnd = int(math.ceil(round(yIdxSta + rowsClone /(cellsizeInput/cellsizeClone), 6)))
+            cropData = f.variables[varName][idx,yIdxSta:yIdxEnd,xIdxSta:xIdxEnd]
+            factor = int(round(float(cellsizeInput)/float(cellsizeClone)))
     
-    # convert to PCR object and close f
-    outPCR = pcr.numpy2pcr(pcr.Scalar, \
-               regridData2FinerGrid(factor,cropData,MV), \
-                  float(f.variables[varName]._FillValue))
-    f.close();
+        # convert to PCR object
+        outPCR = pcr.numpy2pcr(pcr.Scalar, \
+                   regridData2FinerGrid(factor,cropData,MV), \
+                      float(f.variables[varName]._FillValue))
     f = None ; cropData = None 
     # PCRaster object
     return (outPCR)    
@@ -453,24 +617,24 @@ def netcdf2PCRobj(ncFile,varName,dateInput):
     # The cloneMap is globally defined (outside this method).
     
     # Get netCDF file and variable name:
-    f = nc.Dataset(ncFile)
-    varName = str(varName)
-
-    # date
-    date = dateInput
-    if isinstance(date, str) == True: date = \
-                    datetime.datetime.strptime(str(date),'%Y-%m-%d') 
-    date = datetime.datetime(date.year,date.month,date.day)
-    
-    # time index (in the netCDF file)
-    nctime = f.variables['time']  # A netCDF time variable object.
-    idx = nc.date2index(date, nctime, calendar=nctime.calendar, \
-                                                 select='exact') 
-    
-    # convert to PCR object and close f
-    outPCR = pcr.numpy2pcr(pcr.Scalar,(f.variables[varName][idx].data), \
-                             float(f.variables[varName]._FillValue))
-    f.close(); f = None ; del f
+    with datasetPool.pool.dataset(ncFile) as f:
+        varName = str(varName)
+
+        # date
+        date = dateInput
+        if isinstance(date, str) == True: date = \
+                        datetime.datetime.strptime(str(date),'%Y-%m-%d') 
+        date = datetime.datetime(date.year,date.month,date.day)
+    
+        # time index (in the netCDF file)
+        nctime = f.variables['time']  # A netCDF time variable object.
+        idx = nc.date2index(date, nctime, calendar=nctime.calendar, \
+                                                     select='exact') 
+    
+        # convert to PCR object
+        outPCR = pcr.numpy2pcr(pcr.Scalar,(f.variables[varName][idx].data), \
+                                 float(f.variables[varName]._FillValue))
+    f = None ; del f
     # PCRaster object
     return (outPCR)
 
@@ -487,10 +651,14 @@ def writePCRmapToDir(v,outFileName,outDir):
     fullFileName = getFullPath(outFileName,outDir)
     pcr.report(v,fullFileName)
 
-def readPCRmapClone(v,cloneMapFileName,tmpDir,absolutePath=None,isLddMap=False,cover=None,isNomMap=False):
+def readPCRmapClone(v,cloneMapFileName,tmpDir,absolutePath=None,isLddMap=False,cover=None,isNomMap=False,\
+                    resampleMethod=None,warpCacheFolder=None):
 	# v: inputMapFileName or floating values
 	# cloneMapFileName: If the inputMap and cloneMap have different clones,
-	#                   resampling will be done.   
+	#                   resampling will be done (in-process; see warping.warpMap
+	#                   for the resampleMethod: "nearest", "average" or "mode").   
+	# resampleMethod  : default: "mode" for ldd and nominal maps, otherwise "nearest"
+	# warpCacheFolder : the folder of warped maps (default: tmpDir/warp_cache/)
     print(v)
     if v == "None":
         PCRmap = str("None")
@@ -501,25 +669,24 @@ def readPCRmapClone(v,cloneMapFileName,tmpDir,absolutePath=None,isLddMap=False,c
         if sameClone == True:
             PCRmap = pcr.readmap(v)
         else:
-            # resample using GDAL:
-            output = tmpDir+'temp.map'
-            warp = gdalwarpPCR(v,output,cloneMapFileName,tmpDir,isLddMap,isNomMap)
-            # read from temporary file and delete the temporary file:
-            PCRmap = pcr.readmap(output)
+            # resample in-process (without temporary files); every warped map is cached
+            # (warping is only imported here, as it imports remapPlan, which imports virtualOS)
+            import warping
+            if warpCacheFolder == None: warpCacheFolder = os.path.join(str(tmpDir), "warp_cache")
+            if resampleMethod == None: resampleMethod = "mode" if (isLddMap == True or isNomMap == True) else "nearest"
+            warped = warping.getWarpedMap(v, cloneMapFileName, resampleMethod, warpCacheFolder, MV)
+            if isLddMap == True or isNomMap == True:
+                PCRmap = pcr.numpy2pcr(pcr.Nominal, np.where(warped == MV, -9999, np.round(warped)).astype(np.int32), -9999)
+            else:
+                PCRmap = pcr.numpy2pcr(pcr.Scalar, warped, MV)
             if isLddMap == True: PCRmap = pcr.ifthen(pcr.scalar(PCRmap) < 10., PCRmap)
             if isLddMap == True: PCRmap = pcr.ldd(PCRmap)
             if isNomMap == True: PCRmap = pcr.ifthen(pcr.scalar(PCRmap) >  0., PCRmap)
             if isNomMap == True: PCRmap = pcr.nominal(PCRmap)
-            co = 'rm '+str(tmpDir)+'*.*'
-            cOut,err = subprocess.Popen(co, stdout=subprocess.PIPE,stderr=open('/dev/null'),shell=True).communicate()
     else:
         PCRmap = pcr.scalar(float(v))
     if cover != None:
         PCRmap = pcr.cover(PCRmap, cover)
-    co = None; cOut = None; err = None; warp = None
-    del co; del cOut; del err; del warp
-    stdout = None; del stdout
-    stderr = None; del stderr
     return PCRmap    
 
 def readPCRmap(v):
@@ -690,44 +857,25 @@ def isLastDayOfMonth(date):
         return False
 
 def getMapAttributesALL(cloneMap):
-    co = ['mapattr -p %s ' %(cloneMap)]
-    cOut,err = subprocess.Popen(co, stdout=subprocess.PIPE,stderr=open('/dev/null'),shell=True).communicate()
-    if err !=None or cOut == []:
-        print "Something wrong with mattattr in virtualOS, maybe clone Map does not exist ? "
+    # map attributes from the (cached) header of the map (see csfMap.readHeader) 
+    try:
+        header = csfMap.readHeader(cloneMap)
+    except (IOError, OSError):
+        print "Something wrong with the header of "+str(cloneMap)+" in virtualOS, maybe clone Map does not exist ? "
         sys.exit()
-    mapAttr = {'cellsize': float(cOut.split()[7]) ,\
-               'rows'    : float(cOut.split()[3]) ,\
-               'cols'    : float(cOut.split()[5]) ,\
-               'xUL'     : float(cOut.split()[17]),\
-               'yUL'     : float(cOut.split()[19])}
-    co = None; cOut = None; err = None
-    del co; del cOut; del err
-    n = gc.collect() ; del gc.garbage[:] ; n = None ; del n
+    mapAttr = {'cellsize': float(header['cellsize']) ,\
+               'rows'    : float(header['rows'])     ,\
+               'cols'    : float(header['cols'])     ,\
+               'xUL'     : float(header['xUL'])      ,\
+               'yUL'     : float(header['yUL'])}
     return mapAttr 
 
 def getMapAttributes(cloneMap,attribute):
-    co = ['mapattr -p %s ' %(cloneMap)]
-    cOut,err = subprocess.Popen(co, stdout=subprocess.PIPE,stderr=open('/dev/null'),shell=True).communicate()
-    #print cOut
-    if err !=None or cOut == []:
-        print "Something wrong with mattattr in virtualOS, maybe clone Map does not exist ? "
-        sys.exit()
-    #print cOut.split()
-    co = None; err = None
-    del co; del err
-    n = gc.collect() ; del gc.garbage[:] ; n = None ; del n
-    if attribute == 'cellsize':
-        return float(cOut.split()[7])
-    if attribute == 'rows':
-        return int(cOut.split()[3])
-        #return float(cOut.split()[3])
-    if attribute == 'cols':
-        return int(cOut.split()[5])
-        #return float(cOut.split()[5])
-    if attribute == 'xUL':
-        return float(cOut.split()[17])
-    if attribute == 'yUL':
-        return float(cOut.split()[19])
+    mapAttr = getMapAttributesALL(cloneMap)
+    if attribute in ['rows', 'cols']:
+        return int(mapAttr[attribute])
+    if attribute in ['cellsize', 'xUL', 'yUL']:
+        return mapAttr[attribute]
     
 def getMapTotal(mapFile):
     ''' outputs the sum of all values in a map file '''
@@ -831,48 +979,86 @@ def regridMapFile2FinerGrid (rescaleFac,coarse):
     return pcr.numpy2pcr(pcr.Scalar, regridData2FinerGrid(rescaleFac,pcr.pcr2numpy(coarse,MV),MV),MV)
     
 def regridData2FinerGrid(rescaleFac,coarse,MV):
+    # Refines a field (rows, cols) or a stack of fields (..., rows, cols): every cell 
+    # becomes rescaleFac x rescaleFac cells (with the same value and data type), in a
+    # (..., rows*rescaleFac, cols*rescaleFac) array that is filled (in one copy) from a
+    # broadcast view of coarse
     if rescaleFac ==1:
         return coarse
-    nr,nc = np.shape(coarse)
-    
-    fine= np.zeros(nr*nc*rescaleFac*rescaleFac).reshape(nr*rescaleFac,nc*rescaleFac) + MV
-    
- 
-    ii = -1
-    nrF,ncF = np.shape(fine)
-    for i in range(0 , nrF):
-            if i % rescaleFac == 0:
-                ii += 1
-            fine [i,:] = coarse[ii,:].repeat(rescaleFac)
-
-    nr = None; nc = None
-    del nr; del nc
-    nrF = None; ncF = None
-    del nrF; del ncF
-    n = gc.collect() ; del gc.garbage[:] ; n = None ; del n
+    coarse = np.asarray(coarse)
+    lead = coarse.shape[:-2]
+    nr,nc = coarse.shape[-2:]
+    blocks = np.broadcast_to(coarse[..., :, None, :, None], lead + (nr,rescaleFac,nc,rescaleFac))
+
+    fine = np.empty(lead + (nr*rescaleFac,nc*rescaleFac), dtype = coarse.dtype)
+    fine.reshape(blocks.shape)[...] = blocks
     return fine
 
+def getBlocks(fine,fac):
+    # returns the fac x fac blocks of a (..., rows, cols) array in an array 
+    # with the shape (..., rows/fac, cols/fac, fac*fac); rows and columns
+    # that do not fill a complete block are ignored (as in regridToCoarse)
+    fac = int(fac)
+    nr,nc = np.shape(fine)[-2:]
+    nrCoarse = nr // fac ; ncCoarse = nc // fac
+    lead = np.shape(fine)[:-2]
+    blocks = fine[...,0:nrCoarse*fac,0:ncCoarse*fac]
+    blocks = blocks.reshape(lead + (nrCoarse,fac,ncCoarse,fac))
+    blocks = np.swapaxes(blocks,-3,-2)
+    # the (copying) reshape puts every block in one contiguous row 
+    return blocks.reshape(lead + (nrCoarse,ncCoarse,fac*fac))
+
+def getTimeStepBlocks(timeSteps, blockSize):
+    # splits a list of (index, date) time steps in blocks of (at most blockSize)
+    # time steps with consecutive indices, so that every block can be read at once
+    blocks = []
+    for timeStep in timeSteps:
+        if len(blocks) > 0 and len(blocks[-1]) < blockSize and \
+           timeStep[0] == blocks[-1][-1][0] + 1:
+            blocks[-1].append(timeStep)
+        else:
+            blocks.append([timeStep])
+    return blocks
+
 def regridToCoarse(fine,fac,mode,missValue):
-    nr,nc = np.shape(fine)
-    coarse = np.zeros(nr/fac * nc / fac).reshape(nr/fac,nc/fac) + MV
-    nr,nc = np.shape(coarse)
-    for r in range(0,nr):
-        for c in range(0,nc):
-            ar = fine[r * fac : fac * (r+1),c * fac: fac * (c+1)]
-            m = np.ma.masked_values(ar,missValue)
-            if ma.count(m) == 0:
-                coarse[r,c] = MV
-            else:
-                if mode == 'average':
-                    coarse [r,c] = ma.average(m)
-                elif mode == 'median': 
-                    coarse [r,c] = ma.median(m)
-                elif mode == 'sum':
-                    coarse [r,c] = ma.sum(m)
-                elif mode =='min':
-                    coarse [r,c] = ma.min(m)
-                elif mode == 'max':
-                    coarse [r,c] = ma.max(m)
+    # All blocks are reduced at once. The masking and the arithmetic follow 
+    # the former cell-by-cell np.ma loop so that the results are identical: 
+    # - cells (approximately) equal to missValue are ignored (np.ma.masked_values),
+    # - blocks without any value get MV.
+    fac = int(fac)
+    blocks = getBlocks(ma.filled(fine,missValue),fac)
+    if np.issubdtype(blocks.dtype, np.floating):
+        valid = ~np.isclose(blocks,missValue,atol=1e-8,rtol=1e-5)
+    else:
+        valid = blocks != missValue
+    count = valid.sum(axis=-1)
+    coarse = np.zeros(count.shape) + MV
+    
+    if mode == 'average' or mode == 'sum':
+        values = np.where(valid,blocks,0).sum(axis=-1)
+        if mode == 'average':
+            total = values
+            values = total.astype(np.float64) / np.maximum(count,1)
+            # np.ma keeps the input precision for blocks without masked cells
+            if np.issubdtype(blocks.dtype, np.floating) and blocks.dtype.itemsize < 8:
+                complete = count == fac*fac
+                values[complete] = (total[complete] / count[complete]).astype(blocks.dtype)
+    elif mode == 'median':
+        # missing cells are sorted behind the values (as in np.ma.median)
+        sortedBlocks = np.sort(np.where(valid,blocks,ma.minimum_fill_value(blocks)),axis=-1)
+        low  = np.take_along_axis(sortedBlocks,(np.maximum(count-1,0)//2)[...,None],axis=-1)[...,0]
+        high = np.take_along_axis(sortedBlocks,(count//2)[...,None],axis=-1)[...,0]
+        values = np.where(count % 2 == 1, low, np.true_divide(low + high, 2.))
+        if np.issubdtype(blocks.dtype, np.floating):
+            values[np.isnan(np.where(valid,blocks,0)).any(axis=-1)] = np.nan
+    elif mode == 'min':
+        values = np.where(valid,blocks,ma.minimum_fill_value(blocks)).min(axis=-1)
+    elif mode == 'max':
+        values = np.where(valid,blocks,ma.maximum_fill_value(blocks)).max(axis=-1)
+    else:
+        values = coarse
+    
+    coarse[count > 0] = values[count > 0]
     return coarse    
         
     
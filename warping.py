@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# In-process warping (resampling) of static maps (e.g. cell area, ldd or
+# nominal maps) to a clone map, without GDAL, subprocesses or temporary
+# files. Warped maps are kept in a content-addressed cache (keyed by the
+# content of the map, the clone attributes and the method), so that every
+# (map, clone) pair is warped only once, also across runs.
+
+import os
+import hashlib
+import json
+
+import numpy as np
+
+import csfMap
+import remapPlan
+from virtualOS import LazyModule
+
+# scipy (sparse matrices) is only imported when a map is warped
+sparse = LazyModule("scipy.sparse")
+
+# version of the warping methods (part of the cache key)
+warpVersion = 1
+
+# content digests of map files (path -> (size, modification time, digest))
+digestCache = dict()
+
+def warpMap(values, source_grid, target_grid, method = "nearest", missValue = 1e20):
+    #
+    # Warps values (rows, cols) on the source grid to the target grid; grids are dictionaries
+    # with 'xUL', 'yUL', 'cellsize', 'rows' and 'cols'. Target cells without values get missValue.
+    # - "nearest": the value of the source cell at the target cell center (as gdalwarp)
+    # - "average": the mean of the overlapping source values, weighted by their overlap
+    # - "mode"   : the value with the largest overlap (for nominal and ldd maps)
+    values = np.asarray(values, dtype = np.float64)
+    available = ~np.isclose(values, missValue)
+
+    if method == "nearest":
+        # the source rows and columns at the centers of target cells
+        rows = np.floor((float(source_grid['yUL']) - float(target_grid['yUL']) + float(target_grid['cellsize']) * (np.arange(int(target_grid['rows'])) + 0.5))\
+                        / float(source_grid['cellsize'])).astype(np.int64)
+        cols = np.floor((float(target_grid['xUL']) - float(source_grid['xUL']) + float(target_grid['cellsize']) * (np.arange(int(target_grid['cols'])) + 0.5))\
+                        / float(source_grid['cellsize'])).astype(np.int64)
+        inside = ((rows >= 0) & (rows < values.shape[0]))[:,None] & ((cols >= 0) & (cols < values.shape[1]))[None,:]
+        rows = np.clip(rows, 0, values.shape[0] - 1)[:,None]
+        cols = np.clip(cols, 0, values.shape[1] - 1)[None,:]
+        return np.where(inside & available[rows, cols], values[rows, cols], missValue)
+
+    # overlap fractions of source cells in target cells (rows from north)
+    row_fraction = remapPlan.overlapFractions(-float(source_grid['yUL']), float(source_grid['cellsize']), int(source_grid['rows']),
+                                    -float(target_grid['yUL']), float(target_grid['cellsize']), int(target_grid['rows']))
+    col_fraction = remapPlan.overlapFractions( float(source_grid['xUL']), float(source_grid['cellsize']), int(source_grid['cols']),
+                                     float(target_grid['xUL']), float(target_grid['cellsize']), int(target_grid['cols']))
+    row_fraction = row_fraction.tocsr() ; col_fraction = col_fraction.tocsr()
+    target_shape = (int(target_grid['rows']), int(target_grid['cols']))
+
+    if method == "average":
+        # separable: first along columns, then along rows
+        weighted = row_fraction.T.dot(col_fraction.T.dot(np.where(available, values, 0.0).T).T)
+        weights  = row_fraction.T.dot(col_fraction.T.dot(available.astype(np.float64).T).T)
+        return np.where(weights > 0.0, weighted / np.maximum(weights, 1e-300), missValue).reshape(target_shape)
+
+    if method == "mode":
+        # all (source, target, overlap) combinations of available source cells
+        fraction = sparse.kron(row_fraction, col_fraction, format = 'coo')
+        used = available.ravel()[fraction.row]
+        source = fraction.row[used] ; target = fraction.col[used] ; overlap = fraction.data[used]
+        value = values.ravel()[source]
+        warped = np.full(target_shape[0] * target_shape[1], missValue)
+        if len(target) == 0: return warped.reshape(target_shape)
+        # the total overlap of every (target, value)
+        order = np.lexsort((value, target))
+        target = target[order] ; value = value[order] ; overlap = overlap[order]
+        first = np.r_[True, (target[1:] != target[:-1]) | (value[1:] != value[:-1])]
+        starts = np.nonzero(first)[0]
+        total = np.add.reduceat(overlap, starts)
+        target = target[starts] ; value = value[starts]
+        # per target, the value with the largest total overlap (the smallest value if equal)
+        order = np.lexsort((value, -total, target))
+        best = order[np.r_[True, target[order][1:] != target[order][:-1]]]
+        warped[target[best]] = value[best]
+        return warped.reshape(target_shape)
+
+    raise ValueError("Unknown warping method: "+str(method))
+
+def fileDigest(fileName):
+    # the sha1 digest of the content of a file (calculated once per file version)
+    path = os.path.abspath(fileName)
+    stat = os.stat(path)
+    if path in digestCache.keys() and digestCache[path][:2] == (stat.st_size, stat.st_mtime):
+        return digestCache[path][2]
+    digest = hashlib.sha1()
+    with open(path, 'rb') as mapFile:
+        for data in iter(lambda: mapFile.read(2**24), b""): digest.update(data)
+    digestCache[path] = (stat.st_size, stat.st_mtime, digest.hexdigest())
+    return digestCache[path][2]
+
+def getWarpedMap(mapFileName, cloneMapFileName, method = "nearest", cacheFolder = None, missValue = 1e20, mmapMode = None):
+    #
+    # Returns the values (numpy array) of a PCRaster map warped to the clone map. If a cache folder
+    # is given, the result is taken from (or saved in) the cache; cache files are written to a
+    # temporary file first, so that concurrent runs can share the cache folder. With mmapMode 
+    # (e.g. 'r'), a cached result is returned as a memory map (see numpy.load).
+    clone_grid = csfMap.readHeader(cloneMapFileName)
+    key = json.dumps([warpVersion, fileDigest(mapFileName), remapPlan.gridTuple(clone_grid), method, missValue])
+    cacheFileName = None
+    if cacheFolder != None:
+        cacheFileName = os.path.join(cacheFolder, "warped_" + hashlib.sha1(key.encode('utf-8')).hexdigest() + ".npy")
+        if os.path.isfile(cacheFileName):
+            print("Using the warped map: "+str(cacheFileName))
+            return np.load(cacheFileName, mmap_mode = mmapMode)
+
+    print("Warping "+str(mapFileName)+" to "+str(cloneMapFileName)+" ("+str(method)+")")
+    warped = warpMap(csfMap.readMap(mapFileName, missValue), csfMap.readHeader(mapFileName), clone_grid, method, missValue)
+
+    if cacheFileName != None:
+        if not os.path.exists(cacheFolder):
+            try:
+                os.makedirs(cacheFolder)
+            except OSError:
+                pass
+        tmpFileName = cacheFileName + ".tmp" + str(os.getpid()) + ".npy"
+        np.save(tmpFileName, warped)
+        os.rename(tmpFileName, cacheFileName)
+        if mmapMode != None: return np.load(cacheFileName, mmap_mode = mmapMode)
+    return warped